@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+医師数などの集計（保存のたびに差分で更新する集計テーブル）
+
+病院データのメインテーブル（印_n / 卒業_n / Dr./出身大学_n / 診療科_n）の
+1行を医師1人として、次の集計を保持します。
+
+    stats_doctors           都道府県・診療科・出身大学・卒業 ごとの医師数
+    stats_hospital_doctors  上記に病院コードを加えた医師数（病院数の集計用）
+
+病院データの保存時は、履歴用に求めた変更フィールド（diff_fields）から
+変わった行だけを旧データの分を減らし新データの分を加えます（保存と同じ
+トランザクション）。CSVの取り込みなどでDBを直接変更した場合は rebuild を
+実行してください。
+
+使い方:
+    python aggregate_stats.py rebuild
+    python aggregate_stats.py show --group-by prefecture department
+"""
+
+import argparse
+import os
+import re
+import sqlite3
+
+import storage_codec
+
+DB_PATH = os.environ.get('DATABASE_PATH', 'hospital_data.sqlite3')
+
+# 集計の軸（API の group_by 名 → 列名）
+DIMENSIONS = ('prefecture', 'department', 'university', 'graduation')
+
+# 医師の行のフィールド（いずれかに値があれば医師1人として数える）
+ROW_FIELDS = ('印', '卒業', 'Dr./出身大学', '診療科')
+ROW_FIELD_RE = re.compile(r'^(印|卒業|Dr\./出身大学|診療科)_(\d+)$')
+
+def ensure_tables(conn):
+    dims = ', '.join(f"{d} TEXT NOT NULL DEFAULT ''" for d in DIMENSIONS)
+    keys = ', '.join(DIMENSIONS)
+    conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS stats_doctors (
+            {dims},
+            doctors INTEGER NOT NULL,
+            PRIMARY KEY ({keys})
+        )
+    ''')
+    conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS stats_hospital_doctors (
+            code TEXT NOT NULL,
+            {dims},
+            doctors INTEGER NOT NULL,
+            PRIMARY KEY (code, {keys})
+        )
+    ''')
+
+# ============================================
+# 医師の行
+# ============================================
+
+def _value(kv, base, n):
+    value = kv.get(f'{base}_{n}', '')
+    return value.strip() if isinstance(value, str) else str(value)
+
+def doctor_cell(code, kv, n):
+    """n 行目の医師の集計キー（医師がいない行は None）"""
+    if not kv or not any(_value(kv, base, n) for base in ROW_FIELDS):
+        return None
+    return (code[:2], _value(kv, '診療科', n), _value(kv, 'Dr./出身大学', n), _value(kv, '卒業', n))
+
+def doctor_rows(kv):
+    """医師の行番号"""
+    rows = set()
+    for key in kv or ():
+        m = ROW_FIELD_RE.match(key)
+        if m:
+            rows.add(int(m.group(2)))
+    return rows
+
+def _add(conn, code, cell, delta):
+    """集計キー1つ分の医師数を増減（0になった行は削除）"""
+    for table, columns, params in (('stats_doctors', DIMENSIONS, cell),
+                                   ('stats_hospital_doctors', ('code',) + DIMENSIONS, (code,) + cell)):
+        conn.execute(f'''
+            INSERT INTO {table} ({', '.join(columns)}, doctors) VALUES ({', '.join('?' * len(columns))}, ?)
+            ON CONFLICT ({', '.join(columns)}) DO UPDATE SET doctors = doctors + excluded.doctors
+        ''', (*params, delta))
+        if delta < 0:
+            where = ' AND '.join(f'{c} = ?' for c in columns)
+            conn.execute(f'DELETE FROM {table} WHERE {where} AND doctors <= 0', params)
+
+def apply_change(conn, code, old_data, new_data, changed_fields):
+    """
+    保存1件分の差分を集計に反映（呼び出し元のトランザクション内で実行）
+
+    Args:
+        changed_fields: diff_fields() の結果（old_data がない場合は新規作成として全行を加算）
+
+    Returns:
+        反映した医師の行数
+    """
+    if old_data:
+        rows = set()
+        for field in changed_fields:
+            m = ROW_FIELD_RE.match(field)
+            if m:
+                rows.add(int(m.group(2)))
+    else:
+        rows = doctor_rows(new_data)
+
+    applied = 0
+    for n in rows:
+        old_cell = doctor_cell(code, old_data, n)
+        new_cell = doctor_cell(code, new_data, n)
+        if old_cell == new_cell:
+            continue
+        if old_cell:
+            _add(conn, code, old_cell, -1)
+        if new_cell:
+            _add(conn, code, new_cell, 1)
+        applied += 1
+    return applied
+
+def fill(conn, codec):
+    """
+    集計を全件から作り直す（呼び出し元のトランザクション内で実行）
+
+    Returns:
+        医師数の合計
+    """
+    conn.execute('DELETE FROM stats_doctors')
+    conn.execute('DELETE FROM stats_hospital_doctors')
+    total = 0
+    for code, kv in conn.execute('SELECT code, kv FROM mdata').fetchall():
+        try:
+            data = codec.loads(kv)
+        except Exception:
+            continue
+        for n in doctor_rows(data):
+            cell = doctor_cell(code, data, n)
+            if cell:
+                _add(conn, code, cell, 1)
+                total += 1
+    return total
+
+def rebuild(conn, codec):
+    """集計を全件から作り直す"""
+    with conn:
+        ensure_tables(conn)
+        return fill(conn, codec)
+
+# ============================================
+# 集計の取得（APIから使用）
+# ============================================
+
+def query(conn, group_by, filters=None, limit=None):
+    """
+    集計の取得
+
+    Args:
+        group_by: DIMENSIONS のリスト（空の場合は全体の合計）
+        filters: {軸: 値}（'' は未入力）
+        limit: 医師数の多い順に返す件数
+
+    Returns:
+        [{軸..., 'doctors', 'hospitals'}]
+    """
+    for dim in list(group_by) + list(filters or {}):
+        if dim not in DIMENSIONS:
+            raise ValueError(f'Unknown dimension: {dim}')
+
+    where, params = '', []
+    if filters:
+        where = 'WHERE ' + ' AND '.join(f'{dim} = ?' for dim in filters)
+        params = list(filters.values())
+    cols = ', '.join(group_by)
+    select = f'{cols}, ' if group_by else ''
+    group = f'GROUP BY {cols}' if group_by else ''
+
+    doctors = conn.execute(f'''
+        SELECT {select}SUM(doctors) AS doctors FROM stats_doctors {where} {group}
+    ''', params).fetchall()
+    # 病院数は軸をまたいで合計できないため、病院ごとの集計から数える
+    hospitals = {tuple(row[:-1]): row[-1] for row in conn.execute(f'''
+        SELECT {select}COUNT(DISTINCT code) FROM stats_hospital_doctors {where} {group}
+    ''', params)}
+
+    rows = []
+    for row in doctors:
+        key = tuple(row[:-1])
+        if row[-1] is None:
+            continue
+        item = dict(zip(group_by, key))
+        item['doctors'] = row[-1]
+        item['hospitals'] = hospitals.get(key, 0)
+        rows.append(item)
+    rows.sort(key=lambda r: (-r['doctors'], [r[d] for d in group_by]))
+    return rows[:limit] if limit else rows
+
+# ============================================
+# コマンドライン
+# ============================================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='医師数などの集計')
+    parser.add_argument('--database', default=DB_PATH, help='データベースファイル')
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('rebuild', help='集計を全件から作り直す（取り込み後など）')
+    p_show = sub.add_parser('show', help='集計を表示')
+    p_show.add_argument('--group-by', nargs='*', default=['prefecture'], choices=DIMENSIONS)
+    p_show.add_argument('--limit', type=int, default=30)
+    args = parser.parse_args(argv)
+
+    conn = sqlite3.connect(args.database)
+    try:
+        if args.command == 'rebuild':
+            total = rebuild(conn, storage_codec.get_codec(args.database))
+            print(f"✅ 集計を作り直しました: 医師 {total}人")
+        else:
+            for row in query(conn, args.group_by, limit=args.limit):
+                label = ' / '.join(row[d] or '(未入力)' for d in args.group_by) or '合計'
+                print(f"{label:<40} 医師 {row['doctors']:>5}人  病院 {row['hospitals']:>4}件")
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    main()
@@ -1,142 +1,122 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, send_from_directory
+from flask import Flask, Blueprint, render_template, request, redirect, url_for, session, flash, jsonify, send_from_directory, Response, stream_with_context, g
 from flask_socketio import SocketIO, emit
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.middleware.proxy_fix import ProxyFix
 import sqlite3
 import os
-import json
+import json_engine
+import storage_codec
+import compression
+import static_assets
+import login_guard
+import audit_writer
+import login_retention
+import history_archive
+import migrations
+import hospital_index
+import backup_db
+import read_replica
+import find_replace
+import aggregate_stats
+import geo
+import similarity
+import dedup
+import validation
+import change_log
+import rate_limit
+import health_check
+import gc
+import io
+import csv
+import time
+import atexit
 from datetime import datetime, timedelta
 import secrets
 
-app = Flask(__name__)
+# 画面・APIのルート（create_app() で作成したアプリに登録）
+bp = Blueprint('main', __name__)
 
-# ============================================
-# セッション設定
-# ============================================
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', secrets.token_hex(32))
-app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=8)
-app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
-app.config['SESSION_COOKIE_SECURE'] = False  # ローカル開発環境用（HTTPSの場合はTrue）
-app.config['SESSION_COOKIE_HTTPONLY'] = True
-app.config['SESSION_COOKIE_NAME'] = 'hospital_session'
+# Socket.IO（サーバーは create_app() の init_app で作成）
+socketio = SocketIO()
 
-socketio = SocketIO(app, cors_allowed_origins="*")
+# リバースプロキシの段数（X-Forwarded-For のうち信頼する分。0 の場合はヘッダーを使わない）
+# request.remote_addr をクライアントのアドレスにする（ログイン失敗の記録・流量制限のキー）
+TRUSTED_PROXY_COUNT = int(os.environ.get('TRUSTED_PROXY_COUNT', 0))
 
 DATABASE = os.environ.get('DATABASE_PATH', 'hospital_data.sqlite3')
 
+# 近隣病院・似ている病院・重複した病院データの候補のAPIで返す最大件数
+GEO_MAX_RESULTS = int(os.environ.get('GEO_MAX_RESULTS', 200))
+SIMILAR_MAX_RESULTS = int(os.environ.get('SIMILAR_MAX_RESULTS', 100))
+DEDUP_MAX_RESULTS = int(os.environ.get('DEDUP_MAX_RESULTS', 1000))
+# 定期バックアップの間隔（0 の場合は行わない）
+BACKUP_INTERVAL_MINUTES = int(os.environ.get('BACKUP_INTERVAL_MINUTES', 0))
+
+# 以下は create_app() で作成（1プロセスで使うアプリは1つ）
+assets = None
+replica = None
+audit_log = None
+hospitals = None
+geo_index = None
+similar_hospitals = None
+dedup_report = None
+readiness = None
+backup_scheduler = None
+password_verifier = None
+login_throttle = None
+rate_limiter = None
+admission = None
+
+# 保存時の入力チェック（validation.RULES を読み込み時にコンパイル）
+validator = validation.Validator()
+
 def get_db_connection():
     conn = sqlite3.connect(DATABASE)
     conn.row_factory = sqlite3.Row
     return conn
 
-def init_db():
-    """データベースの初期化"""
-    conn = get_db_connection()
-    
-    # usersテーブル
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            password TEXT NOT NULL,
-            email TEXT UNIQUE NOT NULL,
-            role TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # password_reset_tokensテーブル
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS password_reset_tokens (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            token TEXT UNIQUE NOT NULL,
-            expires_at TIMESTAMP NOT NULL,
-            used INTEGER DEFAULT 0,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-    
-    # mdataテーブル（病院データ）
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS mdata (
-            code TEXT PRIMARY KEY,
-            kv TEXT NOT NULL,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_by INTEGER,
-            FOREIGN KEY (updated_by) REFERENCES users (id)
-        )
-    ''')
-    
-    # locksテーブル（編集ロック）
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS locks (
-            code TEXT PRIMARY KEY,
-            user_id INTEGER NOT NULL,
-            username TEXT NOT NULL,
-            locked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-    
-    # 🆕 historyテーブル（変更履歴）
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            code TEXT NOT NULL,
-            action TEXT NOT NULL,
-            old_data TEXT,
-            new_data TEXT,
-            changed_fields TEXT,
-            user_id INTEGER NOT NULL,
-            username TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-    
-    # 履歴テーブルのインデックス（検索高速化）
-    conn.execute('''
-        CREATE INDEX IF NOT EXISTS idx_history_code 
-        ON history(code)
-    ''')
-    
-    conn.execute('''
-        CREATE INDEX IF NOT EXISTS idx_history_user 
-        ON history(user_id)
-    ''')
-    
-    conn.execute('''
-        CREATE INDEX IF NOT EXISTS idx_history_created 
-        ON history(created_at DESC)
-    ''')
-    
-    conn.commit()
-    conn.close()
-    print("✅ データベーステーブルを初期化しました")
+def get_read_connection():
+    """参照のみのAPI用の接続（READ_REPLICA=1 の場合はメモリ上のコピー）"""
+    return replica.connect()
 
-# アプリケーション起動時にデータベースを初期化
-init_db()
+def get_storage_codec():
+    """病院データ・履歴の保存形式（圧縮コーデック）を取得"""
+    return storage_codec.get_codec(DATABASE)
+
+def init_db(database=None):
+    """データベースのスキーマを最新にする（未適用のマイグレーションを適用）"""
+    migrations.upgrade(database or DATABASE)
+
+def check_schema(database=None):
+    """
+    スキーマのバージョンを確認（起動時は変更せず、確認のみ）
+
+    Raises:
+        RuntimeError: 未適用のマイグレーションがある場合
+    """
+    database = database or DATABASE
+    remaining = migrations.pending(database)
+    if remaining:
+        raise RuntimeError(f'未適用のマイグレーションがあります（{remaining}件）: '
+                           f'python migrations.py --database {database} upgrade を実行してください')
+
+@bp.before_app_request
+def start_backup_scheduler():
+    # BACKUP_INTERVAL_MINUTES > 0 の場合、各プロセスの最初のリクエストで開始
+    backup_scheduler.start()
 
 # ============================================
 # 履歴記録用のヘルパー関数
 # ============================================
 
-def record_history(code, action, old_data, new_data, user_id, username):
+def diff_fields(old_data, new_data):
     """
-    データ変更履歴を記録
+    変更前後のデータを比較し、変更されたフィールド名のリストを返す
     
     Args:
-        code: 病院コード
-        action: アクション ('create', 'update', 'delete')
         old_data: 変更前のデータ（辞書）
         new_data: 変更後のデータ（辞書）
-        user_id: ユーザーID
-        username: ユーザー名
     """
-    conn = get_db_connection()
-    
-    # 変更されたフィールドを検出
     changed_fields = []
     if old_data and new_data:
         for key in set(list(old_data.keys()) + list(new_data.keys())):
@@ -144,24 +124,51 @@ def record_history(code, action, old_data, new_data, user_id, username):
             new_value = new_data.get(key, '')
             if old_value != new_value:
                 changed_fields.append(key)
+    return changed_fields
+
+def record_history(code, action, old_data, new_data, user_id, username, wait=None):
+    """
+    データ変更履歴を記録
     
-    # JSON形式で保存
-    old_data_json = json.dumps(old_data, ensure_ascii=False) if old_data else None
-    new_data_json = json.dumps(new_data, ensure_ascii=False) if new_data else None
-    changed_fields_json = json.dumps(changed_fields, ensure_ascii=False) if changed_fields else None
+    Args:
+        code: 病院コード
+        action: アクション ('create', 'update', 'delete')
+        old_data: 変更前のデータ（辞書）
+        new_data: 変更後のデータ（辞書）
+        user_id: ユーザーID
+        username: ユーザー名
+        wait: True の場合は書き込み完了まで待つ（None は AUDIT_DURABILITY に従う）
+    """
+    row, changed_fields = history_row(code, action, old_data, new_data, user_id, username)
+    enqueue_history(row, changed_fields, wait=wait)
+
+def enqueue_history(row, changed_fields, wait=None):
+    """history_row() で作成した履歴を書き込みスレッドに渡す"""
+    # 履歴を記録（書き込みスレッドがまとめてコミット）
+    audit_log.add('history', row, wait=wait)
+
+    code, action, username = row[0], row[1], row[6]
+    print(f"📝 履歴記録: code={code}, action={action}, user={username}, fields={len(changed_fields)}")
+
+def history_row(code, action, old_data, new_data, user_id, username):
+    """
+    history テーブルの1行（audit_writer.STATEMENTS['history'] の列順）
     
-    # 履歴を記録
-    conn.execute('''
-        INSERT INTO history (code, action, old_data, new_data, changed_fields, user_id, username)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    ''', (code, action, old_data_json, new_data_json, changed_fields_json, user_id, username))
+    Returns:
+        (行, 変更されたフィールド名のリスト)
+    """
+    # 変更されたフィールドを検出
+    changed_fields = diff_fields(old_data, new_data)
     
-    conn.commit()
-    conn.close()
+    # JSON形式で保存
+    codec = get_storage_codec()
+    old_data_json = codec.dumps(old_data) if old_data else None
+    new_data_json = codec.dumps(new_data) if new_data else None
+    changed_fields_json = json_engine.dumps(changed_fields) if changed_fields else None
     
-    print(f"📝 履歴記録: code={code}, action={action}, user={username}, fields={len(changed_fields)}")
+    return (code, action, old_data_json, new_data_json, changed_fields_json, user_id, username), changed_fields
 
-def record_login_history(user_id, username, success=True, ip_address=None, user_agent=None):
+def record_login_history(user_id, username, success=True, ip_address=None, user_agent=None, wait=None):
     """
     ログイン履歴を記録
     
@@ -171,19 +178,81 @@ def record_login_history(user_id, username, success=True, ip_address=None, user_
         success: ログイン成功/失敗
         ip_address: IPアドレス
         user_agent: ブラウザ情報
+        wait: True の場合は書き込み完了まで待つ（None は AUDIT_DURABILITY に従う）
     """
-    conn = get_db_connection()
-    
-    conn.execute('''
-        INSERT INTO login_history (user_id, username, ip_address, user_agent, success)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (user_id, username, ip_address, user_agent, success))
-    
-    conn.commit()
-    conn.close()
+    # 書き込みスレッドがまとめてコミット
+    audit_log.add('login_history', (user_id, username, ip_address, user_agent, success), wait=wait)
     
     status = '成功' if success else '失敗'
-    print(f"📝 ログイン履歴記録: username={username}, status={status}, ip={ip_address}")
+    print(f"📝 ログイン履歴記録（書き込み待ち）: username={username}, status={status}, ip={ip_address}")
+
+# ============================================
+# 流量制限・過負荷時の受付制限
+# ============================================
+
+# エンドポイント（bp の関数名）ごとのルートの種類（ここにないものは GET: read、それ以外: write）
+ROUTE_CLASSES = {
+    'api_mdata_search': 'search',
+    'api_hospitals': 'search',
+    'api_mdata_similar': 'search',
+    'api_geo_nearest': 'search',
+    'api_stats': 'search',
+    'api_history': 'search',
+    'api_login_history': 'search',
+    'api_login_history_summary': 'search',
+    'api_mdata_bulk': 'bulk',
+    'api_mdata_replace_preview': 'bulk',
+    'api_mdata_replace_apply': 'bulk',
+    'api_dedup_candidates': 'bulk',
+    'api_validation_report': 'bulk',
+    'api_changes_snapshot': 'bulk',
+    'api_lock': 'lock',
+    'api_lock_heartbeat': 'heartbeat',
+}
+# 流量制限の対象外（監視用）
+RATE_LIMIT_EXEMPT = {'api_health', 'api_health_ready', 'api_ratelimit_status'}
+
+def rate_limit_client():
+    """バケットのキー（ログイン中はユーザーID、未ログインはIPアドレス）"""
+    user_id = session.get('user_id')
+    if user_id is not None:
+        return f'user:{user_id}'
+    # プロキシ経由の場合は ProxyFix（TRUSTED_PROXY_COUNT）で変換済みのアドレス
+    return 'ip:' + (request.remote_addr or '')
+
+def too_many_requests(seconds, error, **extra):
+    response = jsonify({'ok': False, 'error': error, 'retry_after': seconds, **extra})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(seconds)
+    return response
+
+@bp.before_app_request
+def limit_api_requests():
+    """APIリクエストの流量制限と過負荷時の受付制限（ログインは login_throttle で制限）"""
+    endpoint = (request.endpoint or '').rpartition('.')[2]
+    if not request.path.startswith('/api/') or endpoint in RATE_LIMIT_EXEMPT:
+        return None
+    admission.start()
+    route_class = ROUTE_CLASSES.get(endpoint) or ('read' if request.method == 'GET' else 'write')
+
+    seconds = rate_limiter.check(route_class, rate_limit_client())
+    if seconds:
+        print(f"🚦 流量制限: {rate_limit_client()}, class={route_class}, path={request.path}, retry_after={seconds}s")
+        return too_many_requests(seconds, 'Too many requests', route_class=route_class)
+
+    reason = admission.enter(route_class)
+    if reason:
+        seconds = admission.retry_after()
+        print(f"🚦 過負荷のため受付停止: reason={reason}, class={route_class}, path={request.path}")
+        return too_many_requests(seconds, 'Server busy', reason=reason)
+    g.admitted = True
+    return None
+
+@bp.teardown_app_request
+def release_admission(error=None):
+    # ストリーミング応答は送信の完了後に呼ばれる
+    if g.pop('admitted', False):
+        admission.leave()
 
 # ============================================
 # 認証チェック用デコレータ
@@ -203,36 +272,36 @@ def login_required(f):
 # ルート定義
 # ============================================
 
-@app.route('/')
+@bp.route('/')
 def index():
     """メインページ"""
     if 'user_id' not in session:
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
     print(f"📄 メインページ表示: user={session.get('username')}, role={session.get('role')}")
-    return send_from_directory('.', 'index.html')
+    return assets.index_response() or send_from_directory('.', 'index.html')
 
-# 静的ファイルの提供
-@app.route('/css/<path:filename>')
+# 静的ファイルの提供（ハッシュ付きURLは長期キャッシュ）
+@bp.route('/css/<path:filename>')
 def serve_css(filename):
-    return send_from_directory('css', filename)
+    return assets.response('css', filename) or send_from_directory('css', filename)
 
-@app.route('/js/<path:filename>')
+@bp.route('/js/<path:filename>')
 def serve_js(filename):
-    return send_from_directory('js', filename)
+    return assets.response('js', filename) or send_from_directory('js', filename)
 
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/login', methods=['GET', 'POST'])
 def login():
     # 既にログイン済みの場合はメインページへ
     if 'user_id' in session:
         print(f"✅ 既にログイン済み: user_id={session.get('user_id')}")
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     
     if request.method == 'POST':
         username = request.form.get('username')
         password = request.form.get('password')
         
-        # 🆕 IPアドレスとUser-Agentを取得
-        ip_address = request.headers.get('X-Forwarded-For', request.remote_addr)
+        # 🆕 IPアドレスとUser-Agentを取得（プロキシ経由の場合は ProxyFix で変換済み）
+        ip_address = request.remote_addr
         user_agent = request.headers.get('User-Agent', '')
         
         print(f"🔍 ログイン試行: username={username}, ip={ip_address}")
@@ -241,6 +310,13 @@ def login():
             flash('ユーザー名とパスワードを入力してください。')
             return render_template('login.html')
         
+        # 🆕 失敗が続いている場合はDB検索・パスワード検証を行わずに拒否
+        retry_after = login_throttle.check(ip_address, username)
+        if retry_after:
+            print(f"⛔ ログイン試行を制限: username={username}, ip={ip_address}, retry_after={retry_after}s")
+            flash(f'ログイン試行回数が上限を超えました。{(retry_after + 59) // 60}分後に再度お試しください。')
+            return render_template('login.html'), 429, {'Retry-After': str(retry_after)}
+        
         conn = get_db_connection()
         user = conn.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
         conn.close()
@@ -248,8 +324,15 @@ def login():
         if user:
             print(f"🔍 ユーザー発見: id={user['id']}, username={user['username']}, role={user['role']}")
             
-            if check_password_hash(user['password'], password):
+            verified = password_verifier.verify(user['password'], password)
+            if verified is None:
+                print(f"⚠️ パスワード検証が混雑しています: username={username}")
+                flash('ただいま混み合っています。しばらくしてから再度お試しください。')
+                return render_template('login.html'), 503, {'Retry-After': '5'}
+            
+            if verified:
                 print(f"✅ パスワード検証成功")
+                login_throttle.success(ip_address, username)
                 
                 # セッションをクリアして新規設定
                 session.clear()
@@ -270,21 +353,23 @@ def login():
                 record_login_history(user['id'], user['username'], True, ip_address, user_agent)
                 
                 flash('ログインに成功しました。', 'success')
-                return redirect(url_for('index'))
+                return redirect(url_for('main.index'))
             else:
                 print(f"❌ パスワード検証失敗")
+                login_throttle.failure(ip_address, username)
                 # 🆕 ログイン失敗を記録
                 record_login_history(user['id'], username, False, ip_address, user_agent)
                 flash('ユーザー名またはパスワードが正しくありません。')
         else:
             print(f"❌ ユーザーが見つかりません: username={username}")
+            login_throttle.failure(ip_address, username)
             # 🆕 ログイン失敗を記録（user_idはNone）
             record_login_history(None, username, False, ip_address, user_agent)
             flash('ユーザー名またはパスワードが正しくありません。')
     
     return render_template('login.html')
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     username = session.get('username', 'Unknown')
     user_id = session.get('user_id')
@@ -300,31 +385,31 @@ def logout():
     session.clear()
     print(f"👋 ログアウト: user={username}")
     flash('ログアウトしました。')
-    return redirect(url_for('login'))
+    return redirect(url_for('main.login'))
 
 # ============================================
 # ユーザー管理・パスワード変更・履歴ページ
 # ============================================
 
-@app.route('/user_management')
+@bp.route('/user_management')
 def user_management():
     """ユーザー管理ページ"""
     if 'user_id' not in session:
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
     
     # 管理者のみアクセス可能
     if session.get('role') != 'admin':
         flash('管理者のみアクセスできます。')
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     
     print(f"👥 ユーザー管理ページ表示: user={session.get('username')}")
     return render_template('user_management.html')
 
-@app.route('/change_password', methods=['GET', 'POST'])
+@bp.route('/change_password', methods=['GET', 'POST'])
 def change_password():
     """パスワード変更ページ（ログイン後）"""
     if 'user_id' not in session:
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
     
     if request.method == 'POST':
         current_password = request.form.get('current_password')
@@ -361,25 +446,25 @@ def change_password():
         
         print(f"✅ パスワード変更成功: user_id={session['user_id']}")
         flash('パスワードを変更しました。', 'success')
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     
     print(f"🔑 パスワード変更ページ表示: user={session.get('username')}")
     return render_template('change_password.html')
 
-@app.route('/history')
+@bp.route('/history')
 def history():
     """変更履歴ページ"""
     if 'user_id' not in session:
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
     
     print(f"📜 変更履歴ページ表示: user={session.get('username')}")
     return render_template('history.html')
 
-@app.route('/login_history')
+@bp.route('/login_history')
 def login_history():
     """🆕 ログイン履歴ページ"""
     if 'user_id' not in session:
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
     
     print(f"📊 ログイン履歴ページ表示: user={session.get('username')}")
     return render_template('login_history.html')
@@ -388,7 +473,7 @@ def login_history():
 # パスワードリセット（メール経由）
 # ============================================
 
-@app.route('/reset-password-request', methods=['GET', 'POST'])
+@bp.route('/reset-password-request', methods=['GET', 'POST'])
 def reset_password_request():
     if request.method == 'POST':
         email = request.form.get('email')
@@ -417,7 +502,7 @@ def reset_password_request():
             conn.close()
             
             # リセットURLを生成
-            reset_url = url_for('reset_password', token=token, _external=True)
+            reset_url = url_for('main.reset_password', token=token, _external=True)
             
             print(f"🔑 パスワードリセットトークン生成: user={user['username']}, token={token[:10]}...")
             
@@ -430,7 +515,7 @@ def reset_password_request():
     
     return render_template('reset_password_request.html')
 
-@app.route('/reset-password/<token>', methods=['GET', 'POST'])
+@bp.route('/reset-password/<token>', methods=['GET', 'POST'])
 def reset_password(token):
     # トークンを検証
     conn = get_db_connection()
@@ -483,7 +568,7 @@ def reset_password(token):
         print(f"✅ パスワードリセット成功: user={user['username']}")
         
         flash('パスワードが正常に変更されました。新しいパスワードでログインしてください。', 'success')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
     
     conn.close()
     return render_template('reset_password.html', token=token)
@@ -492,12 +577,54 @@ def reset_password(token):
 # API エンドポイント
 # ============================================
 
-@app.route('/api/health', methods=['GET'])
+@bp.route('/api/health', methods=['GET'])
+@bp.route('/api/health/live', methods=['GET'])
 def api_health():
-    """ヘルスチェック"""
-    return jsonify({'ok': True, 'status': 'healthy', 'timestamp': datetime.now().isoformat()})
+    """
+    ヘルスチェック（liveness: プロセスが応答しているか）
+
+    DBなどには触れません。振り分けの判断には /api/health/ready を使います。
+    """
+    return jsonify({'ok': True, 'status': 'healthy', 'pid': os.getpid(), 'timestamp': datetime.now().isoformat()})
+
+@bp.route('/api/health/ready', methods=['GET'])
+def api_health_ready():
+    """
+    リクエストを受け付けられる状態か（readiness）
+
+    DBの応答時間・スキーマのバージョン・WAL・監査ログの書き込み待ち・Socket.IO・ディスクの空き容量を確認し、
+    いずれかが上限を超えている場合は 503（結果は HEALTH_CACHE_SECONDS 秒間再利用）。
+    """
+    result = readiness.status()
+    if not result['ready']:
+        print(f"🩺 準備未完了: {', '.join(result['failed'])}")
+    return jsonify({
+        'ok': result['ready'],
+        'status': 'ready' if result['ready'] else 'unavailable',
+        'pid': os.getpid(),
+        'timestamp': datetime.now().isoformat(),
+        **result
+    }), 200 if result['ready'] else 503
 
-@app.route('/api/session', methods=['GET'])
+@bp.route('/api/replica/status', methods=['GET'])
+@login_required
+def api_replica_status():
+    """リードレプリカの状態（遅延など）"""
+    return jsonify({'ok': True, 'replica': replica.status()})
+
+@bp.route('/api/ratelimit/status', methods=['GET'])
+@login_required
+def api_ratelimit_status():
+    """流量制限・受付制限・ログイン失敗の記録の状態（このプロセスの集計）"""
+    return jsonify({
+        'ok': True,
+        'pid': os.getpid(),
+        'rate_limit': rate_limiter.stats(),
+        'admission': admission.stats(),
+        'login': login_throttle.stats()
+    })
+
+@bp.route('/api/session', methods=['GET'])
 def api_session():
     """セッション情報を返す"""
     if 'user_id' not in session:
@@ -518,7 +645,7 @@ def api_session():
         'permanent': session.permanent
     })
 
-@app.route('/api/lock/status', methods=['GET'])
+@bp.route('/api/lock/status', methods=['GET'])
 @login_required
 def api_lock_status():
     """すべてのロック状態を取得"""
@@ -531,7 +658,36 @@ def api_lock_status():
         'locks': [dict(lock) for lock in locks]
     })
 
-@app.route('/api/lock/<code>', methods=['POST', 'DELETE'])
+@bp.route('/api/lock/heartbeat', methods=['POST'])
+@login_required
+def api_lock_heartbeat():
+    """
+    ハートビート（編集中のロックがまだ自分のものか確認、ロックは変更しない）
+
+    Request JSON:
+        code: 編集中の病院コード
+
+    ロックが解除されている（管理者による削除など）場合は 409。
+    """
+    data = request.get_json(silent=True) or {}
+    code = data.get('code')
+    if not code:
+        return jsonify({'ok': False, 'error': 'code required'}), 400
+
+    conn = get_db_connection()
+    lock = conn.execute('SELECT user_id, username FROM locks WHERE code = ?', (code,)).fetchone()
+    conn.close()
+
+    if not lock or lock['user_id'] != session.get('user_id'):
+        print(f"💔 ハートビート: ロックなし code={code}, user={session.get('username')}")
+        return jsonify({
+            'ok': False,
+            'error': 'Lock lost',
+            'locked_by': lock['username'] if lock else None
+        }), 409
+    return jsonify({'ok': True, 'code': code})
+
+@bp.route('/api/lock/<code>', methods=['POST', 'DELETE'])
 @login_required
 def api_lock(code):
     """ロックの取得/解放"""
@@ -575,25 +731,14 @@ def api_lock(code):
         print(f"🔓 ロック解放: code={code}, user={username}")
         return jsonify({'ok': True, 'message': 'Lock released'})
 
-@app.route('/api/mdata/search', methods=['GET'])
+@bp.route('/api/mdata/search', methods=['GET'])
 @login_required
 def api_mdata_search():
     """病院データ検索"""
     prefix = request.args.get('prefix', '')
     
-    conn = get_db_connection()
-    
-    if prefix:
-        # 前方一致検索
-        query = 'SELECT code FROM mdata WHERE code LIKE ? ORDER BY code'
-        results = conn.execute(query, (f'{prefix}%',)).fetchall()
-    else:
-        # すべて取得
-        results = conn.execute('SELECT code FROM mdata ORDER BY code').fetchall()
-    
-    conn.close()
-    
-    items = [{'code': row['code']} for row in results]
+    # 前方一致検索（prefix がなければすべて）
+    items = [{'code': code} for code in hospitals.search(prefix)]
     
     return jsonify({
         'ok': True,
@@ -601,15 +746,111 @@ def api_mdata_search():
         'count': len(items)
     })
 
-@app.route('/api/mdata/<code>', methods=['GET', 'POST'])
+# 画面の表の列（js/config.js の TABLE_KEYS と同じ順）
+TABLE_KEYS = {
+    'main': ('印', '卒業', 'Dr./出身大学', '診療科', 'PHS', '直PHS', '①', '②', '備考'),
+    'facilities': ('関連病院施設等', '関連病院TEL', '関連病院備考'),
+    'vendors': ('部署', '業者', '内線', 'TEL・メモ'),
+}
+# 画面上部の病院の情報（js/table.js の setMeta）
+META_FIELDS = ('コード', '都道府県', '病院名', '郵便番号', '住所', '最寄駅', 'TEL', 'DI', 'ファミレス')
+MDATA_SHAPES = ('flat', 'tables')
+
+def parse_mdata_fields(value):
+    """
+    fields パラメータ（カンマ区切り）を (フィールド名, 表の名前) に分ける
+
+    'meta' は META_FIELDS、'main' / 'facilities' / 'vendors' は表の列、
+    それ以外はフィールド名（PHS_3 など）。省略時はすべての表と META_FIELDS。
+    """
+    names = [name.strip() for name in (value or '').split(',') if name.strip()]
+    if not names:
+        return list(META_FIELDS), list(TABLE_KEYS)
+    fields, tables = [], []
+    for name in names:
+        if name == 'meta':
+            fields.extend(META_FIELDS)
+        elif name in TABLE_KEYS:
+            tables.append(name)
+        else:
+            fields.append(name)
+    return list(dict.fromkeys(fields)), list(dict.fromkeys(tables))
+
+def pivot_table(items, keys):
+    """
+    連番の列を行の配列に（末尾の空の行は除く）
+
+    Returns:
+        [[keys の順の値, ...], ...]（値がないセルは ''）
+    """
+    columns = {f'{key}_': i for i, key in enumerate(keys)}
+    cells = {}
+    last = 0
+    for key, value in items.items():
+        column = columns.get(storage_codec.series_base(key))
+        if column is None or not key[-1:].isdigit():
+            continue
+        n = int(key[len(keys[column]) + 1:])
+        if n < 1:
+            continue
+        cells[(n, column)] = value
+        if n > last and (value.strip() if isinstance(value, str) else value):
+            last = n
+    return [[cells.get((n, column), '') for column in range(len(keys))] for n in range(1, last + 1)]
+
+def read_mdata_projection(conn, code, fields, tables, shape):
+    """
+    病院データのうち fields と tables の列だけを読み込む（storage_codec.select_items）
+
+    Returns:
+        データがない場合は None
+        shape='flat':   {'kv': {フィールド: 値}}
+        shape='tables': {'kv': {fields の値}, 'tables': {表: [[行の値, ...], ...]}, 'columns': {表: [列, ...]}}
+    """
+    series = [key for table in tables for key in TABLE_KEYS[table]]
+    for _, items in storage_codec.select_items(conn, get_storage_codec(), fields, series,
+                                               'WHERE code = ?', (code,)):
+        if shape == 'flat':
+            return {'kv': items}
+        return {
+            'kv': {field: items[field] for field in fields if field in items},
+            'tables': {table: pivot_table(items, TABLE_KEYS[table]) for table in tables},
+            'columns': {table: list(TABLE_KEYS[table]) for table in tables},
+        }
+    return None
+
+@bp.route('/api/mdata/<code>', methods=['GET', 'POST'])
 @login_required
 def api_mdata(code):
-    """病院データの取得/保存（履歴記録付き）"""
-    conn = get_db_connection()
+    """
+    病院データの取得/保存（履歴記録付き）
+
+    GET Query（省略時は kv 全体）:
+        fields: 取得するフィールド（カンマ区切り、meta / main / facilities / vendors / フィールド名）
+        shape: flat（kv のみ）/ tables（表の列は行の配列 tables に変換し、末尾の空の行は除く）
+    """
+    # 取得は参照用の接続（READ_REPLICA=1 の場合はメモリ上のコピー）
+    conn = get_read_connection() if request.method == 'GET' else get_db_connection()
     user_id = session.get('user_id')
     username = session.get('username')
     
     if request.method == 'GET':
+        if 'fields' in request.args or 'shape' in request.args:
+            # 一部のフィールドだけ取得（shape=tables は表の行の配列に変換）
+            shape = request.args.get('shape') or 'flat'
+            if shape not in MDATA_SHAPES:
+                conn.close()
+                return jsonify({'ok': False, 'error': f'shape must be one of {MDATA_SHAPES}'}), 400
+            fields, tables = parse_mdata_fields(request.args.get('fields'))
+            try:
+                row = conn.execute('SELECT code, updated_at FROM mdata WHERE code = ?', (code,)).fetchone()
+                projection = row and read_mdata_projection(conn, code, fields, tables, shape)
+            finally:
+                conn.close()
+            if not projection:
+                return jsonify({'ok': False, 'error': 'Not found'}), 404
+            return jsonify({'ok': True, 'code': row['code'], 'updated_at': row['updated_at'], **projection})
+
         # データ取得
         row = conn.execute('SELECT * FROM mdata WHERE code = ?', (code,)).fetchone()
         conn.close()
@@ -618,7 +859,7 @@ def api_mdata(code):
             return jsonify({'ok': False, 'error': 'Not found'}), 404
         
         try:
-            kv = json.loads(row['kv'])
+            kv = get_storage_codec().loads(row['kv'])
         except:
             kv = {}
         
@@ -638,39 +879,64 @@ def api_mdata(code):
             conn.close()
             return jsonify({'ok': False, 'error': 'No data provided'}), 400
         
-        kv_json = json.dumps(kv, ensure_ascii=False)
-        
-        # 🆕 既存データを取得（履歴記録用）
-        existing = conn.execute('SELECT * FROM mdata WHERE code = ?', (code,)).fetchone()
+        codec = get_storage_codec()
+        kv_json = codec.dumps(kv)
         
-        old_data = None
-        action = 'create'
-        
-        if existing:
-            # 更新の場合
-            action = 'update'
+        # 書き込みロックを取ってから既存データを読む（同時の保存が同じ変更前のデータから
+        # 集計・座標の差分を計算しないように）
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # 🆕 既存データを取得（履歴記録用）
+            existing = conn.execute('SELECT * FROM mdata WHERE code = ?', (code,)).fetchone()
+
+            old_data = None
+            action = 'create'
+
+            if existing:
+                # 更新の場合
+                action = 'update'
+                try:
+                    old_data = codec.loads(existing['kv'])
+                except:
+                    old_data = {}
+
+            # 入力チェック（更新は変更されたフィールドのみ、error は保存しない）
             try:
-                old_data = json.loads(existing['kv'])
-            except:
-                old_data = {}
-            
-            conn.execute('''
-                UPDATE mdata 
-                SET kv = ?, updated_at = CURRENT_TIMESTAMP, updated_by = ?
-                WHERE code = ?
-            ''', (kv_json, user_id, code))
-        else:
-            # 新規作成の場合
-            conn.execute('''
-                INSERT INTO mdata (code, kv, updated_by) 
-                VALUES (?, ?, ?)
-            ''', (code, kv_json, user_id))
-        
-        conn.commit()
-        conn.close()
-        
+                warnings = validator.check(kv, diff_fields(old_data, kv) if old_data else None)
+            except validation.ValidationError as e:
+                conn.rollback()
+                print(f"⚠️ 入力チェックエラー: code={code}, user_id={user_id}, 違反={len(e.violations)}件")
+                return jsonify({'ok': False, 'error': 'Validation failed', 'violations': e.violations}), 400
+
+            if existing:
+                conn.execute('''
+                    UPDATE mdata 
+                    SET kv = ?, updated_at = CURRENT_TIMESTAMP, updated_by = ?
+                    WHERE code = ?
+                ''', (kv_json, user_id, code))
+            else:
+                # 新規作成の場合
+                conn.execute('''
+                    INSERT INTO mdata (code, kv, updated_by) 
+                    VALUES (?, ?, ?)
+                ''', (code, kv_json, user_id))
+
+            # 履歴用の差分から集計・病院の座標を更新（保存と同じトランザクション）
+            history, changed_fields = history_row(code, action, old_data, kv, user_id, username)
+            aggregate_stats.apply_change(conn, code, old_data, kv, changed_fields)
+            geo.apply_change(conn, code, old_data, kv, changed_fields)
+
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+        replica.mark_stale()
+
         # 🆕 履歴を記録
-        record_history(code, action, old_data, kv, user_id, username)
+        enqueue_history(history, changed_fields)
         
         print(f"💾 データ保存: code={code}, user_id={user_id}, action={action}")
         
@@ -678,20 +944,611 @@ def api_mdata(code):
             'ok': True,
             'message': 'Data saved',
             'updated': len(kv),
-            'action': action
+            'action': action,
+            'warnings': warnings
         })
 
+# 一括更新で1回に受け付ける最大件数
+BULK_UPDATE_LIMIT = int(os.environ.get('BULK_UPDATE_LIMIT', 5000))
+
+def apply_mdata_patches(conn, patches, user_id, username, atomic=False):
+    """
+    複数の病院データにフィールド単位の変更をまとめて適用（1トランザクション）
+
+    データの更新と履歴の追加は同じトランザクションでコミットします。
+    他のユーザーがロック中のデータ、version（updated_at）が一致しないデータは更新しません。
+
+    Args:
+        conn: トランザクションを開始していない接続
+        patches: [{'code': 病院コード, 'set': {フィールド: 値（None は削除）}, 'version': 省略可}]
+        atomic: True の場合、1件でも更新できなければすべて取り消す
+
+    Returns:
+        (適用したか, [{'code', 'status', ...}])
+        status: updated / unchanged / not_found / locked / conflict / duplicate / invalid（入力チェックの error）
+    """
+    codec = get_storage_codec()
+    codes = [patch['code'] for patch in patches]
+
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        rows = {}
+        for i in range(0, len(codes), 500):
+            chunk = codes[i:i + 500]
+            placeholders = ','.join('?' * len(chunk))
+            for row in conn.execute(f'SELECT code, kv, updated_at FROM mdata WHERE code IN ({placeholders})', chunk):
+                rows[row['code']] = row
+        locks = {row['code']: row for row in conn.execute(
+            'SELECT code, user_id, username FROM locks WHERE user_id != ?', (user_id,))}
+
+        results, updates, history_rows, seen = [], [], [], set()
+        for patch in patches:
+            code = patch['code']
+            row = rows.get(code)
+            if code in seen:
+                results.append({'code': code, 'status': 'duplicate'})
+                continue
+            seen.add(code)
+
+            if row is None:
+                results.append({'code': code, 'status': 'not_found'})
+            elif code in locks:
+                results.append({'code': code, 'status': 'locked', 'locked_by': locks[code]['username']})
+            elif patch.get('version') is not None and patch['version'] != row['updated_at']:
+                results.append({'code': code, 'status': 'conflict', 'version': row['updated_at']})
+            else:
+                try:
+                    old_data = codec.loads(row['kv'])
+                except:
+                    old_data = {}
+                new_data = dict(old_data)
+                for key, value in patch['set'].items():
+                    if value is None:
+                        new_data.pop(key, None)
+                    else:
+                        new_data[key] = value
+
+                if new_data == old_data:
+                    results.append({'code': code, 'status': 'unchanged'})
+                    continue
+                try:
+                    warnings = validator.check(new_data, diff_fields(old_data, new_data) if old_data else None)
+                except validation.ValidationError as e:
+                    results.append({'code': code, 'status': 'invalid', 'violations': e.violations})
+                    continue
+                hist, changed_fields = history_row(code, 'update', old_data, new_data, user_id, username)
+                aggregate_stats.apply_change(conn, code, old_data, new_data, changed_fields)
+                geo.apply_change(conn, code, old_data, new_data, changed_fields)
+                updates.append((codec.dumps(new_data), user_id, code))
+                history_rows.append(hist)
+                result = {'code': code, 'status': 'updated', 'changed_fields': changed_fields}
+                if warnings:
+                    result['warnings'] = warnings
+                results.append(result)
+
+        if atomic and any(r['status'] not in ('updated', 'unchanged') for r in results):
+            conn.rollback()
+            return False, results
+
+        conn.executemany('''
+            UPDATE mdata
+            SET kv = ?, updated_at = CURRENT_TIMESTAMP, updated_by = ?
+            WHERE code = ?
+        ''', updates)
+        conn.executemany(audit_writer.STATEMENTS['history'], history_rows)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    if updates:
+        replica.mark_stale()
+    return True, results
+
+@bp.route('/api/mdata/bulk', methods=['POST'])
+@login_required
+def api_mdata_bulk():
+    """
+    病院データの一括更新（履歴記録付き）
+
+    Request JSON:
+        updates: [{'code': 病院コード, 'set': {フィールド: 値（null は削除）}, 'version': 省略可}]
+        atomic: true の場合、1件でも更新できなければすべて取り消す（既定: false）
+    """
+    data = request.get_json(silent=True) or {}
+    patches = data.get('updates')
+    atomic = bool(data.get('atomic', False))
+
+    if not isinstance(patches, list) or not patches:
+        return jsonify({'ok': False, 'error': 'updates required'}), 400
+    if len(patches) > BULK_UPDATE_LIMIT:
+        return jsonify({'ok': False, 'error': f'Too many updates (max {BULK_UPDATE_LIMIT})'}), 400
+    for i, patch in enumerate(patches):
+        if (not isinstance(patch, dict) or not isinstance(patch.get('code'), str)
+                or not isinstance(patch.get('set'), dict) or not patch['set']):
+            return jsonify({'ok': False, 'error': f'Invalid update at index {i}'}), 400
+
+    user_id = session.get('user_id')
+    username = session.get('username')
+
+    conn = get_db_connection()
+    try:
+        applied, results = apply_mdata_patches(conn, patches, user_id, username, atomic)
+    finally:
+        conn.close()
+
+    summary = {}
+    for r in results:
+        summary[r['status']] = summary.get(r['status'], 0) + 1
+
+    print(f"💾 一括更新: user={username}, 件数={len(patches)}, 結果={summary}, 適用={applied}")
+
+    return jsonify({
+        'ok': applied,
+        'applied': applied,
+        'summary': summary,
+        'results': results
+    }), 200 if applied else 409
+
+def replace_rule_from_request(data):
+    """リクエストJSONから置換ルールを作成（正しくない場合は ValueError）"""
+    return find_replace.Rule(
+        data.get('find'),
+        data.get('replace', ''),
+        data.get('mode', 'contains'),
+        data.get('fields'),
+        data.get('ignore_case', False)
+    )
+
+@bp.route('/api/mdata/replace/preview', methods=['POST'])
+@login_required
+def api_mdata_replace_preview():
+    """
+    一括置換のプレビュー（DBは変更しない）
+
+    Request JSON:
+        find, replace, mode（contains / exact / regex）, fields（例: ["Dr./出身大学_*"]）, ignore_case
+
+    Response (application/x-ndjson, 1行ずつ):
+        {"type": "hospital", "code", "name", "version", "count", "matches": [{"field", "before", "after", "count"}]}
+        ...
+        {"type": "summary", "candidates", "hospitals", "cells", "count", "elapsed_ms"}
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        rule = replace_rule_from_request(data)
+    except ValueError as e:
+        return jsonify({'ok': False, 'error': str(e)}), 400
+
+    def generate():
+        started = time.perf_counter()
+        stats = {}
+        hospitals = cells = count = 0
+        conn = get_db_connection()
+        try:
+            for result in find_replace.scan(conn, get_storage_codec(), rule, stats=stats):
+                hospitals += 1
+                cells += len(result['matches'])
+                count += result['count']
+                yield json_engine.dumps(dict(result, type='hospital')) + '\n'
+        finally:
+            conn.close()
+        yield json_engine.dumps({
+            'type': 'summary',
+            'candidates': stats.get('candidates', 0),
+            'hospitals': hospitals,
+            'cells': cells,
+            'count': count,
+            'elapsed_ms': round((time.perf_counter() - started) * 1000, 1)
+        }) + '\n'
+
+    print(f"🔍 一括置換プレビュー: find={rule.find}, mode={rule.mode}, fields={rule.fields}")
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@bp.route('/api/mdata/replace/apply', methods=['POST'])
+@login_required
+def api_mdata_replace_apply():
+    """
+    一括置換の実行（1トランザクション、履歴記録付き）
+
+    Request JSON:
+        プレビューと同じ条件 + codes（プレビューで選んだ病院コード、省略時はすべて）, atomic
+        versions: {病院コード: プレビューの version}（省略時は codes に versions のコードを使う）
+
+    versions を指定した場合、プレビューの後に他のユーザーが変更した病院は conflict になります
+    （プレビューの後に置換の対象でなくなった病院も同様）。省略した場合は実行時の内容を置換します。
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        rule = replace_rule_from_request(data)
+    except ValueError as e:
+        return jsonify({'ok': False, 'error': str(e)}), 400
+    codes = data.get('codes')
+    versions = data.get('versions')
+    if codes is not None and not isinstance(codes, list):
+        return jsonify({'ok': False, 'error': 'codes must be a list'}), 400
+    if versions is not None and not isinstance(versions, dict):
+        return jsonify({'ok': False, 'error': 'versions must be an object'}), 400
+    if versions is not None and codes is None:
+        codes = list(versions)
+
+    user_id = session.get('user_id')
+    username = session.get('username')
+
+    conn = get_db_connection()
+    try:
+        results = list(find_replace.scan(conn, get_storage_codec(), rule, codes=codes))
+        if len(results) > BULK_UPDATE_LIMIT:
+            return jsonify({'ok': False, 'error': f'Too many hospitals (max {BULK_UPDATE_LIMIT})'}), 400
+        patches = find_replace.patches(results)
+        if versions is not None:
+            # プレビューの version と一致しなければ apply_mdata_patches で conflict
+            for patch in patches:
+                patch['version'] = versions.get(patch['code'])
+            matched = {patch['code'] for patch in patches}
+            patches.extend({'code': code, 'set': {}, 'version': version}
+                           for code, version in versions.items() if code not in matched)
+        if not patches:
+            return jsonify({'ok': True, 'applied': True, 'summary': {}, 'results': [], 'cells': 0})
+        applied, patch_results = apply_mdata_patches(
+            conn, patches, user_id, username, bool(data.get('atomic', False)))
+    finally:
+        conn.close()
+
+    summary = {}
+    for r in patch_results:
+        summary[r['status']] = summary.get(r['status'], 0) + 1
+    cells = sum(len(r['matches']) for r in results)
+
+    print(f"💾 一括置換: find={rule.find}, user={username}, 病院={len(results)}, セル={cells}, 結果={summary}")
+
+    return jsonify({
+        'ok': applied,
+        'applied': applied,
+        'summary': summary,
+        'cells': cells,
+        'results': patch_results
+    }), 200 if applied else 409
+
+@bp.route('/api/mdata/<code>/similar', methods=['GET'])
+@login_required
+def api_mdata_similar(code):
+    """
+    似ている病院（出身大学・診療科・関連病院施設等・部署の共通度）
+
+    Query:
+        k: 件数（既定 10、最大 SIMILAR_MAX_RESULTS）
+
+    Response:
+        results: [{'code', 'name', 'score', 'shared': {'university': [...], 'facility': [...]}}]
+    """
+    k = min(request.args.get('k', 10, type=int), SIMILAR_MAX_RESULTS)
+    if k <= 0:
+        return jsonify({'ok': False, 'error': 'k must be positive'}), 400
+
+    started = time.perf_counter()
+    results = similar_hospitals.similar(code, k)
+    if results is None:
+        return jsonify({'ok': False, 'error': 'Not found'}), 404
+    elapsed_ms = round((time.perf_counter() - started) * 1000, 2)
+
+    hospitals.refresh_if_changed()
+    names = hospitals.names
+    for r in results:
+        r['name'] = names.get(r['code'], '')
+
+    print(f"🔗 類似病院検索: code={code}, k={k}, count={len(results)}, {elapsed_ms}ms")
+
+    return jsonify({
+        'ok': True,
+        'code': code,
+        'engine': similar_hospitals.engine,
+        'results': results,
+        'count': len(results),
+        'elapsed_ms': elapsed_ms
+    })
+
+@bp.route('/api/dedup/candidates', methods=['GET'])
+@login_required
+def api_dedup_candidates():
+    """
+    重複した病院データの候補（点数の高い順）
+
+    全病院の比較は mdata_version が変わったときだけ行い、結果を再利用します。
+
+    Query:
+        min_score: 点数の下限（既定 DEDUP_THRESHOLD）
+        limit: 件数（既定 100、最大 DEDUP_MAX_RESULTS）
+
+    Response:
+        candidates: [{'codes': [a, b], 'score', 'scores': {項目: 一致度}, 'records': [...]}]
+    """
+    min_score = request.args.get('min_score', dedup.DEDUP_THRESHOLD, type=float)
+    limit = min(request.args.get('limit', 100, type=int), DEDUP_MAX_RESULTS)
+    if not 0 < min_score <= 1:
+        return jsonify({'ok': False, 'error': 'min_score must be between 0 and 1'}), 400
+    if limit <= 0:
+        return jsonify({'ok': False, 'error': 'limit must be positive'}), 400
+
+    results, stats = dedup_report.get(min_score)
+
+    print(f"🔍 重複候補: min_score={min_score}, 候補={len(results)}組, 比較={stats.get('pairs')}組")
+
+    return jsonify({
+        'ok': True,
+        'min_score': min_score,
+        'candidates': results[:limit],
+        'count': len(results),
+        'stats': stats
+    })
+
+@bp.route('/api/dedup/merge', methods=['POST'])
+@login_required
+def api_dedup_merge():
+    """
+    重複した病院データの統合（履歴記録付き）
+
+    keep の空欄を remove の値で補完し（take のフィールドは remove の値で上書き）、
+    remove を削除します。keep の更新・remove の削除・両方の履歴は同じトランザクションで
+    コミットします。
+
+    Request JSON:
+        keep: 残す病院コード
+        remove: 削除する病院コード
+        take: remove の値を使うフィールド（省略可）
+        versions: {病院コード: version（updated_at）}（省略可）
+
+    Response:
+        filled: 補完したフィールド
+        taken: remove の値を使ったフィールド
+        conflicts: 値が異なり keep の値を残したフィールド [{'field', 'keep', 'remove'}]
+    """
+    data = request.get_json(silent=True) or {}
+    keep, remove = data.get('keep'), data.get('remove')
+    take = data.get('take') or []
+    versions = data.get('versions') or {}
+
+    if not isinstance(keep, str) or not isinstance(remove, str) or not keep or not remove:
+        return jsonify({'ok': False, 'error': 'keep and remove required'}), 400
+    if keep == remove:
+        return jsonify({'ok': False, 'error': 'keep and remove must differ'}), 400
+    if not isinstance(take, list) or not all(isinstance(field, str) for field in take) \
+            or not isinstance(versions, dict):
+        return jsonify({'ok': False, 'error': 'Invalid request'}), 400
+
+    user_id = session.get('user_id')
+    username = session.get('username')
+    codec = get_storage_codec()
+
+    conn = get_db_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = {row['code']: row for row in conn.execute(
+                'SELECT code, kv, updated_at FROM mdata WHERE code IN (?, ?)', (keep, remove))}
+            for code in (keep, remove):
+                if code not in rows:
+                    conn.rollback()
+                    return jsonify({'ok': False, 'error': 'Not found', 'code': code}), 404
+                if versions.get(code) is not None and versions[code] != rows[code]['updated_at']:
+                    conn.rollback()
+                    return jsonify({'ok': False, 'error': 'Conflict', 'code': code,
+                                    'version': rows[code]['updated_at']}), 409
+            lock = conn.execute('SELECT code, username FROM locks WHERE code IN (?, ?) AND user_id != ?',
+                                (keep, remove, user_id)).fetchone()
+            if lock:
+                conn.rollback()
+                return jsonify({'ok': False, 'error': 'Locked', 'code': lock['code'],
+                                'locked_by': lock['username']}), 409
+
+            old_data = {}
+            for code in (keep, remove):
+                try:
+                    old_data[code] = codec.loads(rows[code]['kv'])
+                except:
+                    old_data[code] = {}
+            merged, filled, taken, conflicts = dedup.merge_kv(old_data[keep], old_data[remove], set(take))
+
+            history_rows = []
+            if merged != old_data[keep]:
+                hist, changed_fields = history_row(keep, 'update', old_data[keep], merged, user_id, username)
+                aggregate_stats.apply_change(conn, keep, old_data[keep], merged, changed_fields)
+                geo.apply_change(conn, keep, old_data[keep], merged, changed_fields)
+                conn.execute('''
+                    UPDATE mdata
+                    SET kv = ?, updated_at = CURRENT_TIMESTAMP, updated_by = ?
+                    WHERE code = ?
+                ''', (codec.dumps(merged), user_id, keep))
+                history_rows.append(hist)
+
+            # 削除は変更後のデータがないため、変更前の全フィールドを変更として扱う
+            hist, _ = history_row(remove, 'delete', old_data[remove], None, user_id, username)
+            aggregate_stats.apply_change(conn, remove, old_data[remove], {}, list(old_data[remove]))
+            geo.apply_change(conn, remove, old_data[remove], {}, list(old_data[remove]))
+            conn.execute('DELETE FROM mdata WHERE code = ?', (remove,))
+            conn.execute('DELETE FROM locks WHERE code = ?', (remove,))
+            history_rows.append(hist)
+
+            conn.executemany(audit_writer.STATEMENTS['history'], history_rows)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    finally:
+        conn.close()
+
+    replica.mark_stale()
+
+    print(f"🔀 重複統合: keep={keep}, remove={remove}, user={username}, "
+          f"補完={len(filled)}, 上書き={len(taken)}, 不一致={len(conflicts)}")
+
+    return jsonify({
+        'ok': True,
+        'code': keep,
+        'removed': remove,
+        'filled': filled,
+        'taken': taken,
+        'conflicts': conflicts
+    })
+
+@bp.route('/api/validation/report', methods=['GET'])
+@login_required
+def api_validation_report():
+    """
+    全病院の入力チェックの結果（CSV、1件ずつ読み込みながら出力）
+
+    Query:
+        level: error / warning（省略時はすべて）
+    """
+    level = request.args.get('level') or None
+    if level is not None and level not in validation.LEVELS:
+        return jsonify({'ok': False, 'error': f'level must be one of {validation.LEVELS}'}), 400
+
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        # Excel で開けるよう BOM 付き
+        buffer.write('\ufeff')
+        writer.writerow(validation.REPORT_COLUMNS)
+        stats = {}
+        conn = get_db_connection()
+        try:
+            for code, violations in validation.check_all(conn, get_storage_codec(), validator, level, stats):
+                writer.writerows(validation.report_rows([(code, violations)]))
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        finally:
+            conn.close()
+        yield buffer.getvalue()
+        print(f"📋 入力チェックレポート: 病院={stats.get('hospitals')}, 違反のある病院={stats.get('invalid')}, "
+              f"違反={stats.get('violations')}")
+
+    return Response(stream_with_context(generate()), mimetype='text/csv',
+                    headers={'Content-Disposition': 'attachment; filename=validation_report.csv'})
+
+OPEN_HISTORY_LIMIT = 5
+
+@bp.route('/api/mdata/<code>/open', methods=['POST'])
+@login_required
+def api_mdata_open(code):
+    """
+    編集開始（前の病院のロック解放・ロック取得・データ取得を1回で行う）
+    
+    Request JSON:
+        release: 解放する病院コード（前に編集していた病院、省略可）
+        fields, shape: 指定した場合は GET /api/mdata/<code> と同じ形式で一部のフィールドだけ返す
+    
+    ロックの解放・取得とデータの読み込みは1つのトランザクションで行います。
+    他のユーザーがロック中の場合は 409、データがない場合は 404 を返します
+    （どちらの場合も release の解放は行います）。
+    """
+    data = request.get_json(silent=True) or {}
+    release = data.get('release')
+    shape = data.get('shape')
+    if shape is not None and shape not in MDATA_SHAPES:
+        return jsonify({'ok': False, 'error': f'shape must be one of {MDATA_SHAPES}'}), 400
+    fields, tables = parse_mdata_fields(data.get('fields'))
+    user_id = session.get('user_id')
+    username = session.get('username')
+    
+    conn = get_db_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        
+        # 前の病院のロックを解放
+        released = None
+        if release and release != code:
+            cur = conn.execute('DELETE FROM locks WHERE code = ? AND user_id = ?', (release, user_id))
+            released = release if cur.rowcount else None
+        
+        row = conn.execute('SELECT code, kv, updated_at FROM mdata WHERE code = ?', (code,)).fetchone()
+        if not row:
+            conn.commit()
+            return jsonify({'ok': False, 'error': 'Not found', 'released': released}), 404
+        
+        lock = conn.execute('SELECT user_id, username, locked_at FROM locks WHERE code = ?', (code,)).fetchone()
+        if lock and lock['user_id'] != user_id:
+            conn.commit()
+            return jsonify({
+                'ok': False,
+                'error': f'Locked by {lock["username"]}',
+                'locked_by': lock['username'],
+                'lock': dict(lock),
+                'released': released
+            }), 409
+        
+        if not lock:
+            conn.execute('INSERT INTO locks (code, user_id, username) VALUES (?, ?, ?)',
+                        (code, user_id, username))
+            lock = conn.execute('SELECT user_id, username, locked_at FROM locks WHERE code = ?', (code,)).fetchone()
+        
+        # 最近の履歴（一覧表示用の要約のみ、アーカイブ済みの履歴は含めない）
+        recent = conn.execute('''
+            SELECT id, action, changed_fields, username, created_at, merged_count
+            FROM history
+            WHERE code = ?
+            ORDER BY created_at DESC, id DESC
+            LIMIT ?
+        ''', (code, OPEN_HISTORY_LIMIT)).fetchall()
+        history_total = conn.execute('SELECT COUNT(*) FROM history WHERE code = ?', (code,)).fetchone()[0]
+
+        projection = read_mdata_projection(conn, code, fields, tables, shape) if shape else None
+        
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    
+    if projection is None:
+        try:
+            projection = {'kv': get_storage_codec().loads(row['kv'])}
+        except:
+            projection = {'kv': {}}
+    
+    history = []
+    for h in recent:
+        try:
+            changed_fields = json_engine.loads(h['changed_fields']) if h['changed_fields'] else []
+        except:
+            changed_fields = []
+        history.append({
+            'id': h['id'],
+            'action': h['action'],
+            'changed_count': len(changed_fields),
+            'username': h['username'],
+            'created_at': h['created_at'],
+            'merged_count': h['merged_count']
+        })
+    
+    print(f"🔒 編集開始: code={code}, user={username}" + (f", 解放={released}" if released else ''))
+    
+    return jsonify({
+        'ok': True,
+        'code': row['code'],
+        **projection,
+        'updated_at': row['updated_at'],
+        'version': row['updated_at'],
+        'lock': dict(lock),
+        'released': released,
+        'history': {'total': history_total, 'recent': history}
+    })
+
 # ============================================
 # 🆕 履歴管理API
 # ============================================
 
-@app.route('/api/history', methods=['GET'])
+@bp.route('/api/history', methods=['GET'])
 @login_required
 def api_history():
     """全体の履歴を取得"""
     limit = request.args.get('limit', 50, type=int)
     offset = request.args.get('offset', 0, type=int)
     
+    # 書き込み待ちの監査ログを反映してから読む
+    audit_log.flush()
     conn = get_db_connection()
     
     # 履歴を取得
@@ -710,7 +1567,7 @@ def api_history():
     result = []
     for h in histories:
         try:
-            changed_fields = json.loads(h['changed_fields']) if h['changed_fields'] else []
+            changed_fields = json_engine.loads(h['changed_fields']) if h['changed_fields'] else []
         except:
             changed_fields = []
         
@@ -732,63 +1589,99 @@ def api_history():
         'offset': offset
     })
 
-@app.route('/api/history/<code>', methods=['GET'])
+@bp.route('/api/history/<code>', methods=['GET'])
 @login_required
 def api_history_by_code(code):
-    """特定の病院の履歴を取得"""
+    """
+    特定の病院の履歴を取得（新しい順、アーカイブ分も含めてページング）
+    
+    クエリパラメータ: limit（既定: 50）, offset
+    """
+    limit = request.args.get('limit', 50, type=int)
+    offset = request.args.get('offset', 0, type=int)
+    
+    # 書き込み待ちの監査ログを反映してから読む
+    audit_log.flush()
     conn = get_db_connection()
+    tiers = ('hot', 'cold') if history_archive.attach(conn, DATABASE) else ('hot',)
     
-    histories = conn.execute('''
-        SELECT * FROM history 
-        WHERE code = ?
-        ORDER BY created_at DESC
-    ''', (code,)).fetchall()
+    histories = history_archive.page_by_code(conn, code, limit, offset, tiers)
+    total = history_archive.count_by_code(conn, code, tiers)
     
     conn.close()
     
     # 結果を整形
-    result = []
-    for h in histories:
-        try:
-            old_data = json.loads(h['old_data']) if h['old_data'] else None
-            new_data = json.loads(h['new_data']) if h['new_data'] else None
-            changed_fields = json.loads(h['changed_fields']) if h['changed_fields'] else []
-        except:
-            old_data = None
-            new_data = None
-            changed_fields = []
-        
-        result.append({
-            'id': h['id'],
-            'code': h['code'],
-            'action': h['action'],
-            'old_data': old_data,
-            'new_data': new_data,
-            'changed_fields': changed_fields,
-            'user_id': h['user_id'],
-            'username': h['username'],
-            'created_at': h['created_at']
-        })
+    result = [format_history_entry(h) for h in histories]
     
     return jsonify({
         'ok': True,
         'code': code,
         'histories': result,
-        'count': len(result)
+        'count': len(result),
+        'total': total,
+        'limit': limit,
+        'offset': offset
     })
 
+@bp.route('/api/history/<code>/<int:history_id>', methods=['GET'])
+@login_required
+def api_history_entry(code, history_id):
+    """履歴1件の詳細（変更前後のデータ）を取得"""
+    audit_log.flush()
+    conn = get_db_connection()
+    tiers = ('hot', 'cold') if history_archive.attach(conn, DATABASE) else ('hot',)
+    h = history_archive.get_entry(conn, code, history_id, tiers)
+    conn.close()
+    
+    if not h:
+        return jsonify({'ok': False, 'error': 'Not found'}), 404
+    
+    return jsonify({'ok': True, 'history': format_history_entry(h)})
+
+def format_history_entry(h):
+    """履歴の行をAPIレスポンス用の辞書に変換"""
+    codec = get_storage_codec()
+    try:
+        old_data = codec.loads(h['old_data']) if h['old_data'] else None
+        new_data = codec.loads(h['new_data']) if h['new_data'] else None
+        changed_fields = json_engine.loads(h['changed_fields']) if h['changed_fields'] else []
+    except:
+        old_data = None
+        new_data = None
+        changed_fields = []
+    
+    return {
+        'id': h['id'],
+        'code': h['code'],
+        'action': h['action'],
+        'old_data': old_data,
+        'new_data': new_data,
+        'changed_fields': changed_fields,
+        'user_id': h['user_id'],
+        'username': h['username'],
+        'created_at': h['created_at'],
+        # 古い連続した更新をまとめた場合は件数と最初の日時
+        'merged_count': h['merged_count'],
+        'first_created_at': h['first_created_at'],
+        'archived': h['tier'] == 'cold'
+    }
+
 # ============================================
 # 🆕 ログイン履歴API
 # ============================================
 
-@app.route('/api/login_history', methods=['GET'])
+@bp.route('/api/login_history', methods=['GET'])
 @login_required
 def api_login_history():
     """ログイン履歴を取得"""
     limit = request.args.get('limit', 50, type=int)
     offset = request.args.get('offset', 0, type=int)
     user_id = request.args.get('user_id', type=int)  # 特定ユーザーのみ取得
+    start = request.args.get('start')  # 'YYYY-MM-DD'
+    end = request.args.get('end')
     
+    # 書き込み待ちの監査ログを反映してから読む
+    audit_log.flush()
     conn = get_db_connection()
     
     # 管理者以外は自分の履歴のみ閲覧可能
@@ -799,24 +1692,29 @@ def api_login_history():
         user_id = current_user_id
     
     # クエリ構築
+    conditions = []
+    params = []
     if user_id:
-        query = '''
-            SELECT * FROM login_history 
-            WHERE user_id = ?
-            ORDER BY login_time DESC 
-            LIMIT ? OFFSET ?
-        '''
-        histories = conn.execute(query, (user_id, limit, offset)).fetchall()
-        total = conn.execute('SELECT COUNT(*) as count FROM login_history WHERE user_id = ?', 
-                           (user_id,)).fetchone()['count']
-    else:
-        query = '''
-            SELECT * FROM login_history 
-            ORDER BY login_time DESC 
-            LIMIT ? OFFSET ?
-        '''
-        histories = conn.execute(query, (limit, offset)).fetchall()
-        total = conn.execute('SELECT COUNT(*) as count FROM login_history').fetchone()['count']
+        conditions.append('user_id = ?')
+        params.append(user_id)
+    if start:
+        conditions.append('login_time >= ?')
+        params.append(start)
+    if end:
+        conditions.append("login_time < date(?, '+1 day')")
+        params.append(end)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    
+    histories = conn.execute(f'''
+        SELECT * FROM login_history 
+        {where}
+        ORDER BY login_time DESC 
+        LIMIT ? OFFSET ?
+    ''', params + [limit, offset]).fetchall()
+    total = conn.execute(f'SELECT COUNT(*) as count FROM login_history {where}', params).fetchone()['count']
+    
+    # これより前の明細はアーカイブ済み（集計のみ）
+    archived_before = login_retention.archived_before(conn)
     
     conn.close()
     
@@ -838,52 +1736,148 @@ def api_login_history():
         'histories': result,
         'total': total,
         'limit': limit,
-        'offset': offset
+        'offset': offset,
+        'archived_before': archived_before
+    })
+
+@bp.route('/api/login_history/summary', methods=['GET'])
+@login_required
+def api_login_history_summary():
+    """
+    日別のログイン件数（長い期間は日別集計テーブルから取得）
+    
+    クエリパラメータ: start, end（'YYYY-MM-DD'）, user_id
+    """
+    user_id = request.args.get('user_id', type=int)
+    start = request.args.get('start')
+    end = request.args.get('end')
+    
+    # 管理者以外は自分の履歴のみ閲覧可能
+    if session.get('role') != 'admin':
+        user_id = session.get('user_id')
+    
+    try:
+        for value in (start, end):
+            if value:
+                datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        return jsonify({'ok': False, 'error': 'Invalid date (YYYY-MM-DD)'}), 400
+    
+    audit_log.flush()
+    conn = get_db_connection()
+    days = login_retention.daily_summary(conn, start, end, user_id)
+    archived_before = login_retention.archived_before(conn)
+    conn.close()
+    
+    return jsonify({
+        'ok': True,
+        'days': days,
+        'total': sum(d['success'] + d['failure'] for d in days),
+        'success': sum(d['success'] for d in days),
+        'failure': sum(d['failure'] for d in days),
+        'archived_before': archived_before
     })
 
 # ============================================
 # 都道府県・病院リストAPI
 # ============================================
 
-@app.route('/api/prefectures', methods=['GET'])
+@bp.route('/api/stats', methods=['GET'])
+@login_required
+def api_stats():
+    """
+    医師数・病院数の集計
+
+    Query:
+        group_by: 集計の軸（カンマ区切り: prefecture, department, university, graduation）
+        prefecture / department / university / graduation: 絞り込み（空文字は未入力）
+        limit: 医師数の多い順に返す件数
+    """
+    group_by = [d for d in request.args.get('group_by', 'prefecture').split(',') if d]
+    filters = {d: request.args[d] for d in aggregate_stats.DIMENSIONS if d in request.args}
+    limit = request.args.get('limit', type=int)
+
+    conn = get_read_connection()
+    try:
+        rows = aggregate_stats.query(conn, group_by, filters, limit)
+    except ValueError as e:
+        return jsonify({'ok': False, 'error': str(e)}), 400
+    finally:
+        conn.close()
+
+    if 'prefecture' in group_by:
+        for row in rows:
+            row['prefecture_name'] = hospital_index.prefecture_name(row['prefecture'])
+
+    return jsonify({
+        'ok': True,
+        'group_by': group_by,
+        'filters': filters,
+        'rows': rows,
+        'count': len(rows)
+    })
+
+@bp.route('/api/geo/nearest', methods=['GET'])
+@login_required
+def api_geo_nearest():
+    """
+    近隣の病院（近い順）
+
+    Query:
+        postcode / code / lat と lon: 基準の地点（郵便番号・病院コード・座標のいずれか）
+        k: 件数（既定 10、radius_km のみ指定した場合は GEO_MAX_RESULTS）
+        radius_km: この距離（km）以内の病院のみ
+    """
+    k = request.args.get('k', type=int)
+    radius_km = request.args.get('radius_km', type=float)
+    if k is None:
+        k = GEO_MAX_RESULTS if radius_km is not None else 10
+    if k <= 0 or (radius_km is not None and radius_km < 0):
+        return jsonify({'ok': False, 'error': 'k and radius_km must be positive'}), 400
+    k = min(k, GEO_MAX_RESULTS)
+
+    code = request.args.get('code')
+    postcode = request.args.get('postcode')
+    lat = request.args.get('lat', type=float)
+    lon = request.args.get('lon', type=float)
+    if code:
+        location = geo_index.location(code)
+        if not location:
+            return jsonify({'ok': False, 'error': 'No location for this hospital'}), 404
+        origin = {'lat': location[0], 'lon': location[1], 'source': 'hospital'}
+    elif postcode:
+        conn = get_read_connection()
+        try:
+            location = geo.postcode_location(conn, postcode)
+        finally:
+            conn.close()
+        if not location:
+            return jsonify({'ok': False, 'error': 'Unknown postcode'}), 404
+        origin = {'lat': location[0], 'lon': location[1], 'source': location[2]}
+    elif lat is not None and lon is not None:
+        origin = {'lat': lat, 'lon': lon, 'source': 'point'}
+    else:
+        return jsonify({'ok': False, 'error': 'postcode, code or lat/lon is required'}), 400
+
+    nearest = geo_index.nearest(origin['lat'], origin['lon'], k, radius_km, exclude=code)
+    hospitals.refresh_if_changed()
+    names = hospitals.names
+    results = [{'code': c, 'name': names.get(c, ''), 'distance_km': round(d, 2)} for d, c in nearest]
+
+    print(f"🗺️ 近隣病院検索: origin={code or postcode or (lat, lon)}, k={k}, radius={radius_km}, count={len(results)}")
+
+    return jsonify({
+        'ok': True,
+        'origin': origin,
+        'results': results,
+        'count': len(results)
+    })
+
+@bp.route('/api/prefectures', methods=['GET'])
 @login_required
 def api_prefectures():
     """都道府県リストを取得"""
-    conn = get_db_connection()
-    
-    # 都道府県コードから一意の値を取得
-    query = '''
-        SELECT DISTINCT substr(code, 1, 2) as pref_code
-        FROM mdata
-        ORDER BY pref_code
-    '''
-    
-    results = conn.execute(query).fetchall()
-    conn.close()
-    
-    # 都道府県コードと名前のマッピング
-    pref_names = {
-        '01': '北海道', '02': '青森県', '03': '岩手県', '04': '宮城県', '05': '秋田県',
-        '06': '山形県', '07': '福島県', '08': '茨城県', '09': '栃木県', '10': '群馬県',
-        '11': '埼玉県', '12': '千葉県', '13': '東京都', '14': '神奈川県', '15': '新潟県',
-        '16': '富山県', '17': '石川県', '18': '福井県', '19': '山梨県', '20': '長野県',
-        '21': '岐阜県', '22': '静岡県', '23': '愛知県', '24': '三重県', '25': '滋賀県',
-        '26': '京都府', '27': '大阪府', '28': '兵庫県', '29': '奈良県', '30': '和歌山県',
-        '31': '鳥取県', '32': '島根県', '33': '岡山県', '34': '広島県', '35': '山口県',
-        '36': '徳島県', '37': '香川県', '38': '愛媛県', '39': '高知県', '40': '福岡県',
-        '41': '佐賀県', '42': '長崎県', '43': '熊本県', '44': '大分県', '45': '宮崎県',
-        '46': '鹿児島県', '47': '沖縄県'
-    }
-    
-    prefectures = []
-    for row in results:
-        pref_code = row['pref_code']
-        pref_name = pref_names.get(pref_code, f'都道府県{pref_code}')
-        
-        prefectures.append({
-            'code': pref_code,
-            'name': pref_name
-        })
+    prefectures = hospitals.prefectures()
     
     print(f"📊 都道府県リスト取得: {len(prefectures)}件")
     
@@ -892,7 +1886,7 @@ def api_prefectures():
         'prefectures': prefectures
     })
 
-@app.route('/api/hospitals', methods=['GET'])
+@bp.route('/api/hospitals', methods=['GET'])
 @login_required
 def api_hospitals():
     """都道府県で絞り込んだ病院リストを取得"""
@@ -901,47 +1895,168 @@ def api_hospitals():
     if not prefecture:
         return jsonify({'ok': False, 'error': 'Prefecture code required'}), 400
     
-    conn = get_db_connection()
-    
-    # 都道府県コードで前方一致検索（例：'01' -> '01-*'）
-    query = '''
-        SELECT code, kv
-        FROM mdata
-        WHERE code LIKE ?
-        ORDER BY code
-    '''
+    # 都道府県コードで前方一致検索（例：'01' -> '01-*'、病院名がある病院のみ）
+    results = hospitals.hospitals(prefecture)
     
-    results = conn.execute(query, (f'{prefecture}-%',)).fetchall()
-    conn.close()
-    
-    hospitals = []
-    for row in results:
-        try:
-            kv = json.loads(row['kv'])
-            hospital_name = kv.get('病院名', '')
-            
-            if hospital_name:  # 病院名がある場合のみ追加
-                hospitals.append({
-                    'code': row['code'],
-                    'name': hospital_name
-                })
-        except:
-            # JSONのパースに失敗した場合はスキップ
-            continue
-    
-    print(f"🏥 病院リスト取得: prefecture={prefecture}, count={len(hospitals)}")
+    print(f"🏥 病院リスト取得: prefecture={prefecture}, count={len(results)}")
     
     return jsonify({
         'ok': True,
-        'hospitals': hospitals,
-        'count': len(hospitals)
+        'hospitals': results,
+        'count': len(results)
     })
 
+# ============================================
+# 変更フィード（ブラウザ側のキャッシュの差分同期）
+# ============================================
+
+# /api/changes で1回に返す病院の最大件数
+CHANGES_PAGE_LIMIT = int(os.environ.get('CHANGES_PAGE_LIMIT', 1000))
+
+def mdata_line(head, kv_text):
+    """NDJSON の1行（kv は保存されている JSON テキストをそのまま埋め込む）"""
+    return json_engine.dumps(head)[:-1] + ',"kv":' + kv_text + '}\n'
+
+def stored_kv_text(codec, value):
+    """保存された kv の JSON テキスト（1行に収まらない場合は作り直し、読めない場合は {}）"""
+    try:
+        text = codec.decode(value)
+        if text is None:
+            return '{}'
+        if '\n' in text or '\r' in text:
+            return json_engine.dumps(json_engine.loads(text))
+        return text
+    except Exception:
+        return '{}'
+
+# JSONとして読めないテキストは {} として返す（NDJSON の行を壊さないため）
+MDATA_KV_COLUMN = "CASE WHEN typeof(kv) = 'text' AND NOT json_valid(kv) THEN '{}' ELSE kv END"
+
+@bp.route('/api/changes', methods=['GET'])
+@login_required
+def api_changes():
+    """
+    連番 since より後に変更された病院（病院ごとに最新の内容のみ）
+
+    ブラウザは全件（/api/changes/snapshot）を保存した後、最後に受け取った連番を since に
+    指定して差分だけを受け取ります。more が true の間は続けて呼び出してください。
+
+    Query:
+        since: 最後に受け取った連番
+        limit: 病院の件数（既定・最大 CHANGES_PAGE_LIMIT）
+
+    Response (application/x-ndjson, 1行ずつ):
+        {"type": "change", "op": "upsert", "code", "seq", "updated_at", "kv"}
+        {"type": "change", "op": "delete", "code", "seq"}
+        ...
+        {"type": "cursor", "since", "seq": 次の since, "latest", "more", "count"}
+
+    since の直後の記録がすでに削除されている（または連番が戻った）場合は 410
+    （/api/changes/snapshot から取り直す）。
+    """
+    since = request.args.get('since', type=int)
+    limit = min(request.args.get('limit', CHANGES_PAGE_LIMIT, type=int), CHANGES_PAGE_LIMIT)
+    if since is None or since < 0:
+        return jsonify({'ok': False, 'error': 'since required'}), 400
+    if limit <= 0:
+        return jsonify({'ok': False, 'error': 'limit must be positive'}), 400
+
+    # 連番と病院データを同じ時点で読むため、1つの読み取りトランザクションで処理
+    conn = get_db_connection()
+    try:
+        conn.execute('BEGIN')
+        changes, latest, expired = change_log.compacted_since(conn, since, limit)
+    except Exception:
+        conn.close()
+        raise
+    if expired:
+        conn.close()
+        print(f"⏳ 変更フィード: since={since} は期限切れ（latest={latest}）")
+        return jsonify({
+            'ok': False,
+            'error': 'Cursor expired',
+            'latest': latest,
+            'snapshot': url_for('main.api_changes_snapshot')
+        }), 410
+
+    def generate():
+        codec = get_storage_codec()
+        try:
+            rows = {}
+            codes = [code for code, _ in changes]
+            for i in range(0, len(codes), 500):
+                chunk = codes[i:i + 500]
+                placeholders = ','.join('?' * len(chunk))
+                for row in conn.execute(f'SELECT code, {MDATA_KV_COLUMN}, updated_at FROM mdata '
+                                        f'WHERE code IN ({placeholders})', chunk):
+                    rows[row[0]] = row
+            for code, seq in changes:
+                row = rows.get(code)
+                if row is None:
+                    yield json_engine.dumps({'type': 'change', 'op': 'delete', 'code': code, 'seq': seq}) + '\n'
+                else:
+                    head = {'type': 'change', 'op': 'upsert', 'code': code, 'seq': seq, 'updated_at': row[2]}
+                    yield mdata_line(head, stored_kv_text(codec, row[1]))
+        finally:
+            conn.close()
+        cursor = changes[-1][1] if changes else latest
+        yield json_engine.dumps({
+            'type': 'cursor',
+            'since': since,
+            'seq': cursor,
+            'latest': latest,
+            'more': cursor < latest,
+            'count': len(changes)
+        }) + '\n'
+
+    print(f"🔄 変更フィード: since={since}, 病院={len(changes)}件, latest={latest}")
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@bp.route('/api/changes/snapshot', methods=['GET'])
+@login_required
+def api_changes_snapshot():
+    """
+    全病院のデータ（ブラウザのキャッシュの作成用）
+
+    Response (application/x-ndjson, 1行ずつ):
+        {"type": "snapshot", "seq": この時点の連番, "count"}
+        {"type": "hospital", "code", "updated_at", "kv"}
+        ...
+        {"type": "end", "seq", "count"}
+
+    以降は seq を since にして /api/changes で差分を受け取ります。
+    """
+    conn = get_db_connection()
+    try:
+        conn.execute('BEGIN')
+        seq = change_log.latest_seq(conn)
+        count = conn.execute('SELECT COUNT(*) FROM mdata').fetchone()[0]
+    except Exception:
+        conn.close()
+        raise
+
+    def generate():
+        codec = get_storage_codec()
+        sent = 0
+        try:
+            yield json_engine.dumps({'type': 'snapshot', 'seq': seq, 'count': count}) + '\n'
+            for code, kv, updated_at in conn.execute(
+                    f'SELECT code, {MDATA_KV_COLUMN}, updated_at FROM mdata ORDER BY code'):
+                sent += 1
+                yield mdata_line({'type': 'hospital', 'code': code, 'updated_at': updated_at},
+                                 stored_kv_text(codec, kv))
+        finally:
+            conn.close()
+        yield json_engine.dumps({'type': 'end', 'seq': seq, 'count': sent}) + '\n'
+        print(f"📦 スナップショット: seq={seq}, 病院={sent}件")
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
 # ============================================
 # ユーザー管理API
 # ============================================
 
-@app.route('/api/users', methods=['GET', 'POST'])
+@bp.route('/api/users', methods=['GET', 'POST'])
 @login_required
 def api_users():
     """ユーザー管理API"""
@@ -981,7 +2096,7 @@ def api_users():
             print(f"❌ ユーザー作成失敗: {str(e)}")
             return jsonify({'error': 'Username or email already exists'}), 400
 
-@app.route('/api/users/<int:user_id>', methods=['PUT', 'DELETE'])
+@bp.route('/api/users/<int:user_id>', methods=['PUT', 'DELETE'])
 @login_required
 def api_user(user_id):
     """個別ユーザー管理API"""
@@ -1047,6 +2162,11 @@ def handle_connect():
     user_id = session.get('user_id')
     username = session.get('username')
     
+    # 再接続を繰り返すクライアントは接続を拒否（クライアントは間隔を空けて再接続する）
+    if rate_limiter.check('socket', rate_limit_client()):
+        print(f"🚦 Socket接続を拒否（流量制限）: user={username}")
+        return False
+    
     if user_id and username:
         print(f"🔌 Socket接続: user={username} (ID: {user_id})")
         emit('connection_response', {'status': 'connected', 'username': username})
@@ -1063,23 +2183,158 @@ def handle_disconnect():
 # エラーハンドラ
 # ============================================
 
-@app.errorhandler(404)
+@bp.app_errorhandler(404)
 def not_found(error):
     print(f"❌ 404エラー: {request.path}")
     if request.path.startswith('/api/'):
         return jsonify({'ok': False, 'error': 'Not found'}), 404
     return render_template('login.html'), 404
 
-@app.errorhandler(500)
+@bp.app_errorhandler(500)
 def internal_error(error):
     print(f"❌ 500エラー: {str(error)}")
     return jsonify({'ok': False, 'error': 'Internal server error'}), 500
 
+# ============================================
+# アプリケーションファクトリ
+# ============================================
+
+def warmup(app):
+    """
+    一度だけ行えばよい準備をまとめて実行
+    
+    gunicorn --preload ではフォーク前のマスタープロセスで実行され、
+    読み込んだデータはワーカー間でコピーオンライトにより共有されます。
+    """
+    started = time.perf_counter()
+    
+    # 保存形式（圧縮辞書）と病院コード・病院名の一覧・病院の座標・類似病院
+    get_storage_codec()
+    hospitals.load()
+    geo_index.load()
+    similar_hospitals.load()
+    
+    # テンプレートのコンパイル
+    for name in app.jinja_env.list_templates(extensions=['html']):
+        app.jinja_env.get_template(name)
+    
+    # 静的ファイルのハッシュ・圧縮は StaticAssets の作成時に完了している
+    print(f"🔥 ウォームアップ完了: {(time.perf_counter() - started) * 1000:.0f}ms")
+
+def create_app(preload=False, database=None):
+    """
+    アプリケーションファクトリ（gunicorn から wsgi.py 経由で使用）
+
+    Flask アプリ・Socket.IO・監査ログの書き込みスレッド・病院一覧などを作成します。
+    作成したオブジェクトはこのモジュールの変数に置くため、1プロセスで使うアプリは1つです
+    （再度呼び出した場合は以前のアプリも新しいオブジェクトを参照します）。
+    
+    Args:
+        preload: True の場合は warmup() を行い、フォーク後に変更されない
+                 オブジェクトを GC の対象から外す（コピーオンライトの共有を保つ）
+        database: DBファイル（省略時は DATABASE_PATH）
+
+    Raises:
+        RuntimeError: 未適用のマイグレーションがある場合（python migrations.py upgrade で適用）
+    """
+    global DATABASE, assets, replica, audit_log, hospitals, geo_index, similar_hospitals, dedup_report
+    global readiness, backup_scheduler, password_verifier, login_throttle, rate_limiter, admission
+
+    # スキーマの変更は migrations.py で行う（起動時はバージョンの確認のみ）
+    database = database or os.environ.get('DATABASE_PATH', 'hospital_data.sqlite3')
+    check_schema(database)
+
+    # 作り直す場合は以前のアプリの書き込み待ち・プロセスプールを片付ける
+    if audit_log is not None:
+        audit_log.close()
+    if password_verifier is not None:
+        password_verifier.shutdown()
+    DATABASE = database
+
+    app = Flask(__name__)
+
+    # セッション設定
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', secrets.token_hex(32))
+    app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=8)
+    app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
+    app.config['SESSION_COOKIE_SECURE'] = False  # ローカル開発環境用（HTTPSの場合はTrue）
+    app.config['SESSION_COOKIE_HTTPONLY'] = True
+    app.config['SESSION_COOKIE_NAME'] = 'hospital_session'
+
+    # JSONエンジン（orjson / msgspec があれば高速化）
+    app.json = json_engine.FastJSONProvider(app)
+
+    # SOCKETIO_ASYNC_MODE: gunicorn の gthread ワーカーでは threading を指定
+    # SOCKETIO_MESSAGE_QUEUE: 複数ワーカーで通知を共有する場合（例: redis://localhost:6379/0）
+    socketio.init_app(app, cors_allowed_origins="*", json=json_engine,
+                      async_mode=os.environ.get('SOCKETIO_ASYNC_MODE') or None,
+                      message_queue=os.environ.get('SOCKETIO_MESSAGE_QUEUE') or None)
+
+    # Socket.IO の要求にも適用するため、init_app の後に包む
+    if TRUSTED_PROXY_COUNT > 0:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_COUNT)
+
+    # JSONレスポンスの圧縮（gzip / brotli）
+    compression.init_app(app)
+
+    # 静的ファイル（ハッシュ付きURL・圧縮済みデータを起動時に作成）
+    assets = static_assets.StaticAssets(app.root_path, auto_reload=app.debug)
+    app.jinja_env.globals['asset_url'] = assets.url_for
+
+    app.register_blueprint(bp)
+
+    # 参照のみのAPI用の接続（READ_REPLICA=1 の場合はメモリ上のコピー）
+    replica = read_replica.ReadReplica(DATABASE)
+
+    # 監査ログ（history / login_history）の書き込みスレッド
+    audit_log = audit_writer.AuditWriter(get_db_connection)
+    atexit.register(audit_log.close)
+
+    # 病院コード・病院名の一覧（初回の参照時、または warmup() で読み込み）
+    hospitals = hospital_index.HospitalIndex(get_read_connection, get_storage_codec)
+
+    # 病院の座標（近隣病院の検索用、初回の参照時、または warmup() で読み込み）
+    geo_index = geo.GeoIndex(get_read_connection)
+
+    # 似ている病院の検索（初回の参照時、または warmup() で作成し、以降は変更された病院のみ更新）
+    similar_hospitals = similarity.SimilarityIndex(get_read_connection, get_storage_codec)
+
+    # 重複した病院データの候補（初回の参照時に全件を比較し、mdata_version が変わるまで再利用）
+    dedup_report = dedup.DedupReport(get_read_connection, get_storage_codec)
+
+    # /api/health/ready の確認（DB・スキーマ・WAL・監査ログ・Socket.IO・ディスク、結果は短時間再利用）
+    readiness = health_check.ReadinessCheck(get_db_connection, DATABASE, audit_log.pending, socketio,
+                                            migrations.LATEST_VERSION)
+
+    # 定期バックアップ（各プロセスの最初のリクエストで開始）
+    backup_scheduler = backup_db.BackupScheduler(DATABASE, backup_db.BACKUP_DIR, BACKUP_INTERVAL_MINUTES)
+
+    # パスワード検証はプロセスプールで実行（リクエスト処理を止めない）
+    password_verifier = login_guard.PasswordVerifier(async_mode=socketio.async_mode)
+    atexit.register(password_verifier.shutdown)
+    # 失敗が続くIPアドレス・ユーザー名はDB検索・ハッシュ計算の前に拒否
+    login_throttle = login_guard.LoginThrottle()
+
+    # ユーザー（未ログインはIPアドレス）とルートの種類ごとのトークンバケット
+    rate_limiter = rate_limit.RateLimiter()
+    # 処理中のリクエスト・監査ログの書き込み待ち・DBの書き込みロックの待ち時間を監視
+    admission = rate_limit.AdmissionControl(get_db_connection, audit_log.pending)
+
+    if preload:
+        warmup(app)
+        gc.collect()
+        gc.freeze()
+    return app
+
 # ============================================
 # アプリケーション起動
 # ============================================
 
 if __name__ == '__main__':
+    # 開発サーバーではスキーマを自動で最新にする
+    init_db()
+    app = create_app()
+
     print("\n" + "=" * 60)
     print("🏥 病院情報管理システム サーバー起動中...")
     print("=" * 60)
@@ -1089,4 +2344,4 @@ if __name__ == '__main__':
     print(f"⏰ セッション有効期限: {app.config['PERMANENT_SESSION_LIFETIME']}")
     print("=" * 60 + "\n")
     
-    socketio.run(app, debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    socketio.run(app, debug=True, host='0.0.0.0', port=5000)
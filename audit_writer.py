@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+監査ログ（history / login_history）の非同期書き込み
+
+リクエスト処理では行をキューに積むだけにし、専用の書き込みスレッドが
+一定時間ごと、または一定件数たまった時点で1トランザクションにまとめて
+INSERT します（コミット＝fsync の回数を減らす）。
+
+    AUDIT_DURABILITY      async: キューに積んだら戻る（既定）
+                          sync:  書き込み完了まで待ってから戻る
+    AUDIT_BATCH_SIZE      1回のトランザクションで書き込む最大件数（既定: 200）
+    AUDIT_FLUSH_INTERVAL  書き込み間隔（ミリ秒、既定: 5）
+    AUDIT_RETRY_SECONDS   DBがロックされている場合に再試行する時間（秒、既定: 5）
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+
+AUDIT_DURABILITY = os.environ.get('AUDIT_DURABILITY', 'async')
+AUDIT_BATCH_SIZE = int(os.environ.get('AUDIT_BATCH_SIZE', 200))
+AUDIT_FLUSH_INTERVAL = int(os.environ.get('AUDIT_FLUSH_INTERVAL', 5))
+AUDIT_RETRY_SECONDS = float(os.environ.get('AUDIT_RETRY_SECONDS', 5))
+
+# 書き込み先のテーブルごとのSQL
+STATEMENTS = {
+    'history': '''
+        INSERT INTO history (code, action, old_data, new_data, changed_fields, user_id, username)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''',
+    'login_history': '''
+        INSERT INTO login_history (user_id, username, ip_address, user_agent, success)
+        VALUES (?, ?, ?, ?, ?)
+    ''',
+}
+
+class AuditWriteError(Exception):
+    """書き込みを待っていた行が書き込めなかった（または期限内に完了しなかった）"""
+
+class AuditWriter:
+    """
+    監査ログの書き込みスレッド
+
+    Args:
+        connect: DB接続を返す関数（書き込みスレッドで1本だけ使う）
+        durability: 'async' / 'sync'（add() の既定の待ち方）
+        batch_size: 1トランザクションの最大件数
+        interval: 書き込み間隔（秒）
+        retry_seconds: DBがロックされている場合に再試行する時間（秒）
+    """
+
+    def __init__(self, connect, durability=None, batch_size=None, interval=None, retry_seconds=None):
+        self.connect = connect
+        self.durability = durability or AUDIT_DURABILITY
+        if self.durability not in ('async', 'sync'):
+            raise ValueError(f'Unknown audit durability: {self.durability}')
+        self.batch_size = batch_size or AUDIT_BATCH_SIZE
+        self.interval = interval if interval is not None else AUDIT_FLUSH_INTERVAL / 1000
+        self.retry_seconds = retry_seconds if retry_seconds is not None else AUDIT_RETRY_SECONDS
+        self._queue = deque()         # (連番, テーブル, 行)
+        self._cond = threading.Condition()
+        self._enqueued = 0            # 最後に積んだ連番
+        self._written = 0             # コミットが完了した最後の連番
+        self._settled = 0             # 処理が終わった（書き込み済み・失敗）最後の連番
+        self._failed = deque(maxlen=1000)  # 書き込めなかった行の (最初の連番, 最後の連番, エラー)
+        self._thread = None
+        self._closed = False
+        self._urgent = False          # flush() で待っている呼び出し元がいる
+        self.stats = {'events': 0, 'batches': 0, 'dropped': 0, 'retries': 0}
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        # スレッドはフォーク先に引き継がれないため、子プロセスで作り直す
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._enqueued = self._written = self._settled = 0
+        self._failed = deque(maxlen=1000)
+        self._thread = None
+        self._urgent = False
+
+    def _ensure_thread(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='audit-writer', daemon=True)
+            self._thread.start()
+
+    def add(self, table, row, wait=None):
+        """
+        行を書き込みキューに積む
+
+        Args:
+            table: STATEMENTS のキー
+            row: INSERT のパラメータ
+            wait: True の場合は書き込み完了まで待つ（None は durability に従う）
+
+        Returns:
+            連番（flush(seq) で完了を待てる）
+
+        Raises:
+            AuditWriteError: 完了を待つ場合に、書き込めなかった・期限内に完了しなかった
+        """
+        if table not in STATEMENTS:
+            raise ValueError(f'Unknown audit table: {table}')
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('Audit writer is closed')
+            self._enqueued += 1
+            seq = self._enqueued
+            self._queue.append((seq, table, row))
+            self._ensure_thread()
+            self._cond.notify_all()
+        if wait if wait is not None else self.durability == 'sync':
+            if not self.flush(seq):
+                raise AuditWriteError(f'Audit row was not written in time: table={table}')
+        return seq
+
+    def flush(self, seq=None, timeout=10):
+        """
+        指定の連番（省略時はここまでに積んだ全件）の書き込み完了を待つ
+
+        Returns:
+            期限内に完了した場合は True、期限切れ・書き込めなかった行がある場合は False
+
+        Raises:
+            AuditWriteError: seq を指定し、その行が書き込めなかった
+        """
+        with self._cond:
+            target = self._enqueued if seq is None else seq
+            start = self._settled
+            if start < target:
+                if self._thread is None or not self._thread.is_alive():
+                    return False
+                self._urgent = True
+                self._cond.notify_all()
+                if not self._cond.wait_for(lambda: self._settled >= target, timeout):
+                    return False
+            # 待っている間に失敗した行（seq 指定時はその行のみ）
+            low = seq if seq is not None else start + 1
+            for first, last, error in self._failed:
+                if first <= target and last >= low:
+                    if seq is not None:
+                        raise AuditWriteError(f'Audit row was not written: {error}')
+                    return False
+            return True
+
+    def pending(self):
+        """書き込み待ちの件数"""
+        with self._cond:
+            return len(self._queue)
+
+    def _run(self):
+        conn = self.connect()
+        try:
+            while True:
+                with self._cond:
+                    self._cond.wait_for(lambda: self._queue or self._closed)
+                    # 少し待って後続の行と同じトランザクションにまとめる
+                    self._cond.wait_for(
+                        lambda: len(self._queue) >= self.batch_size or self._urgent or self._closed,
+                        self.interval)
+                    self._urgent = False
+                    batch = [self._queue.popleft() for _ in range(min(len(self._queue), self.batch_size))]
+                    done = self._closed and not self._queue
+                if batch:
+                    failed = self._write(conn, batch)
+                    with self._cond:
+                        self._failed.extend(failed)
+                        if not failed or failed[-1][1] < batch[-1][0]:
+                            self._written = batch[-1][0]
+                        self._settled = batch[-1][0]
+                        self._cond.notify_all()
+                if done:
+                    return
+        finally:
+            conn.close()
+
+    def _execute(self, conn, statements):
+        """
+        1トランザクションで書き込む（DBがロックされている間は retry_seconds まで間隔を延ばして再試行）
+        """
+        deadline = time.monotonic() + self.retry_seconds
+        delay = 0.05
+        while True:
+            try:
+                with conn:
+                    for sql, rows in statements:
+                        conn.executemany(sql, rows)
+                return
+            except sqlite3.OperationalError as e:
+                message = str(e)
+                if 'locked' not in message and 'busy' not in message:
+                    raise
+                if time.monotonic() + delay > deadline:
+                    raise
+                self.stats['retries'] += 1
+                print(f"⏳ 監査ログの書き込みを再試行: {delay:.2f}秒後, error={e}")
+                time.sleep(delay)
+                delay = min(delay * 2, 1.0)
+
+    def _write(self, conn, batch):
+        """
+        バッチを書き込む
+
+        Returns:
+            書き込めなかった行の [(最初の連番, 最後の連番, エラー)]（連番の順）
+        """
+        grouped = {}
+        for _, table, row in batch:
+            grouped.setdefault(table, []).append(row)
+        failed = []
+        try:
+            self._execute(conn, [(STATEMENTS[table], rows) for table, rows in grouped.items()])
+        except sqlite3.IntegrityError:
+            # 制約違反の行があれば1件ずつ書き込み、失敗した行だけ捨てる
+            for seq, table, row in batch:
+                try:
+                    self._execute(conn, [(STATEMENTS[table], [row])])
+                except sqlite3.Error as e:
+                    failed.append((seq, seq, str(e)))
+                    print(f"❌ 監査ログの記録に失敗: table={table}, error={e}")
+        except sqlite3.Error as e:
+            failed.append((batch[0][0], batch[-1][0], str(e)))
+            print(f"❌ 監査ログの書き込みエラー: {len(batch)}件, error={e}")
+        dropped = sum(last - first + 1 for first, last, _ in failed)
+        self.stats['dropped'] += dropped
+        if dropped < len(batch):
+            self.stats['events'] += len(batch) - dropped
+            self.stats['batches'] += 1
+        return failed
+
+    def close(self, timeout=10):
+        """キューに残った行を書き込んでから停止"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+            remaining = self.pending()
+            if remaining:
+                print(f"⚠️ 監査ログの書き込みが完了しませんでした: {remaining}件")
@@ -1,31 +1,323 @@
 # backup_db.py
+"""
+データベースのバックアップ・復元
+
+- オンラインバックアップAPIでページ単位（BACKUP_PAGES ページずつ、間に BACKUP_SLEEP 秒）
+  にコピーするため、バックアップ中もアプリの書き込みを長時間止めません
+- コピーしたスナップショットは PRAGMA integrity_check で検査してから保存します
+- full: DB全体を gzip で保存
+  incremental: 前回のバックアップからページ内容（ハッシュ）が変わったページのみ保存
+- restore: full と incremental を順に適用して復元し、検査してからファイルを置き換えます
+
+使い方:
+    python backup_db.py                      # バックアップ（auto）+ 古いバックアップの削除
+    python backup_db.py backup --mode full
+    python backup_db.py list
+    python backup_db.py verify [名前]
+    python backup_db.py restore [名前] [--target パス]   # アプリを停止してから実行
+
+アプリ内で定期実行する場合は BACKUP_INTERVAL_MINUTES を設定します（app.py）。
+"""
+import argparse
+import gzip
+import hashlib
+import json
 import os
+import shutil
 import sqlite3
+import struct
+import tempfile
+import threading
+import time
 from datetime import datetime, timedelta
 from pathlib import Path
 
 # ====== 設定 ======
-PROJECT_DIR = Path(r"C:\Projects\hospital-transfer-ui")
-DB_PATH     = PROJECT_DIR / "hospital_data.sqlite3"
-BACKUP_DIR  = PROJECT_DIR / "backup"
+PROJECT_DIR = Path(__file__).resolve().parent
+DB_PATH     = Path(os.environ.get("DATABASE_PATH", PROJECT_DIR / "hospital_data.sqlite3"))
+BACKUP_DIR  = Path(os.environ.get("BACKUP_DIR", PROJECT_DIR / "backup"))
 # 何時間より古いバックアップを自動削除するか（例: 72 = 3日保管）
-RETENTION_HOURS = 72
+RETENTION_HOURS = int(os.environ.get("BACKUP_RETENTION_HOURS", 72))
+# 1回にコピーするページ数と、その間の待ち時間（秒）
+BACKUP_PAGES = int(os.environ.get("BACKUP_PAGES", 256))
+BACKUP_SLEEP = float(os.environ.get("BACKUP_SLEEP", 0.005))
+# incremental をいくつ続けたら full を取り直すか
+FULL_EVERY = int(os.environ.get("BACKUP_FULL_EVERY", 24))
 # ==================
 
-def backup_sqlite(src: Path, dst_dir: Path) -> Path:
-    dst_dir.mkdir(parents=True, exist_ok=True)
-    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-    dst = dst_dir / f"hospital_data_{ts}.sqlite3"
+PREFIX = "hospital_data_"
+TIMESTAMP_FORMAT = "%Y%m%d_%H%M%S"
 
+# ============================================
+# スナップショット
+# ============================================
+
+def snapshot(src: Path, dst: Path, pages: int = BACKUP_PAGES, sleep: float = BACKUP_SLEEP) -> None:
+    """オンラインバックアップAPIでページ単位にコピー"""
     # SQLite のオンラインバックアップAPIで整合性あるコピーを作成
-    with sqlite3.connect(src) as src_con, sqlite3.connect(dst) as dst_con:
-        src_con.backup(dst_con)  # DB使用中でも安全にスナップショット取得
-    return dst
+    src_con = sqlite3.connect(src)
+    dst_con = sqlite3.connect(dst)
+    try:
+        src_con.backup(dst_con, pages=pages, sleep=sleep)  # DB使用中でも安全にスナップショット取得
+    finally:
+        dst_con.close()
+        src_con.close()
+
+def check_integrity(path: Path) -> str:
+    """PRAGMA integrity_check の結果（正常なら 'ok'）"""
+    con = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        rows = con.execute("PRAGMA integrity_check").fetchall()
+    finally:
+        con.close()
+    return "\n".join(row[0] for row in rows)
+
+def page_hashes(path: Path, page_size: int) -> list:
+    """ページごとのハッシュ"""
+    hashes = []
+    with open(path, "rb") as f:
+        while True:
+            page = f.read(page_size)
+            if not page:
+                break
+            hashes.append(hashlib.blake2b(page, digest_size=16).hexdigest())
+    return hashes
+
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _page_size(path: Path) -> int:
+    con = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        return con.execute("PRAGMA page_size").fetchone()[0]
+    finally:
+        con.close()
+
+# ============================================
+# バックアップ一覧（manifest）
+# ============================================
+
+def load_manifests(dst_dir: Path) -> list:
+    """バックアップの manifest を古い順に取得"""
+    manifests = []
+    for p in sorted(dst_dir.glob(f"{PREFIX}*.manifest.json")):
+        try:
+            manifests.append(json.loads(p.read_text(encoding="utf-8")))
+        except (OSError, ValueError):
+            continue
+    return manifests
+
+def find_manifest(dst_dir: Path, name: str = None) -> dict:
+    manifests = load_manifests(dst_dir)
+    if not manifests:
+        raise SystemExit(f"バックアップがありません: {dst_dir}")
+    if name is None:
+        return manifests[-1]
+    for m in manifests:
+        if m["name"] == name:
+            return m
+    raise SystemExit(f"バックアップが見つかりません: {name}")
+
+def chain(dst_dir: Path, manifest: dict) -> list:
+    """復元に必要なバックアップ（full から指定のバックアップまで）"""
+    by_name = {m["name"]: m for m in load_manifests(dst_dir)}
+    result = [manifest]
+    while result[0]["type"] == "incremental":
+        base = by_name.get(result[0]["base"])
+        if base is None:
+            raise SystemExit(f"元になるバックアップがありません: {result[0]['base']}")
+        result.insert(0, base)
+    return result
+
+# ============================================
+# バックアップ
+# ============================================
+
+def backup_sqlite(src: Path, dst_dir: Path, mode: str = "auto",
+                  pages: int = BACKUP_PAGES, sleep: float = BACKUP_SLEEP) -> dict:
+    """
+    バックアップを作成
+
+    Args:
+        mode: 'full' / 'incremental' / 'auto'（前回の full から FULL_EVERY 回までは incremental）
+
+    Returns:
+        作成したバックアップの manifest
+    """
+    dst_dir.mkdir(parents=True, exist_ok=True)
+    started = time.perf_counter()
+    ts = datetime.now().strftime(TIMESTAMP_FORMAT)
+    name = f"{PREFIX}{ts}"
+
+    manifests = load_manifests(dst_dir)
+    previous = manifests[-1] if manifests else None
+    if mode == "auto":
+        since_full = 0
+        for m in reversed(manifests):
+            if m["type"] == "full":
+                break
+            since_full += 1
+        mode = "incremental" if previous and since_full < FULL_EVERY else "full"
+    if mode == "incremental" and previous is None:
+        mode = "full"
+
+    with tempfile.TemporaryDirectory(dir=dst_dir) as workdir:
+        snap = Path(workdir) / "snapshot.sqlite3"
+        snapshot(src, snap, pages, sleep)
+
+        integrity = check_integrity(snap)
+        if integrity != "ok":
+            raise RuntimeError(f"integrity_check に失敗しました: {integrity}")
+
+        page_size = _page_size(snap)
+        hashes = page_hashes(snap, page_size)
+        if mode == "incremental" and previous["page_size"] != page_size:
+            mode = "full"
+
+        if mode == "full":
+            data_path = dst_dir / f"{name}.full.sqlite3.gz"
+            with open(snap, "rb") as f_in, gzip.open(f"{data_path}.tmp", "wb") as f_out:
+                shutil.copyfileobj(f_in, f_out, 1 << 20)
+            changed = len(hashes)
+        else:
+            # 前回から内容が変わったページのみ保存（ページ番号 + ページ内容）
+            old_hashes = previous["pages"]
+            data_path = dst_dir / f"{name}.incr.gz"
+            changed = 0
+            with open(snap, "rb") as f_in, gzip.open(f"{data_path}.tmp", "wb") as f_out:
+                for pgno, digest in enumerate(hashes):
+                    if pgno < len(old_hashes) and old_hashes[pgno] == digest:
+                        continue
+                    f_in.seek(pgno * page_size)
+                    f_out.write(struct.pack(">I", pgno))
+                    f_out.write(f_in.read(page_size))
+                    changed += 1
+
+        manifest = {
+            "name": name,
+            "type": mode,
+            "base": previous["name"] if mode == "incremental" else None,
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "source": str(src),
+            "file": data_path.name,
+            "page_size": page_size,
+            "page_count": len(hashes),
+            "changed_pages": changed,
+            "sha256": file_sha256(snap),
+            "integrity": integrity,
+            "pages": hashes,
+        }
+
+    # データ → manifest の順に確定（manifest があるバックアップのみ有効）
+    os.replace(f"{data_path}.tmp", data_path)
+    manifest["size_bytes"] = data_path.stat().st_size
+    manifest["elapsed_s"] = round(time.perf_counter() - started, 3)
+    manifest_path = dst_dir / f"{name}.manifest.json"
+    with open(f"{manifest_path}.tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(f"{manifest_path}.tmp", manifest_path)
+    return manifest
+
+# ============================================
+# 復元
+# ============================================
+
+def rebuild(dst_dir: Path, manifest: dict, out: Path) -> None:
+    """full と incremental を順に適用してDBファイルを作成し、検査する"""
+    steps = chain(dst_dir, manifest)
+    page_size = manifest["page_size"]
+
+    with open(out, "wb") as f_out:
+        with gzip.open(dst_dir / steps[0]["file"], "rb") as f_in:
+            shutil.copyfileobj(f_in, f_out, 1 << 20)
+
+    with open(out, "r+b") as f_out:
+        for step in steps[1:]:
+            record = 4 + page_size
+            with gzip.open(dst_dir / step["file"], "rb") as f_in:
+                while True:
+                    data = f_in.read(record)
+                    if not data:
+                        break
+                    if len(data) != record:
+                        raise RuntimeError(f"incremental が壊れています: {step['file']}")
+                    pgno = struct.unpack(">I", data[:4])[0]
+                    f_out.seek(pgno * page_size)
+                    f_out.write(data[4:])
+            f_out.truncate(step["page_count"] * page_size)
+
+    if file_sha256(out) != manifest["sha256"]:
+        raise RuntimeError(f"復元したファイルのハッシュが一致しません: {manifest['name']}")
+    integrity = check_integrity(out)
+    if integrity != "ok":
+        raise RuntimeError(f"integrity_check に失敗しました: {integrity}")
+
+def verify_backup(dst_dir: Path, name: str = None) -> dict:
+    """バックアップを一時ファイルに復元して検査"""
+    manifest = find_manifest(dst_dir, name)
+    with tempfile.TemporaryDirectory(dir=dst_dir) as workdir:
+        rebuild(dst_dir, manifest, Path(workdir) / "verify.sqlite3")
+    return manifest
+
+def restore_backup(dst_dir: Path, target: Path, name: str = None) -> dict:
+    """
+    バックアップから復元（検査後にファイルを置き換え）
+
+    置き換え前のDBは <target>.pre-restore として残します。
+    """
+    manifest = find_manifest(dst_dir, name)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp = target.with_name(f"{target.name}.restore-tmp")
+    try:
+        rebuild(dst_dir, manifest, tmp)
+        if target.exists():
+            shutil.copy2(target, target.with_name(f"{target.name}.pre-restore"))
+        # 古いDBのジャーナルが残っていると復元後のDBに適用されてしまうため削除
+        for suffix in ("-journal", "-wal", "-shm"):
+            stale = target.with_name(target.name + suffix)
+            if stale.exists():
+                stale.unlink()
+        os.replace(tmp, target)  # 同じディレクトリ内のため置き換えは一瞬で完了
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+    return manifest
+
+# ============================================
+# 古いバックアップの削除
+# ============================================
 
 def rotate_old_backups(dst_dir: Path, retention_hours: int) -> int:
+    """
+    保持期間を過ぎたバックアップを削除
+
+    full とそれに続く incremental はまとめて扱い、最も新しいものが保持期間を
+    過ぎた場合のみ削除します（最新の組は常に残します）。
+    """
     cutoff = datetime.now() - timedelta(hours=retention_hours)
+    groups = []
+    for m in load_manifests(dst_dir):
+        if m["type"] == "full" or not groups:
+            groups.append([])
+        groups[-1].append(m)
+
     removed = 0
-    for p in dst_dir.glob("hospital_data_*.sqlite3"):
+    for group in groups[:-1]:
+        if datetime.fromisoformat(group[-1]["created_at"]) >= cutoff:
+            continue
+        for m in group:
+            for filename in (m["file"], f"{m['name']}.manifest.json"):
+                try:
+                    (dst_dir / filename).unlink()
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+    # 以前の形式（圧縮なしのコピー）
+    for p in dst_dir.glob(f"{PREFIX}*.sqlite3"):
         if datetime.fromtimestamp(p.stat().st_mtime) < cutoff:
             try:
                 p.unlink()
@@ -34,15 +326,139 @@ def rotate_old_backups(dst_dir: Path, retention_hours: int) -> int:
                 pass
     return removed
 
-def main():
-    if not DB_PATH.exists():
-        raise SystemExit(f"DBが見つかりません: {DB_PATH}")
+# ============================================
+# アプリ内での定期実行
+# ============================================
+
+class BackupScheduler:
+    """
+    一定間隔でバックアップを作成するスレッド
+
+    最新のバックアップの作成時刻から間隔を判断するため、再起動や複数ワーカーでも
+    重複して作成しません（同時実行はロックファイルで防ぎます）。
+    """
+
+    def __init__(self, src: Path, dst_dir: Path, interval_minutes: int,
+                 retention_hours: int = RETENTION_HOURS, check_seconds: int = 60):
+        self.src = Path(src)
+        self.dst_dir = Path(dst_dir)
+        self.interval = timedelta(minutes=interval_minutes)
+        self.retention_hours = retention_hours
+        self.check_seconds = check_seconds
+        self.last_result = None
+        self._pid = None
+        self._stop = threading.Event()
+
+    def start(self):
+        """スレッドを開始（フォーク後のプロセスでは改めて開始）"""
+        if self._pid == os.getpid() or self.interval <= timedelta(0):
+            return
+        self._pid = os.getpid()
+        self._stop = threading.Event()
+        threading.Thread(target=self._run, name="backup-scheduler", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def due(self) -> bool:
+        manifests = load_manifests(self.dst_dir) if self.dst_dir.exists() else []
+        if not manifests:
+            return True
+        return datetime.now() - datetime.fromisoformat(manifests[-1]["created_at"]) >= self.interval
+
+    def _lock(self):
+        """ロックファイルを作成（1時間以上前のものは異常終了の残りとして扱う）"""
+        self.dst_dir.mkdir(parents=True, exist_ok=True)
+        path = self.dst_dir / ".backup.lock"
+        try:
+            if time.time() - path.stat().st_mtime > 3600:
+                path.unlink()
+        except FileNotFoundError:
+            pass
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return None
+        os.write(fd, str(os.getpid()).encode())
+        os.close(fd)
+        return path
+
+    def run_once(self):
+        lock = self._lock()
+        if lock is None:
+            return None
+        try:
+            if not self.due():
+                return None
+            manifest = backup_sqlite(self.src, self.dst_dir)
+            removed = rotate_old_backups(self.dst_dir, self.retention_hours)
+            self.last_result = {k: manifest[k] for k in ("name", "type", "changed_pages", "size_bytes", "elapsed_s")}
+            print(f"💾 バックアップ作成: {manifest['name']}（{manifest['type']}, "
+                  f"{manifest['changed_pages']}ページ, {manifest['elapsed_s']}秒, 削除 {removed}件）")
+            return manifest
+        finally:
+            lock.unlink()
+
+    def _run(self):
+        while not self._stop.wait(self.check_seconds):
+            try:
+                if self.due():
+                    self.run_once()
+            except Exception as e:
+                print(f"❌ バックアップエラー: {e}")
+
+# ============================================
+# コマンドライン
+# ============================================
+
+def print_list(dst_dir: Path) -> None:
+    for m in load_manifests(dst_dir):
+        base = f" ← {m['base']}" if m["base"] else ""
+        print(f"{m['name']}  {m['type']:<11} {m['changed_pages']:>7}/{m['page_count']} pages "
+              f"{m['size_bytes'] / 1024:>9.1f} KB  {m['created_at']}{base}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="データベースのバックアップ・復元")
+    parser.add_argument("--database", type=Path, default=DB_PATH, help="データベースファイル")
+    parser.add_argument("--backup-dir", type=Path, default=BACKUP_DIR, help="バックアップの保存先")
+    sub = parser.add_subparsers(dest="command")
+
+    p_backup = sub.add_parser("backup", help="バックアップを作成")
+    p_backup.add_argument("--mode", choices=("auto", "full", "incremental"), default="auto")
+    p_backup.add_argument("--retention-hours", type=int, default=RETENTION_HOURS)
+
+    sub.add_parser("list", help="バックアップの一覧")
+
+    p_verify = sub.add_parser("verify", help="バックアップを復元して検査")
+    p_verify.add_argument("name", nargs="?", help="バックアップ名（省略時は最新）")
+
+    p_restore = sub.add_parser("restore", help="バックアップから復元（アプリを停止してから実行）")
+    p_restore.add_argument("name", nargs="?", help="バックアップ名（省略時は最新）")
+    p_restore.add_argument("--target", type=Path, help="復元先（省略時は --database）")
+
+    args = parser.parse_args(argv)
+    command = args.command or "backup"
 
-    out = backup_sqlite(DB_PATH, BACKUP_DIR)
-    removed = rotate_old_backups(BACKUP_DIR, RETENTION_HOURS)
-    print(f"[OK] Backup: {out}")
-    if removed:
-        print(f"[INFO] 古いバックアップを {removed} 件削除しました（保持: {RETENTION_HOURS} 時間）")
+    if command == "backup":
+        if not args.database.exists():
+            raise SystemExit(f"DBが見つかりません: {args.database}")
+        mode = getattr(args, "mode", "auto")
+        retention = getattr(args, "retention_hours", RETENTION_HOURS)
+        m = backup_sqlite(args.database, args.backup_dir, mode)
+        removed = rotate_old_backups(args.backup_dir, retention)
+        print(f"[OK] Backup: {args.backup_dir / m['file']}（{m['type']}, {m['changed_pages']}/{m['page_count']}ページ, "
+              f"{m['size_bytes'] / 1024:.1f} KB, {m['elapsed_s']}秒）")
+        if removed:
+            print(f"[INFO] 古いバックアップを {removed} 件削除しました（保持: {retention} 時間）")
+    elif command == "list":
+        print_list(args.backup_dir)
+    elif command == "verify":
+        m = verify_backup(args.backup_dir, args.name)
+        print(f"[OK] Verified: {m['name']}（integrity_check: ok, sha256 一致）")
+    elif command == "restore":
+        target = args.target or args.database
+        m = restore_backup(args.backup_dir, target, args.name)
+        print(f"[OK] Restored: {m['name']} → {target}")
 
 if __name__ == "__main__":
     main()
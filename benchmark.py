@@ -0,0 +1,851 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+APIベンチマーク（負荷試験・マイクロベンチマーク）
+
+hospital_data.sqlite3 の一時コピーに対してアプリを起動し、実際のHTTP経由で
+ログイン・病院リスト・病院データ取得/保存・ロック取得/解放・履歴取得を
+混在させて負荷をかけます。結果はJSONで出力されるため、コミット間で比較できます。
+
+使い方:
+    python benchmark.py load --concurrency 8 --duration 30 --output bench_load.json
+    python benchmark.py micro --output bench_micro.json
+    python benchmark.py startup --workers 4 --output bench_startup.json
+    python benchmark.py bulk --records 1000 --output bench_bulk.json
+    python benchmark.py compare before.json after.json
+"""
+
+import argparse
+import contextlib
+import csv
+import glob
+import gzip
+import http.cookiejar
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+
+SOURCE_DATABASE = 'hospital_data.sqlite3'
+BENCH_PASSWORD = 'Bench@2024'
+
+# シナリオの重み（閲覧が大半、編集・履歴・ログインは少数）
+DEFAULT_MIX = {
+    'browse': 60,
+    'edit': 15,
+    'history': 15,
+    'login': 10,
+}
+
+# ============================================
+# 準備（一時DB・アプリ起動）
+# ============================================
+
+def prepare_database(source, workdir, users):
+    """
+    ベンチマーク用の一時DBを作成し、ベンチマークユーザーを登録
+
+    Args:
+        source: コピー元のDBファイル
+        workdir: 一時ディレクトリ
+        users: 作成するユーザー数
+    """
+    from werkzeug.security import generate_password_hash
+
+    db_path = os.path.join(workdir, 'hospital_data.sqlite3')
+
+    # オンラインバックアップAPIで整合性のあるコピーを作成
+    with sqlite3.connect(source) as src_con, sqlite3.connect(db_path) as dst_con:
+        src_con.backup(dst_con)
+
+    # スキーマを最新にする（login_history などを作成）
+    import migrations
+    migrations.upgrade(db_path)
+
+    conn = sqlite3.connect(db_path)
+    conn.execute('DELETE FROM locks')
+
+    # 全ユーザーで同じハッシュを使う（準備時間の短縮）
+    hashed_password = generate_password_hash(BENCH_PASSWORD)
+    usernames = [f'bench{i:03d}' for i in range(1, users + 1)]
+    for username in usernames:
+        conn.execute('''
+            INSERT OR REPLACE INTO users (username, password, email, role)
+            VALUES (?, ?, ?, ?)
+        ''', (username, hashed_password, f'{username}@bench.local', 'user'))
+    conn.commit()
+    conn.close()
+
+    return db_path, usernames
+
+def load_app(db_path):
+    """一時DBを指定してアプリを作成（app モジュールと Flask アプリを返す）"""
+    os.environ['DATABASE_PATH'] = db_path
+    os.environ.setdefault('SECRET_KEY', 'benchmark-secret-key')
+    # 少数のユーザーで大量に送るため、流量制限は行わない
+    os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+    import app as app_module
+    return app_module, app_module.create_app(database=db_path)
+
+def start_server(flask_app):
+    """ローカルのスレッド型WSGIサーバーを起動し、ベースURLを返す"""
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server('127.0.0.1', 0, flask_app, threaded=True, request_handler=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+def git_revision():
+    """現在のコミットID（取得できない場合はNone）"""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL, cwd=os.path.dirname(os.path.abspath(__file__))
+        ).decode().strip()
+    except Exception:
+        return None
+
+def environment_info():
+    return {
+        'commit': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+# ============================================
+# 集計
+# ============================================
+
+def percentile(sorted_values, pct):
+    """最近傍順位法によるパーセンタイル"""
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+def summarize(samples, elapsed):
+    """
+    レイテンシ（秒）のサンプルを集計
+
+    Args:
+        samples: (latency, ok, conflict) のリスト
+        elapsed: 計測時間（秒）
+    """
+    latencies = sorted(s[0] * 1000 for s in samples)
+    errors = sum(1 for s in samples if not s[1])
+    conflicts = sum(1 for s in samples if s[2])
+    count = len(samples)
+    return {
+        'requests': count,
+        'errors': errors,
+        'error_rate': round(errors / count, 6) if count else 0.0,
+        'conflicts': conflicts,
+        'throughput_rps': round(count / elapsed, 2) if elapsed else 0.0,
+        'latency_ms': {
+            'p50': _round(percentile(latencies, 50)),
+            'p95': _round(percentile(latencies, 95)),
+            'p99': _round(percentile(latencies, 99)),
+            'mean': _round(statistics.fmean(latencies)) if latencies else None,
+            'max': _round(latencies[-1]) if latencies else None,
+        },
+    }
+
+def _round(value):
+    return round(value, 3) if value is not None else None
+
+# ============================================
+# 仮想ユーザー
+# ============================================
+
+class VirtualUser:
+    """1人分のブラウザ（Cookieを保持してAPIを呼び出す）"""
+
+    def __init__(self, base_url, username, codes, prefectures, rng, recorder, accept_encoding=None):
+        self.base_url = base_url
+        self.accept_encoding = accept_encoding
+        self.username = username
+        self.codes = codes
+        self.prefectures = prefectures
+        self.rng = rng
+        self.recorder = recorder
+        self.opener = None
+
+    def _new_opener(self):
+        return urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar())
+        )
+
+    def _request(self, name, method, path, body=None, headers=None, opener=None, accept=(200,), conflict=()):
+        """リクエストを送信して計測結果を記録し、(status, body, final_url) を返す"""
+        headers = dict(headers or {})
+        if self.accept_encoding:
+            # 圧縮されたままのサイズで受信する（展開はしない）
+            headers['Accept-Encoding'] = self.accept_encoding
+        req = urllib.request.Request(self.base_url + path, data=body, method=method, headers=headers)
+        status, payload, final_url = None, b'', None
+        started = time.perf_counter()
+        try:
+            with (opener or self.opener).open(req, timeout=30) as resp:
+                status = resp.status
+                payload = resp.read()
+                final_url = resp.geturl()
+        except urllib.error.HTTPError as e:
+            status = e.code
+            payload = e.read()
+        except Exception:
+            status = None
+        latency = time.perf_counter() - started
+
+        is_conflict = status in conflict
+        ok = status in accept or is_conflict
+        self.recorder(name, latency, ok, is_conflict)
+        return status, payload, final_url
+
+    def _json(self, name, method, path, data=None, accept=(200,), conflict=()):
+        body = None
+        headers = {}
+        if data is not None:
+            body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        status, payload, _ = self._request(name, method, path, body, headers, accept=accept, conflict=conflict)
+        try:
+            if payload[:2] == b'\x1f\x8b':
+                payload = gzip.decompress(payload)
+            return status, json.loads(payload) if payload else None
+        except (ValueError, OSError):
+            return status, None
+
+    def login(self):
+        """ログイン（新しいセッションを作成）"""
+        opener = self._new_opener()
+        body = urllib.parse.urlencode({'username': self.username, 'password': BENCH_PASSWORD}).encode()
+        req = urllib.request.Request(self.base_url + '/login', data=body, method='POST',
+                                     headers={'Content-Type': 'application/x-www-form-urlencoded'})
+        started = time.perf_counter()
+        ok = False
+        try:
+            with opener.open(req, timeout=30) as resp:
+                resp.read()
+                # 失敗時はログイン画面が再表示される
+                ok = resp.status == 200 and not urllib.parse.urlparse(resp.geturl()).path.startswith('/login')
+        except Exception:
+            ok = False
+        self.recorder('login', time.perf_counter() - started, ok, False)
+        if ok:
+            self.opener = opener
+        return ok
+
+    def browse(self):
+        """都道府県を選んで病院リストを取得し、病院データを開く"""
+        prefecture = self.rng.choice(self.prefectures)
+        self._json('hospitals', 'GET', f'/api/hospitals?prefecture={prefecture}')
+        code = self.rng.choice(self.codes)
+        self._json('mdata_get', 'GET', f'/api/mdata/{urllib.parse.quote(code)}')
+
+    def edit(self):
+        """ロック取得 → データ取得 → 保存 → ロック解放"""
+        code = self.rng.choice(self.codes)
+        quoted = urllib.parse.quote(code)
+        status, _ = self._json('lock_acquire', 'POST', f'/api/lock/{quoted}', conflict=(409,))
+        if status != 200:
+            return
+        try:
+            status, result = self._json('mdata_get', 'GET', f'/api/mdata/{quoted}')
+            if status == 200 and result and result.get('kv'):
+                kv = result['kv']
+                # 備考欄を1箇所だけ書き換える（実際の編集に近い差分）
+                kv['備考_52'] = f'bench {self.username} {self.rng.randint(0, 999999)}'
+                self._json('mdata_post', 'POST', f'/api/mdata/{quoted}', {'kv': kv})
+        finally:
+            self._json('lock_release', 'DELETE', f'/api/lock/{quoted}')
+
+    def history(self):
+        """変更履歴一覧を取得"""
+        offset = self.rng.choice([0, 0, 0, 50])
+        self._json('history', 'GET', f'/api/history?limit=50&offset={offset}')
+
+    def run(self, deadline, mix):
+        if not self.login():
+            return
+        scenarios = list(mix.keys())
+        weights = list(mix.values())
+        while time.perf_counter() < deadline:
+            scenario = self.rng.choices(scenarios, weights)[0]
+            getattr(self, scenario)()
+
+# ============================================
+# 負荷試験
+# ============================================
+
+def load_test_data(db_path):
+    """対象となる病院コード・都道府県コードを取得"""
+    conn = sqlite3.connect(db_path)
+    codes = [r[0] for r in conn.execute('SELECT code FROM mdata ORDER BY code')]
+    prefectures = [r[0] for r in conn.execute(
+        'SELECT DISTINCT substr(code, 1, 2) FROM mdata ORDER BY 1')]
+    conn.close()
+    return codes, prefectures
+
+def parse_mix(text):
+    """'browse=60,edit=15' 形式のシナリオ比率を解析"""
+    if not text:
+        return dict(DEFAULT_MIX)
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in DEFAULT_MIX:
+            raise SystemExit(f'不明なシナリオ: {name}（利用可能: {", ".join(DEFAULT_MIX)}）')
+        mix[name] = float(weight)
+    return mix
+
+def run_load(args):
+    mix = parse_mix(args.mix)
+    workdir = tempfile.mkdtemp(prefix='hospital_bench_')
+    try:
+        db_path, usernames = prepare_database(args.database, workdir, args.concurrency)
+        codes, prefectures = load_test_data(db_path)
+        if not codes:
+            raise SystemExit('病院データがありません')
+
+        with _quiet(args.verbose):
+            app_module, flask_app = load_app(db_path)
+            server, base_url = start_server(flask_app)
+
+            samples = defaultdict(list)
+            lock = threading.Lock()
+            measuring = threading.Event()
+
+            def recorder(name, latency, ok, conflict):
+                if measuring.is_set():
+                    with lock:
+                        samples[name].append((latency, ok, conflict))
+
+            # ウォームアップ後に計測開始
+            started = time.perf_counter()
+            deadline = started + args.warmup + args.duration
+            users = [
+                VirtualUser(base_url, username, codes, prefectures, random.Random(args.seed + i), recorder,
+                            args.accept_encoding)
+                for i, username in enumerate(usernames)
+            ]
+            threads = [threading.Thread(target=u.run, args=(deadline, mix), daemon=True) for u in users]
+            for t in threads:
+                t.start()
+            time.sleep(args.warmup)
+            measuring.set()
+            measure_started = time.perf_counter()
+            for t in threads:
+                t.join()
+            elapsed = time.perf_counter() - measure_started
+            server.shutdown()
+
+        all_samples = [s for values in samples.values() for s in values]
+        report = {
+            'kind': 'load',
+            'meta': dict(environment_info(), **{
+                'database': os.path.abspath(args.database),
+                'hospitals': len(codes),
+                'concurrency': args.concurrency,
+                'duration_s': round(elapsed, 3),
+                'warmup_s': args.warmup,
+                'seed': args.seed,
+                'mix': mix,
+                'accept_encoding': args.accept_encoding,
+            }),
+            'summary': summarize(all_samples, elapsed),
+            'endpoints': {name: summarize(values, elapsed) for name, values in sorted(samples.items())},
+        }
+        write_report(report, args.output)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+# ============================================
+# マイクロベンチマーク
+# ============================================
+
+def find_csv():
+    candidates = sorted(glob.glob('csv*.csv'))
+    return candidates[0] if candidates else None
+
+def build_full_record(csv_filename):
+    """
+    CSVの全カラム（837列）を埋めたレコードを作成
+
+    各カラムにはCSV内で最初に見つかった値を使い、値がないカラムは仮の値で埋めます。
+    """
+    with open(csv_filename, 'r', encoding='utf-8-sig') as f:
+        reader = csv.reader(f)
+        header = [h.strip() for h in next(reader)]
+        record = {}
+        for row in reader:
+            for key, value in zip(header, row):
+                value = value.strip().lstrip("'")
+                if value and key not in record:
+                    record[key] = value
+            if len(record) == len(header):
+                break
+    return {key: record.get(key, f'{key}の値') for key in header}
+
+def time_call(func, number, repeat):
+    """関数を計測し、1回あたりのマイクロ秒を返す"""
+    timings = timeit.Timer(func).repeat(repeat=repeat, number=number)
+    per_call = sorted(t / number * 1e6 for t in timings)
+    return {
+        'number': number,
+        'repeat': repeat,
+        'best_us': round(per_call[0], 3),
+        'median_us': round(statistics.median(per_call), 3),
+    }
+
+def micro_benchmarks(app_module, record, number, repeat):
+    """マイクロベンチマーク一覧（名前 -> 計測対象の関数）"""
+    benches = {}
+
+    encoded = json.dumps(record, ensure_ascii=False)
+    benches['json_dumps_837'] = lambda: json.dumps(record, ensure_ascii=False)
+    benches['json_loads_837'] = lambda: json.loads(encoded)
+
+    for changes in (1, 10, 100):
+        changed = dict(record)
+        for key in list(record)[-changes:]:
+            changed[key] = record[key] + '更新'
+        benches[f'diff_fields_837_changed_{changes}'] = (
+            lambda old=record, new=changed: app_module.diff_fields(old, new))
+
+    sparse = {k: v for i, (k, v) in enumerate(record.items()) if i < 60}
+    sparse_changed = dict(sparse, **{'備考_1': '更新'})
+    benches['diff_fields_sparse_60'] = lambda: app_module.diff_fields(sparse, sparse_changed)
+
+    # 履歴・ログイン履歴: キューに積むだけ（async）と書き込み完了まで待つ場合（durable）
+    changed = dict(record, **{'備考_1': '更新'})
+    for mode, wait in (('', False), ('_durable', True)):
+        benches[f'record_history_837{mode}'] = (
+            lambda wait=wait: app_module.record_history('bench-00', 'update', record, changed, 1, 'bench', wait=wait))
+        benches[f'record_login_history{mode}'] = (
+            lambda wait=wait: app_module.record_login_history(1, 'bench', True, '127.0.0.1', 'bench', wait=wait))
+
+    for engine in available_json_engines():
+        benches.update(json_engine_benchmarks(engine, record))
+
+    results = {name: time_call(func, number, repeat) for name, func in benches.items()}
+    app_module.audit_log.flush()
+    return results
+
+def available_json_engines():
+    """インストール済みのJSONエンジン名"""
+    import json_engine
+
+    names = []
+    for name in ('stdlib', 'orjson', 'msgspec'):
+        try:
+            json_engine.load_engine(name)
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+def json_engine_benchmarks(name, record):
+    """
+    JSONエンジンごとの計測対象
+
+    save_request / read_request は、1回の保存・取得で行われるJSON処理
+    （リクエスト解析、kv保存、履歴の old/new/changed_fields、レスポンス生成）を再現します。
+    """
+    import json_engine
+
+    _, dumps_bytes, loads = json_engine.load_engine(name)
+    encoded = dumps_bytes(record)
+    body = dumps_bytes({'kv': record})
+    changed_fields = ['備考_1']
+
+    def save_request():
+        kv = loads(body)['kv']                      # request.json
+        dumps_bytes(kv)                             # mdata.kv
+        old_data = loads(encoded)                   # 既存データ
+        dumps_bytes(old_data)                       # history.old_data
+        dumps_bytes(kv)                             # history.new_data
+        dumps_bytes(changed_fields)                 # history.changed_fields
+        dumps_bytes({'ok': True, 'message': 'Data saved', 'updated': len(kv)}, sort_keys=True)
+
+    def read_request():
+        kv = loads(encoded)                         # mdata.kv
+        dumps_bytes({'ok': True, 'code': 'bench-00', 'kv': kv, 'updated_at': None}, sort_keys=True)
+
+    return {
+        f'json_{name}_dumps_837': lambda: dumps_bytes(record),
+        f'json_{name}_loads_837': lambda: loads(encoded),
+        f'json_{name}_save_request': save_request,
+        f'json_{name}_read_request': read_request,
+    }
+
+def json_engine_savings(results):
+    """標準jsonと比べた1リクエストあたりの短縮時間（マイクロ秒）"""
+    savings = {}
+    for kind in ('save_request', 'read_request'):
+        baseline = results.get(f'json_stdlib_{kind}')
+        if not baseline:
+            continue
+        for name in ('orjson', 'msgspec'):
+            measured = results.get(f'json_{name}_{kind}')
+            if measured:
+                saved = baseline['median_us'] - measured['median_us']
+                savings.setdefault(name, {})[kind] = {
+                    'saved_us': round(saved, 3),
+                    'speedup': round(baseline['median_us'] / measured['median_us'], 2),
+                }
+    return savings
+
+def audit_savings(results):
+    """監査ログの書き込みを待たないことによる1回あたりの短縮時間（マイクロ秒）"""
+    savings = {}
+    for name in ('record_history_837', 'record_login_history'):
+        queued, durable = results.get(name), results.get(f'{name}_durable')
+        if queued and durable:
+            savings[name] = {
+                'queued_us': queued['median_us'],
+                'durable_us': durable['median_us'],
+                'saved_us': round(durable['median_us'] - queued['median_us'], 3),
+            }
+    return savings
+
+def run_micro(args):
+    csv_filename = args.csv or find_csv()
+    if not csv_filename:
+        raise SystemExit('CSVファイルが見つかりません（--csv で指定してください）')
+
+    workdir = tempfile.mkdtemp(prefix='hospital_bench_')
+    try:
+        db_path, _ = prepare_database(args.database, workdir, 1)
+        record = build_full_record(csv_filename)
+        with _quiet(args.verbose):
+            app_module, _ = load_app(db_path)
+            results = micro_benchmarks(app_module, record, args.number, args.repeat)
+        report = {
+            'kind': 'micro',
+            'meta': dict(environment_info(), **{
+                'record_keys': len(record),
+                'record_bytes': len(json.dumps(record, ensure_ascii=False).encode('utf-8')),
+            }),
+            'benchmarks': results,
+            'json_engine_savings': json_engine_savings(results),
+            'audit_savings': audit_savings(results),
+        }
+        write_report(report, args.output)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+# ============================================
+# 一括更新（/api/mdata/bulk）
+# ============================================
+
+BULK_FIELD = '備考_1'
+
+def _bulk_single(client, codes, value):
+    """1件ずつ: ロック取得 → 取得 → 保存 → ロック解放"""
+    for code in codes:
+        client.post(f'/api/lock/{code}')
+        kv = client.get(f'/api/mdata/{code}').get_json()['kv']
+        kv[BULK_FIELD] = value
+        client.post(f'/api/mdata/{code}', json={'kv': kv})
+        client.delete(f'/api/lock/{code}')
+
+def _bulk_request(client, codes, value):
+    """一括更新: 1リクエスト"""
+    updates = [{'code': code, 'set': {BULK_FIELD: value}} for code in codes]
+    r = client.post('/api/mdata/bulk', json={'updates': updates})
+    summary = r.get_json()['summary']
+    if summary.get('updated') != len(codes):
+        raise RuntimeError(f'一括更新の結果が想定と異なります: {summary}')
+
+def bulk_benchmarks(app_module, flask_app, username, records, repeat):
+    client = flask_app.test_client()
+    r = client.post('/login', data={'username': username, 'password': BENCH_PASSWORD})
+    if r.status_code != 302:
+        raise RuntimeError(f'ログインに失敗しました: {r.status_code}')
+
+    conn = app_module.get_db_connection()
+    codes = [row['code'] for row in conn.execute('SELECT code FROM mdata ORDER BY code LIMIT ?', (records,))]
+    conn.close()
+
+    results = {}
+    for name, func in (('single', _bulk_single), ('bulk', _bulk_request)):
+        timings = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            func(client, codes, f'bench-{name}-{i}')
+            # 履歴の書き込みが終わるまでを含める
+            app_module.audit_log.flush()
+            timings.append(time.perf_counter() - start)
+        timings.sort()
+        median = statistics.median(timings)
+        results[name] = {
+            'records': len(codes),
+            'repeat': repeat,
+            'best_s': round(timings[0], 3),
+            'median_s': round(median, 3),
+            'records_per_s': round(len(codes) / median, 1),
+        }
+    results['speedup'] = round(results['single']['median_s'] / results['bulk']['median_s'], 1)
+    return results
+
+def run_bulk(args):
+    workdir = tempfile.mkdtemp(prefix='hospital_bench_')
+    try:
+        db_path, usernames = prepare_database(args.database, workdir, 1)
+        with _quiet(args.verbose):
+            app_module, flask_app = load_app(db_path)
+            results = bulk_benchmarks(app_module, flask_app, usernames[0], args.records, args.repeat)
+        report = {
+            'kind': 'bulk',
+            'meta': dict(environment_info(), **{'records': args.records, 'repeat': args.repeat}),
+            'results': results,
+        }
+        write_report(report, args.output)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+# ============================================
+# 起動時間・メモリ（gunicorn）
+# ============================================
+
+# (名前, WSGIアプリ, --preload)
+STARTUP_MODES = (
+    ('lazy', 'app:create_app()', False),  # 各ワーカーがアプリを作成し、初回リクエストで一覧を作成
+    ('preload', 'wsgi:app', True),         # フォーク前に読み込み・warmup()
+)
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def _memory(pid):
+    """プロセスのメモリ（KB）: RSS / PSS（共有ページを按分）/ 共有 / 専有"""
+    values = {}
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2 and parts[1].isdigit():
+                    values[parts[0].rstrip(':')] = int(parts[1])
+    except OSError:
+        return None
+    return {
+        'rss_kb': values.get('Rss', 0),
+        'pss_kb': values.get('Pss', 0),
+        'shared_kb': values.get('Shared_Clean', 0) + values.get('Shared_Dirty', 0),
+        'private_kb': values.get('Private_Clean', 0) + values.get('Private_Dirty', 0),
+    }
+
+def _children(pid):
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            return [int(p) for p in f.read().split()]
+    except OSError:
+        return []
+
+def measure_startup(db_path, username, target, preload, workers, requests_per_worker, timeout=60):
+    """gunicorn を起動し、最初のリクエストまでの時間・初回リクエストの遅延・メモリを計測"""
+    port = _free_port()
+    base_url = f'http://127.0.0.1:{port}'
+    command = [sys.executable, '-m', 'gunicorn', target,
+               '--workers', str(workers), '--worker-class', 'gthread', '--threads', '8',
+               '--bind', f'127.0.0.1:{port}', '--chdir', os.path.dirname(os.path.abspath(__file__))]
+    if preload:
+        command.append('--preload')
+    env = dict(os.environ, DATABASE_PATH=db_path, SOCKETIO_ASYNC_MODE='threading')
+    env.setdefault('RATE_LIMIT_ENABLED', '0')
+
+    started = time.perf_counter()
+    proc = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        # 最初の応答まで
+        first_response = None
+        while time.perf_counter() - started < timeout:
+            try:
+                with urllib.request.urlopen(base_url + '/api/health', timeout=5) as resp:
+                    if resp.status == 200:
+                        first_response = time.perf_counter() - started
+                        break
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.01)
+        if first_response is None:
+            raise SystemExit(f'gunicorn が起動しませんでした: {" ".join(command)}')
+
+        # 全ワーカーが起動するまで待ってから計測（新しい接続ごとに空いているワーカーが受け付ける）
+        while len(_children(proc.pid)) < workers and time.perf_counter() - started < timeout:
+            time.sleep(0.01)
+
+        latencies = []
+        user = VirtualUser(base_url, username, [], [], random.Random(0),
+                           lambda name, latency, ok, conflict: latencies.append((name, latency, ok)))
+        if not user.login():
+            raise SystemExit('ベンチマークユーザーでログインできません')
+        for i in range(workers * requests_per_worker):
+            user._json('hospitals', 'GET', '/api/hospitals?prefecture=13')
+        hospital_latencies = [latency * 1000 for name, latency, ok in latencies if name == 'hospitals' and ok]
+
+        worker_memory = [m for m in (_memory(pid) for pid in _children(proc.pid)) if m]
+        return {
+            'first_response_ms': round(first_response * 1000, 1),
+            'hospitals_first_ms': _round(hospital_latencies[0]) if hospital_latencies else None,
+            'hospitals_max_ms': _round(max(hospital_latencies)) if hospital_latencies else None,
+            'hospitals_p50_ms': _round(statistics.median(hospital_latencies)) if hospital_latencies else None,
+            'master': _memory(proc.pid),
+            'workers': len(worker_memory),
+            'worker_mean': {key: round(statistics.mean(m[key] for m in worker_memory))
+                            for key in worker_memory[0]} if worker_memory else None,
+            'total_pss_kb': sum(m['pss_kb'] for m in worker_memory) + ((_memory(proc.pid) or {}).get('pss_kb', 0)),
+        }
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+def run_startup(args):
+    workdir = tempfile.mkdtemp(prefix='hospital_bench_')
+    try:
+        db_path, usernames = prepare_database(args.database, workdir, 1)
+        results = {}
+        for name, target, preload in STARTUP_MODES:
+            runs = [measure_startup(db_path, usernames[0], target, preload, args.workers, args.requests)
+                    for _ in range(args.repeat)]
+            # first_response_ms の中央値の回を採用
+            runs.sort(key=lambda r: r['first_response_ms'])
+            results[name] = dict(runs[len(runs) // 2], first_response_all_ms=[r['first_response_ms'] for r in runs])
+        report = {
+            'kind': 'startup',
+            'meta': dict(environment_info(), **{'workers': args.workers, 'repeat': args.repeat}),
+            'modes': results,
+        }
+        write_report(report, args.output)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+# ============================================
+# 比較・出力
+# ============================================
+
+def write_report(report, output):
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+        print(f'✅ ベンチマーク結果を保存しました: {output}')
+    else:
+        print(text)
+
+def run_compare(args):
+    """2つの結果ファイルを比較して差分を表示"""
+    with open(args.before, encoding='utf-8') as f:
+        before = json.load(f)
+    with open(args.after, encoding='utf-8') as f:
+        after = json.load(f)
+
+    rows = []
+    if before.get('kind') == 'micro':
+        for name, b in before['benchmarks'].items():
+            a = after.get('benchmarks', {}).get(name)
+            if a:
+                rows.append((name, 'median_us', b['median_us'], a['median_us']))
+    else:
+        for name, b in before.get('endpoints', {}).items():
+            a = after.get('endpoints', {}).get(name)
+            if not a:
+                continue
+            for pct in ('p50', 'p95', 'p99'):
+                rows.append((name, pct, b['latency_ms'][pct], a['latency_ms'][pct]))
+            rows.append((name, 'rps', b['throughput_rps'], a['throughput_rps']))
+
+    print(f'{"name":32} {"metric":10} {"before":>12} {"after":>12} {"change":>9}')
+    for name, metric, b, a in rows:
+        change = f'{(a - b) / b * 100:+.1f}%' if b else '-'
+        print(f'{name:32} {metric:10} {b:>12} {a:>12} {change:>9}')
+
+@contextlib.contextmanager
+def _quiet(verbose):
+    """アプリのログ出力を抑制（計測への影響を減らす）"""
+    if verbose:
+        yield
+        return
+    with contextlib.redirect_stdout(io.StringIO()) as buf:
+        yield
+    buf.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='病院情報管理システム ベンチマーク')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    load = sub.add_parser('load', help='HTTP負荷試験')
+    load.add_argument('--database', default=SOURCE_DATABASE, help='コピー元のDB')
+    load.add_argument('--concurrency', type=int, default=8, help='同時ユーザー数')
+    load.add_argument('--duration', type=float, default=20.0, help='計測時間（秒）')
+    load.add_argument('--warmup', type=float, default=2.0, help='ウォームアップ時間（秒）')
+    load.add_argument('--mix', help='シナリオ比率（例: browse=60,edit=15,history=15,login=10）')
+    load.add_argument('--seed', type=int, default=42)
+    load.add_argument('--accept-encoding', help='送信する Accept-Encoding（例: gzip）')
+    load.add_argument('--output', help='結果JSONの保存先（省略時は標準出力）')
+    load.add_argument('--verbose', action='store_true', help='アプリのログを表示')
+    load.set_defaults(func=run_load)
+
+    micro = sub.add_parser('micro', help='マイクロベンチマーク')
+    micro.add_argument('--database', default=SOURCE_DATABASE, help='コピー元のDB')
+    micro.add_argument('--csv', help='837列のCSVファイル')
+    micro.add_argument('--number', type=int, default=200, help='1回の計測での実行回数')
+    micro.add_argument('--repeat', type=int, default=5, help='計測の繰り返し回数')
+    micro.add_argument('--output', help='結果JSONの保存先（省略時は標準出力）')
+    micro.add_argument('--verbose', action='store_true', help='アプリのログを表示')
+    micro.set_defaults(func=run_micro)
+
+    startup = sub.add_parser('startup', help='gunicorn の起動時間・ワーカーのメモリ（lazy / preload）')
+    startup.add_argument('--database', default=SOURCE_DATABASE, help='コピー元のDB')
+    startup.add_argument('--workers', type=int, default=4, help='ワーカー数')
+    startup.add_argument('--requests', type=int, default=5, help='ワーカーあたりの病院リスト取得回数')
+    startup.add_argument('--repeat', type=int, default=3, help='起動の繰り返し回数')
+    startup.add_argument('--output', help='結果JSONの保存先（省略時は標準出力）')
+    startup.set_defaults(func=run_startup)
+
+    bulk = sub.add_parser('bulk', help='一括更新と1件ずつの保存の比較')
+    bulk.add_argument('--database', default=SOURCE_DATABASE, help='コピー元のDB')
+    bulk.add_argument('--records', type=int, default=1000, help='更新する病院数')
+    bulk.add_argument('--repeat', type=int, default=3, help='計測の繰り返し回数')
+    bulk.add_argument('--output', help='結果JSONの保存先（省略時は標準出力）')
+    bulk.add_argument('--verbose', action='store_true', help='アプリのログを表示')
+    bulk.set_defaults(func=run_bulk)
+
+    compare = sub.add_parser('compare', help='2つの結果を比較')
+    compare.add_argument('before')
+    compare.add_argument('after')
+    compare.set_defaults(func=run_compare)
+
+    args = parser.parse_args(argv)
+    if getattr(args, 'database', None) and not os.path.exists(args.database):
+        raise SystemExit(f'DBが見つかりません: {args.database}')
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
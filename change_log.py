@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+mdata の変更の記録（連番）
+
+mdata への INSERT / UPDATE / DELETE のたびにトリガーで mdata_changes に
+病院コードを記録します。各ワーカーのメモリ上のインデックス（similarity.py など）や
+ブラウザのキャッシュ（app.py の /api/changes）は最後に読んだ連番を覚えておき、
+それより後に変更された病院だけを読み込み直します。
+
+記録は CHANGE_LOG_KEEP 件を超えると古いものから削除されます（トリガー内）。
+読み込んだ連番の直後の記録がすでに削除されている場合（expired）は、
+全件を読み込み直してください。
+"""
+
+import os
+
+# 保持する変更の記録の件数（トリガーの作成時に使用）
+CHANGE_LOG_KEEP = int(os.environ.get('CHANGE_LOG_KEEP', 100000))
+
+def ensure_tables(conn, keep=CHANGE_LOG_KEEP):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS mdata_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            code TEXT NOT NULL
+        )
+    ''')
+    prune = f'DELETE FROM mdata_changes WHERE seq <= (SELECT MAX(seq) FROM mdata_changes) - {int(keep)};'
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS mdata_changes_insert AFTER INSERT ON mdata
+        BEGIN
+            INSERT INTO mdata_changes (code) VALUES (NEW.code);
+            {prune}
+        END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS mdata_changes_update AFTER UPDATE OF code, kv ON mdata
+        BEGIN
+            INSERT INTO mdata_changes (code) VALUES (OLD.code);
+            INSERT INTO mdata_changes (code) SELECT NEW.code WHERE NEW.code IS NOT OLD.code;
+            {prune}
+        END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS mdata_changes_delete AFTER DELETE ON mdata
+        BEGIN
+            INSERT INTO mdata_changes (code) VALUES (OLD.code);
+            {prune}
+        END
+    ''')
+
+def latest_seq(conn):
+    """最新の連番（記録がない場合は 0）"""
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'mdata_changes'").fetchone()
+    return row[0] if row else 0
+
+def changed_since(conn, seq):
+    """
+    連番 seq より後に変更された病院コード
+
+    Returns:
+        (病院コードの集合, 最新の連番, expired)
+        expired が True の場合は記録が削除済み（またはDBが置き換えられた）ため、
+        全件を読み込み直す
+    """
+    latest = latest_seq(conn)
+    if latest == seq:
+        return set(), seq, False
+    if latest < seq:
+        # バックアップからの復元などで連番が戻った
+        return set(), latest, True
+    codes = {row[0] for row in conn.execute('SELECT code FROM mdata_changes WHERE seq > ? AND seq <= ?',
+                                            (seq, latest))}
+    # 読み込んだ後に確認（読み込み中に削除された場合も expired になる）
+    first = conn.execute('SELECT MIN(seq) FROM mdata_changes').fetchone()[0]
+    if first is None or first > seq + 1:
+        return set(), latest, True
+    return codes, latest, False
+
+def first_seq(conn):
+    """保持している最も古い連番（記録がない場合は None）"""
+    return conn.execute('SELECT MIN(seq) FROM mdata_changes').fetchone()[0]
+
+def compacted_since(conn, seq, limit):
+    """
+    連番 seq より後に変更された病院（病院ごとに最後の連番のみ、連番の順に limit 件）
+
+    同じ病院が何回変更されても1件にまとめます。最後の連番の順に返すため、
+    返した最後の連番を次の seq にすれば、残りの病院は次の呼び出しで返ります。
+    同じトランザクションで mdata を読むと、返した連番の時点の内容になります。
+
+    Returns:
+        ([(病院コード, 連番)], 最新の連番, expired)
+    """
+    latest = latest_seq(conn)
+    if seq > latest:
+        # バックアップからの復元などで連番が戻った
+        return [], latest, True
+    if seq == latest:
+        return [], latest, False
+    first = first_seq(conn)
+    if first is None or first > seq + 1:
+        return [], latest, True
+    rows = conn.execute('''
+        SELECT code, MAX(seq) AS last_seq FROM mdata_changes
+        WHERE seq > ?
+        GROUP BY code
+        ORDER BY last_seq
+        LIMIT ?
+    ''', (seq, limit)).fetchall()
+    return [(row[0], row[1]) for row in rows], latest, False
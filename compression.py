@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+HTTPレスポンスの圧縮（gzip / brotli）
+
+Accept-Encoding に応じて、一定サイズ以上のJSONレスポンスを圧縮します。
+brotli がインストールされていれば br を優先し、なければ gzip を使います。
+
+    COMPRESS_MIN_SIZE   圧縮する最小サイズ（バイト、既定: 1024）
+    COMPRESS_LEVEL      gzip の圧縮レベル（既定: 6）
+    BROTLI_QUALITY      brotli の品質（既定: 5）
+
+    pip install brotli   # 任意
+"""
+
+import gzip
+import os
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL', 6))
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', 5))
+
+COMPRESSIBLE_MIMETYPES = {'application/json'}
+
+def available_encodings():
+    """サーバー側で対応している圧縮形式（優先順）"""
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+def negotiate(accept_encoding, available=None):
+    """
+    Accept-Encoding ヘッダーから使用する圧縮形式を決める
+
+    Args:
+        accept_encoding: リクエストの Accept-Encoding
+        available: サーバー側で用意できる形式（優先順）
+
+    Returns:
+        'br' / 'gzip' / None（圧縮しない）
+    """
+    if not accept_encoding:
+        return None
+    if available is None:
+        available = available_encodings()
+
+    accepted = {}
+    for part in accept_encoding.split(','):
+        name, _, params = part.strip().partition(';')
+        name = name.strip().lower()
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name] = q
+
+    wildcard = accepted.get('*')
+    best, best_q = None, 0.0
+    for encoding in available:
+        q = accepted.get(encoding, wildcard if wildcard is not None else 0.0)
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+def compress(data, encoding, level=None):
+    """指定の形式で圧縮"""
+    if encoding == 'br':
+        return brotli.compress(data, quality=level if level is not None else BROTLI_QUALITY)
+    if encoding == 'gzip':
+        # mtime=0 で同じ入力から同じ出力を得る（ETagを安定させる）
+        return gzip.compress(data, compresslevel=level if level is not None else COMPRESS_LEVEL, mtime=0)
+    raise ValueError(f'Unsupported encoding: {encoding}')
+
+def compress_response(response):
+    """after_request: 大きなJSONレスポンスを圧縮"""
+    if (response.mimetype not in COMPRESSIBLE_MIMETYPES
+            or response.direct_passthrough
+            or response.status_code < 200
+            or response.status_code in (204, 206, 304)
+            or 'Content-Encoding' in response.headers):
+        return response
+
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate(request.headers.get('Accept-Encoding', ''))
+    if not encoding:
+        return response
+
+    response.set_data(compress(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+def init_app(app):
+    """Flaskアプリにレスポンス圧縮を登録"""
+    app.after_request(compress_response)
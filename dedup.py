@@ -0,0 +1,439 @@
+# -*- coding: utf-8 -*-
+"""
+重複・ほぼ重複した病院データの検出
+
+地域ごとのCSVを取り込むと、同じ病院が別の病院コードで登録されることがあります。
+全件の組み合わせ（n²）は比較せず、次のブロッキングキーが一致する病院どうしだけを
+比較します。
+
+    tel:   電話番号（数字のみ）
+    pc:    郵便番号（7桁）
+    name:  病院名（法人格・「病院」などを除いた部分）の3文字の組（出現数の少ないもの）
+
+1つのキーに DEDUP_MAX_BLOCK 件を超える病院がある場合は、病院名の順に並べて
+前後 DEDUP_WINDOW 件とだけ比較します（ソート済み近傍法）。
+
+候補の組は 電話番号・郵便番号・病院名・住所 の一致度を重み付けして 0〜1 の点数にし
+（両方に値がある項目のみ）、DEDUP_THRESHOLD 以上の組を重複の候補として返します。
+統合（merge）は app.py の /api/dedup/merge で行います（履歴記録付き）。
+
+使い方:
+    python dedup.py scan --output dedup_report.csv
+    python dedup.py scan --threshold 0.7 --output dedup_report.json
+"""
+
+import argparse
+import codecs
+import csv
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import Counter, defaultdict
+from itertools import chain, combinations
+
+import json_engine
+import storage_codec
+
+DB_PATH = os.environ.get('DATABASE_PATH', 'hospital_data.sqlite3')
+
+DEDUP_THRESHOLD = float(os.environ.get('DEDUP_THRESHOLD', 0.75))
+DEDUP_MAX_BLOCK = int(os.environ.get('DEDUP_MAX_BLOCK', 50))
+DEDUP_WINDOW = int(os.environ.get('DEDUP_WINDOW', 5))
+
+# 点数の重み（両方に値がある項目だけで合計を1にする）
+WEIGHTS = {
+    'tel': 0.35,
+    'postcode': 0.15,
+    'name': 0.3,
+    'address': 0.2,
+}
+
+# 病院名の比較で除く語（長いものから順に）
+NAME_STOPWORDS = (
+    '地方独立行政法人', '独立行政法人', '国立病院機構', '社会医療法人', '医療法人社団', '医療法人財団',
+    '一般財団法人', '公益財団法人', '社会福祉法人', '医療法人', '医療センター', '総合病院',
+    'クリニック', '診療所', '病院', '医院',
+)
+NAME_STOPWORDS_RE = re.compile('|'.join(map(re.escape, NAME_STOPWORDS)))
+
+# 住所の表記ゆれ（丁目・番地・号 → ハイフン）
+ADDRESS_RE = re.compile(r'丁目|番地|番|号|の')
+DASH_RE = re.compile(r'[‐－―ー−]')
+
+# 1件の病院の病院名のキーの数（出現数の少ない組から）
+NAME_KEYS = 3
+
+FIELDS = ('病院名', 'TEL', '郵便番号', '住所')
+
+# 列の値をまとめて正規化する際の区切り（空白ではなく、NFKC・正規表現で変わらない文字）
+SEP = '\x00'
+SPACE_RE = re.compile(r'\s+')
+NON_DIGIT_RE = re.compile(r'[^0-9\x00]')
+
+def _column_text(values):
+    """
+    値の列を1つの文字列にして NFKC 正規化・小文字化
+
+    10万件を1件ずつ正規化するより、まとめて1回で処理したほうが大幅に速いため、
+    正規化はすべて列単位で行います。
+    """
+    text = SEP.join('' if value is None else str(value).replace(SEP, '') for value in values)
+    return unicodedata.normalize('NFKC', text).lower()
+
+def normalize_tels(values):
+    digits = NON_DIGIT_RE.sub('', _column_text(values)).split(SEP)
+    # 市外局番からの番号のみ（内線・短い番号は使わない）
+    return [tel if len(tel) >= 9 else '' for tel in digits]
+
+def normalize_postcodes(values):
+    digits = NON_DIGIT_RE.sub('', _column_text(values)).split(SEP)
+    return [postcode if len(postcode) == 7 else '' for postcode in digits]
+
+def normalize_names(values):
+    """病院名（空白を除く）"""
+    return SPACE_RE.sub('', _column_text(values)).split(SEP)
+
+def name_cores(names):
+    """法人格・「病院」などを除いた病院名（除くと空になる場合は病院名のまま）"""
+    cores = NAME_STOPWORDS_RE.sub('', SEP.join(names)).split(SEP)
+    return [core or name for core, name in zip(cores, names)]
+
+def normalize_addresses(values):
+    text = ADDRESS_RE.sub('-', DASH_RE.sub('-', SPACE_RE.sub('', _column_text(values))))
+    return [address.strip('-') for address in text.split(SEP)]
+
+def ngrams(text, n):
+    if len(text) <= n:
+        return {text} if text else set()
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+def dice(a, b):
+    if not a or not b:
+        return 0.0
+    return 2 * len(a & b) / (len(a) + len(b))
+
+class Record:
+    """比較用に正規化した病院データ"""
+
+    __slots__ = ('code', 'raw', 'name', 'tel', 'postcode', 'address', 'core', '_name_grams', '_address_grams')
+
+    def __init__(self, code, raw, name, tel, postcode, address, core):
+        self.code = code
+        self.raw = raw
+        self.name = name
+        self.tel = tel
+        self.postcode = postcode
+        self.address = address
+        self.core = core
+        self._name_grams = None
+        self._address_grams = None
+
+    def summary(self):
+        return {field: self.raw.get(field, '') for field in FIELDS}
+
+    # 2文字の組は点数の打ち切りに残った組の病院だけ使うため、必要になったときに作成
+    @property
+    def name_grams(self):
+        if self._name_grams is None:
+            self._name_grams = ngrams(self.name, 2)
+        return self._name_grams
+
+    @property
+    def address_grams(self):
+        if self._address_grams is None:
+            self._address_grams = ngrams(self.address, 2)
+        return self._address_grams
+
+def load_records(conn, codec):
+    rows = list(storage_codec.select_fields(conn, codec, FIELDS, 'ORDER BY code'))
+    if not rows:
+        return []
+    column = lambda field: [data.get(field) for _, data in rows]
+    names = normalize_names(column('病院名'))
+    return list(map(Record, (code for code, _ in rows), (data for _, data in rows), names,
+                    normalize_tels(column('TEL')), normalize_postcodes(column('郵便番号')),
+                    normalize_addresses(column('住所')), name_cores(names)))
+
+def blocking_keys(records, others=True):
+    """
+    各病院のブロッキングキー（others が False の場合は電話番号のみ）
+
+    病院名の3文字の組は多くの病院に含まれるもの（「総合病」など）ほど候補が増えるため、
+    出現数の少ない NAME_KEYS 個だけを使います（表記ゆれがあっても、ほぼ同じ名前なら
+    少なくとも1つは共通する組が残ります）。
+    """
+    if not others:
+        for record in records:
+            yield ['tel:' + record.tel] if record.tel else []
+        return
+
+    grams = [ngrams(record.core, 3) for record in records]
+    counts = Counter(chain.from_iterable(grams))
+
+    for record, record_grams in zip(records, grams):
+        keys = []
+        if record.tel:
+            keys.append('tel:' + record.tel)
+        if record.postcode:
+            keys.append('pc:' + record.postcode)
+        # 出現数の少ない順（同数は文字列順）
+        rare = sorted(sorted(record_grams), key=counts.__getitem__)[:NAME_KEYS]
+        keys.extend('name:' + gram for gram in rare)
+        yield keys
+
+def candidate_pairs(records, max_block=DEDUP_MAX_BLOCK, window=DEDUP_WINDOW, threshold=0.0, stats=None):
+    """
+    比較する組（records の添字 (i, j)、i < j）
+
+    threshold が 1 - WEIGHTS['tel'] より大きい場合、電話番号が異なる組は他の項目が
+    すべて一致しても届かないため、郵便番号・病院名のブロックでは電話番号のない病院を
+    含む組だけ比較します（電話番号が同じ組は tel のブロックで比較済み）。
+    全病院に電話番号がある場合は tel のブロックだけを作ります。
+
+    Args:
+        threshold: 点数の閾値
+        stats: 辞書を渡すと 'blocks' / 'large_blocks' / 'pairs' を記録
+    """
+    tel_decides = threshold > 1 - WEIGHTS['tel']
+    others = not tel_decides or not all(record.tel for record in records)
+    blocks = defaultdict(list)
+    for i, keys in enumerate(blocking_keys(records, others)):
+        for key in keys:
+            blocks[key].append(i)
+
+    pairs = set()
+    large = 0
+    rank = None
+    for key, members in blocks.items():
+        size = len(members)
+        if size < 2:
+            continue
+        if size > max_block:
+            # ソート済み近傍法（病院名の順で前後 window 件のみ）
+            large += 1
+            if rank is None:
+                rank = [0] * len(records)
+                for position, m in enumerate(sorted(range(len(records)), key=lambda m: (records[m].core, m))):
+                    rank[m] = position
+            members = sorted(members, key=rank.__getitem__)
+
+        if tel_decides and not key.startswith('tel:'):
+            # 電話番号のない病院を含む組だけ
+            for position, i in enumerate(members):
+                if records[i].tel:
+                    continue
+                neighbours = members if size <= max_block else \
+                    members[max(0, position - window):position + window + 1]
+                pairs.update((i, j) if i < j else (j, i) for j in neighbours if j != i)
+        elif size <= max_block:
+            # members は添字の昇順
+            pairs.update(combinations(members, 2))
+        else:
+            for offset in range(1, window + 1):
+                pairs.update((i, j) if i < j else (j, i) for i, j in zip(members, members[offset:]))
+
+    if stats is not None:
+        stats['blocks'] = sum(1 for members in blocks.values() if len(members) > 1)
+        stats['large_blocks'] = large
+        stats['pairs'] = len(pairs)
+    return pairs
+
+def score(a, b, threshold=0.0):
+    """
+    2つの病院の一致度
+
+    Args:
+        threshold: 残りの項目がすべて一致しても届かないと分かった時点で打ち切る
+                   （打ち切った場合の項目ごとの一致度は空）
+
+    Returns:
+        (点数 0〜1, {項目: 一致度})
+    """
+    if not a.name or not b.name:
+        # 病院名がない場合は判定しない
+        return 0.0, {}
+    has_tel = bool(a.tel and b.tel)
+    has_postcode = bool(a.postcode and b.postcode)
+    has_address = bool(a.address and b.address)
+    total = WEIGHTS['name']
+    partial = 0.0
+    if has_tel:
+        total += WEIGHTS['tel']
+        if a.tel == b.tel:
+            partial += WEIGHTS['tel']
+    if has_postcode:
+        total += WEIGHTS['postcode']
+        if a.postcode == b.postcode:
+            partial += WEIGHTS['postcode']
+    if has_address:
+        total += WEIGHTS['address']
+    if total < 0.5:
+        # 比較できる項目が少ない
+        return 0.0, {}
+    # 病院名・住所が一致しても届かない組（電話番号が異なる組の大半）は比較しない
+    if (partial + total - WEIGHTS['tel'] * has_tel - WEIGHTS['postcode'] * has_postcode) / total < threshold:
+        return partial / total, {}
+
+    scores = {}
+    if has_tel:
+        scores['tel'] = 1.0 if a.tel == b.tel else 0.0
+    if has_postcode:
+        scores['postcode'] = 1.0 if a.postcode == b.postcode else 0.0
+    scores['name'] = 1.0 if a.name == b.name else dice(a.name_grams, b.name_grams)
+    partial += WEIGHTS['name'] * scores['name']
+    if has_address:
+        if (partial + WEIGHTS['address']) / total < threshold:
+            return partial / total, {}
+        scores['address'] = 1.0 if a.address == b.address else dice(a.address_grams, b.address_grams)
+        partial += WEIGHTS['address'] * scores['address']
+    return partial / total, scores
+
+def scan(conn, codec, threshold=DEDUP_THRESHOLD, max_block=DEDUP_MAX_BLOCK, window=DEDUP_WINDOW, stats=None):
+    """
+    重複の候補（点数の高い順）
+
+    Returns:
+        [{'codes': [a, b], 'score', 'scores': {項目: 一致度}, 'records': [{病院名, TEL, 郵便番号, 住所}, ...]}]
+    """
+    stats = {} if stats is None else stats
+    started = time.perf_counter()
+    records = load_records(conn, codec)
+    stats['records'] = len(records)
+    stats['load_ms'] = round((time.perf_counter() - started) * 1000, 1)
+
+    started = time.perf_counter()
+    results = []
+    for i, j in candidate_pairs(records, max_block, window, threshold, stats):
+        a, b = records[i], records[j]
+        value, scores = score(a, b, threshold)
+        if value >= threshold:
+            results.append({
+                'codes': [a.code, b.code],
+                'score': round(value, 3),
+                'scores': {key: round(v, 3) for key, v in scores.items()},
+                'records': [a.summary(), b.summary()],
+            })
+    results.sort(key=lambda r: (-r['score'], r['codes']))
+    stats['candidates'] = len(results)
+    stats['compare_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    return results
+
+class DedupReport:
+    """
+    重複の候補（mdata_version が変わるまで結果を再利用）
+
+    Args:
+        connect: DB接続を返す関数
+        get_codec: kv のコーデックを返す関数
+    """
+
+    def __init__(self, connect, get_codec):
+        self.connect = connect
+        self.get_codec = get_codec
+        self.key = None
+        self.results = []
+        self.stats = {}
+        self._lock = threading.Lock()
+
+    def get(self, threshold=DEDUP_THRESHOLD):
+        """(候補, 統計)"""
+        with self._lock:
+            conn = self.connect()
+            try:
+                row = conn.execute('SELECT version FROM mdata_version WHERE id = 1').fetchone()
+                key = (row[0] if row else 0, threshold)
+                if key != self.key:
+                    stats = {}
+                    self.results = scan(conn, self.get_codec(), threshold, stats=stats)
+                    self.stats, self.key = stats, key
+            finally:
+                conn.close()
+            return self.results, self.stats
+
+# ============================================
+# 統合
+# ============================================
+
+def merge_kv(keep, remove, take=()):
+    """
+    統合後の kv（keep の空欄を remove の値で補完、take のフィールドは remove の値を使用）
+
+    Returns:
+        (統合後の kv, 補完したフィールド, remove の値を使ったフィールド, 値が異なり keep を残したフィールド)
+    """
+    merged = dict(keep)
+    filled, taken, conflicts = [], [], []
+    for key, value in remove.items():
+        if value in (None, ''):
+            continue
+        current = keep.get(key)
+        if key in take:
+            if current != value:
+                merged[key] = value
+                taken.append(key)
+        elif current in (None, ''):
+            merged[key] = value
+            filled.append(key)
+        elif current != value and key != 'コード':
+            conflicts.append({'field': key, 'keep': current, 'remove': value})
+    return merged, filled, taken, conflicts
+
+# ============================================
+# コマンドライン
+# ============================================
+
+REPORT_COLUMNS = ('score', 'code_a', 'code_b', 'tel', 'postcode', 'name', 'address',
+                  '病院名_a', '病院名_b', 'TEL_a', 'TEL_b', '郵便番号_a', '郵便番号_b', '住所_a', '住所_b')
+
+def write_report(results, path):
+    """CSV（Excel で開けるよう BOM 付き）または JSON"""
+    if path.endswith('.json'):
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(json_engine.dumps(results))
+        return
+    with codecs.open(path, 'w', 'utf-8-sig') as f:
+        writer = csv.writer(f)
+        writer.writerow(REPORT_COLUMNS)
+        for r in results:
+            a, b = r['records']
+            writer.writerow([
+                r['score'], r['codes'][0], r['codes'][1],
+                *(r['scores'].get(key, '') for key in ('tel', 'postcode', 'name', 'address')),
+                a['病院名'], b['病院名'], a['TEL'], b['TEL'], a['郵便番号'], b['郵便番号'], a['住所'], b['住所'],
+            ])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='重複した病院データの検出')
+    parser.add_argument('--database', default=DB_PATH, help='データベースファイル')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p_scan = sub.add_parser('scan', help='重複の候補を出力（DBは変更しない）')
+    p_scan.add_argument('--threshold', type=float, default=DEDUP_THRESHOLD)
+    p_scan.add_argument('--max-block', type=int, default=DEDUP_MAX_BLOCK)
+    p_scan.add_argument('--window', type=int, default=DEDUP_WINDOW)
+    p_scan.add_argument('--output', help='出力先（.csv / .json、省略時は上位20件を表示）')
+
+    args = parser.parse_args(argv)
+    conn = sqlite3.connect(args.database)
+    try:
+        stats = {}
+        results = scan(conn, storage_codec.get_codec(args.database), args.threshold,
+                       args.max_block, args.window, stats)
+    finally:
+        conn.close()
+
+    if args.output:
+        write_report(results, args.output)
+        print(f"📄 レポートを出力しました: {args.output}")
+    else:
+        for r in results[:20]:
+            a, b = r['records']
+            print(f"{r['score']:.3f}  {r['codes'][0]} {a['病院名']}  ⇔  {r['codes'][1]} {b['病院名']}")
+    print(f"📊 病院 {stats['records']}件, 比較 {stats['pairs']}組 → 候補 {stats['candidates']}組"
+          f"（読み込み {stats['load_ms']}ms, 比較 {stats['compare_ms']}ms）")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+"""
+病院データ（mdata.kv）の一括検索・置換
+
+mdata.kv は圧縮されている場合があるため、SQL で直接検索できません。
+そこで kv の値だけを並べたテキストを検索用テーブル（mdata_search、
+FTS5 の trigram インデックス）に保存し、候補の病院を絞り込んでから
+kv を読み込んで置換します。
+
+検索用テーブルの更新:
+    mdata の INSERT / UPDATE / DELETE のたびにトリガーで mdata_search_dirty に
+    病院コードを記録し、検索の前に sync_index() で該当する病院だけ作り直します。
+
+検索の種類（mode）:
+    contains  値に find を含む（含まれる部分をすべて replace に置換）
+    exact     値全体が find と一致（値を replace に置換）
+    regex     正規表現（replace では \\1 などのグループ参照が使える）
+
+fields を指定すると対象のキーを絞り込めます（例: ['Dr./出身大学_*']）。
+
+使い方:
+    python find_replace.py reindex
+    python find_replace.py preview --find 北海道大学 --fields 'Dr./出身大学_*'
+"""
+
+import argparse
+import fnmatch
+import os
+import re
+import sqlite3
+import sys
+
+import json_engine
+import storage_codec
+
+DB_PATH = os.environ.get('DATABASE_PATH', 'hospital_data.sqlite3')
+
+MODES = ('contains', 'exact', 'regex')
+
+# trigram インデックスが使える検索語の最小文字数
+TRIGRAM_MIN = 3
+
+# ============================================
+# 検索用テーブル
+# ============================================
+
+def ensure_index(conn):
+    """検索用テーブル・トリガーを作成（全件を更新待ちにする）"""
+    try:
+        conn.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS mdata_search
+            USING fts5(code UNINDEXED, body, tokenize = 'trigram')
+        ''')
+    except sqlite3.OperationalError:
+        # FTS5（trigram）が使えない SQLite の場合は通常のテーブル（全件を instr で検索）
+        conn.execute('CREATE TABLE IF NOT EXISTS mdata_search (code TEXT, body TEXT)')
+
+    conn.execute('CREATE TABLE IF NOT EXISTS mdata_search_dirty (code TEXT PRIMARY KEY)')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS mdata_search_insert AFTER INSERT ON mdata
+        BEGIN
+            INSERT OR IGNORE INTO mdata_search_dirty (code) VALUES (NEW.code);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS mdata_search_update AFTER UPDATE OF code, kv ON mdata
+        BEGIN
+            INSERT OR IGNORE INTO mdata_search_dirty (code) VALUES (OLD.code);
+            INSERT OR IGNORE INTO mdata_search_dirty (code) VALUES (NEW.code);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS mdata_search_delete AFTER DELETE ON mdata
+        BEGIN
+            INSERT OR IGNORE INTO mdata_search_dirty (code) VALUES (OLD.code);
+        END
+    ''')
+    conn.execute('INSERT OR IGNORE INTO mdata_search_dirty (code) SELECT code FROM mdata')
+
+def has_trigram(conn):
+    row = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'mdata_search'").fetchone()
+    return bool(row and 'fts5' in row[0].lower())
+
+def index_text(kv):
+    """検索用テキスト（値を1行ずつ）"""
+    return '\n'.join(value if isinstance(value, str) else str(value)
+                     for value in kv.values() if value not in (None, ''))
+
+def sync_index(conn, codec):
+    """
+    更新待ちの病院の検索用テキストを作り直す
+
+    Returns:
+        作り直した病院数
+    """
+    # 更新待ちがなければ書き込みロックを取らない
+    if not conn.execute('SELECT 1 FROM mdata_search_dirty LIMIT 1').fetchone():
+        return 0
+
+    # 更新待ちの読み込みから削除までを1つの書き込みトランザクションで行う
+    # （同時に作り直した接続と同じ病院の行を重複して追加しないように）
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        dirty = [row[0] for row in conn.execute('SELECT code FROM mdata_search_dirty')]
+        for i in range(0, len(dirty), 500):
+            chunk = dirty[i:i + 500]
+            placeholders = ','.join('?' * len(chunk))
+            conn.execute(f'DELETE FROM mdata_search WHERE code IN ({placeholders})', chunk)
+            rows = conn.execute(f'SELECT code, kv FROM mdata WHERE code IN ({placeholders})', chunk).fetchall()
+            entries = []
+            for code, kv in rows:
+                try:
+                    entries.append((code, index_text(codec.loads(kv))))
+                except Exception:
+                    # 解析できないデータは検索対象外
+                    continue
+            conn.executemany('INSERT INTO mdata_search (code, body) VALUES (?, ?)', entries)
+            conn.execute(f'DELETE FROM mdata_search_dirty WHERE code IN ({placeholders})', chunk)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(dirty)
+
+# ============================================
+# 置換ルール
+# ============================================
+
+class Rule:
+    """
+    検索・置換の条件
+
+    Args:
+        find: 検索する文字列（regex の場合は正規表現）
+        replace: 置換後の文字列
+        mode: 'contains' / 'exact' / 'regex'
+        fields: 対象のキー（fnmatch のパターンのリスト、省略時はすべて）
+        ignore_case: 大文字・小文字を区別しない
+
+    Raises:
+        ValueError: 条件が正しくない場合
+    """
+
+    def __init__(self, find, replace='', mode='contains', fields=None, ignore_case=False):
+        if not isinstance(find, str) or not find:
+            raise ValueError('find is required')
+        if not isinstance(replace, str):
+            raise ValueError('replace must be a string')
+        if mode not in MODES:
+            raise ValueError(f'Unknown mode: {mode}')
+        if fields is not None and (not isinstance(fields, list)
+                                   or not all(isinstance(f, str) and f for f in fields)):
+            raise ValueError('fields must be a list of patterns')
+
+        self.find = find
+        self.replace = replace
+        self.mode = mode
+        self.fields = fields or None
+        self.ignore_case = bool(ignore_case)
+        flags = re.IGNORECASE if self.ignore_case else 0
+        try:
+            self.pattern = re.compile(find if mode == 'regex' else re.escape(find), flags)
+            if mode == 'regex':
+                # 置換後の文字列（グループ参照）も事前に確認
+                self.pattern.sub(replace, '')
+        except re.error as e:
+            raise ValueError(f'Invalid pattern: {e}') from e
+        self._field_patterns = [re.compile(fnmatch.translate(f)) for f in self.fields or ()]
+
+    def field_selected(self, key):
+        return not self._field_patterns or any(p.match(key) for p in self._field_patterns)
+
+    def apply(self, value):
+        """
+        1つの値を置換
+
+        Returns:
+            (置換後の値, 置換した箇所の数)
+        """
+        if self.mode == 'exact':
+            return (self.replace, 1) if self.pattern.fullmatch(value) else (value, 0)
+        if self.mode == 'regex':
+            return self.pattern.subn(self.replace, value)
+        replace = self.replace
+        return self.pattern.subn(lambda m: replace, value)
+
+    def candidate_query(self, trigram):
+        """
+        候補の病院を絞り込む SQL（WHERE 句, パラメータ）
+
+        検索用テキストは値を改行でつないだものなので、ここでは多めに候補を選び、
+        正確な判定は kv を読み込んでから行います。
+        """
+        if self.mode != 'regex':
+            if trigram and len(self.find) >= TRIGRAM_MIN:
+                # trigram は大文字・小文字を区別しない（候補が多くなるだけ）
+                return 'mdata_search MATCH ?', ['"' + self.find.replace('"', '""') + '"']
+            if not self.ignore_case:
+                return 'instr(body, ?) > 0', [self.find]
+        if self.mode == 'regex' and re.search(r'\\[AZ]', self.find):
+            # \A / \Z は値ごとの判定でしか正しく扱えない
+            return None, []
+        return 'body REGEXP ?', [self.pattern.pattern]
+
+# ============================================
+# 検索
+# ============================================
+
+def _regexp(flags):
+    cache = {}
+
+    def regexp(pattern, text):
+        compiled = cache.get(pattern)
+        if compiled is None:
+            # 値ごとの ^ / $ は検索用テキストでは行頭・行末にあたる
+            compiled = cache[pattern] = re.compile(pattern, flags | re.MULTILINE)
+        return text is not None and compiled.search(text) is not None
+    return regexp
+
+def candidates(conn, rule):
+    """候補の病院コード（昇順）"""
+    where, params = rule.candidate_query(has_trigram(conn))
+    if where is None:
+        return [row[0] for row in conn.execute('SELECT code FROM mdata ORDER BY code')]
+    conn.create_function('regexp', 2, _regexp(re.IGNORECASE if rule.ignore_case else 0), deterministic=True)
+    return sorted({row[0] for row in conn.execute(f'SELECT code FROM mdata_search WHERE {where}', params)})
+
+def scan(conn, codec, rule, codes=None, stats=None):
+    """
+    置換の対象となる病院を順に返す（DBは変更しない、検索用テキストの更新のみ）
+
+    Args:
+        codes: 対象を限定する病院コード（省略時はすべて）
+        stats: 辞書を渡すと 'candidates'（絞り込み後の件数）を記録
+
+    Yields:
+        {'code', 'name', 'version', 'count', 'matches': [{'field', 'before', 'after', 'count'}]}
+    """
+    sync_index(conn, codec)
+    found = candidates(conn, rule)
+    if codes is not None:
+        wanted = set(codes)
+        found = [code for code in found if code in wanted]
+    if stats is not None:
+        stats['candidates'] = len(found)
+
+    for i in range(0, len(found), 200):
+        chunk = found[i:i + 200]
+        placeholders = ','.join('?' * len(chunk))
+        rows = conn.execute(f'''
+            SELECT code, kv, updated_at FROM mdata WHERE code IN ({placeholders}) ORDER BY code
+        ''', chunk).fetchall()
+        for code, kv_blob, updated_at in rows:
+            try:
+                kv = codec.loads(kv_blob)
+            except Exception:
+                continue
+            matches = []
+            for key, value in kv.items():
+                if not isinstance(value, str) or not rule.field_selected(key):
+                    continue
+                after, count = rule.apply(value)
+                if count and after != value:
+                    matches.append({'field': key, 'before': value, 'after': after, 'count': count})
+            if matches:
+                yield {
+                    'code': code,
+                    'name': kv.get('病院名', ''),
+                    'version': updated_at,
+                    'count': sum(m['count'] for m in matches),
+                    'matches': matches,
+                }
+
+def patches(results):
+    """scan() の結果を一括更新（apply_mdata_patches）の形式に変換"""
+    return [{
+        'code': r['code'],
+        'set': {m['field']: m['after'] for m in r['matches']},
+        'version': r['version'],
+    } for r in results]
+
+# ============================================
+# コマンドライン
+# ============================================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='病院データの一括検索・置換（プレビュー）')
+    parser.add_argument('--database', default=DB_PATH, help='データベースファイル')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    sub.add_parser('reindex', help='検索用テキストをすべて作り直す')
+
+    p_preview = sub.add_parser('preview', help='置換の対象を表示（DBは変更しない）')
+    p_preview.add_argument('--find', required=True)
+    p_preview.add_argument('--replace', default='')
+    p_preview.add_argument('--mode', choices=MODES, default='contains')
+    p_preview.add_argument('--fields', nargs='*', help="対象のキー（例: 'Dr./出身大学_*'）")
+    p_preview.add_argument('--ignore-case', action='store_true')
+
+    args = parser.parse_args(argv)
+    conn = sqlite3.connect(args.database)
+    codec = storage_codec.get_codec(args.database)
+    try:
+        if args.command == 'reindex':
+            with conn:
+                conn.execute('INSERT OR IGNORE INTO mdata_search_dirty (code) SELECT code FROM mdata')
+            print(f"✅ 検索用テキストを作り直しました: {sync_index(conn, codec)}件")
+            return
+
+        try:
+            rule = Rule(args.find, args.replace, args.mode, args.fields, args.ignore_case)
+        except ValueError as e:
+            raise SystemExit(f"❌ {e}")
+        stats = {}
+        hospitals = cells = 0
+        for result in scan(conn, codec, rule, stats=stats):
+            hospitals += 1
+            cells += len(result['matches'])
+            sys.stdout.write(json_engine.dumps(result) + '\n')
+        print(f"📊 候補 {stats['candidates']}件 → 対象 {hospitals}件 / {cells}セル")
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    main()
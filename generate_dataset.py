@@ -0,0 +1,467 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+スケール試験用の合成データ生成
+
+実データのCSV（1072件×837列）から、列ごとの値の分布と病院ごとの
+入力パターン（どの列が埋まっているか）を学習し、同じ837列スキーマで
+統計的に近い病院データを任意件数生成します。
+
+SQLiteファイルへ直接書き込む場合は、ユーザー・編集履歴・ログイン履歴も生成します。
+CSVとして出力した場合は import_csv_data.py でそのまま取り込めます。
+
+使い方:
+    python generate_dataset.py sqlite scale_x10.sqlite3 --scale 10 --history-mean 5
+    python generate_dataset.py csv scale_x100.csv --scale 100
+    python generate_dataset.py csv - --hospitals 5000 > stream.csv
+"""
+
+import argparse
+import bisect
+import csv
+import glob
+import json
+import os
+import random
+import re
+import sqlite3
+import sys
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from itertools import accumulate
+
+TEMPLATE_DATABASE = 'hospital_data.sqlite3'
+
+PREF_NAMES = {
+    '01': '北海道', '02': '青森県', '03': '岩手県', '04': '宮城県', '05': '秋田県',
+    '06': '山形県', '07': '福島県', '08': '茨城県', '09': '栃木県', '10': '群馬県',
+    '11': '埼玉県', '12': '千葉県', '13': '東京都', '14': '神奈川県', '15': '新潟県',
+    '16': '富山県', '17': '石川県', '18': '福井県', '19': '山梨県', '20': '長野県',
+    '21': '岐阜県', '22': '静岡県', '23': '愛知県', '24': '三重県', '25': '滋賀県',
+    '26': '京都府', '27': '大阪府', '28': '兵庫県', '29': '奈良県', '30': '和歌山県',
+    '31': '鳥取県', '32': '島根県', '33': '岡山県', '34': '広島県', '35': '山口県',
+    '36': '徳島県', '37': '香川県', '38': '愛媛県', '39': '高知県', '40': '福岡県',
+    '41': '佐賀県', '42': '長崎県', '43': '熊本県', '44': '大分県', '45': '宮崎県',
+    '46': '鹿児島県', '47': '沖縄県'
+}
+
+# 電話番号形式の列（値をそのまま使い回さず、番号を振り直す）
+PHONE_KEYS = {'TEL', 'DI', '関連病院TEL'}
+
+# 都道府県ごとに値の分布を学習する列（住所・市外局番など地域に依存するもの）
+PREFECTURE_KEYS = {'住所', '郵便番号', '最寄駅', 'ファミレス', 'TEL', 'DI'}
+
+# 医師テーブル（実CSVでは未入力のため、指定時のみ語彙から生成）
+DOCTOR_SURNAMES = ['佐藤', '鈴木', '高橋', '田中', '伊藤', '渡辺', '山本', '中村', '小林', '加藤',
+                   '吉田', '山田', '佐々木', '山口', '松本', '井上', '木村', '林', '清水', '山崎']
+UNIVERSITIES = ['北海道大学', '札幌医科大学', '東北大学', '東京大学', '慶應義塾大学', '東京医科歯科大学',
+                '順天堂大学', '日本医科大学', '名古屋大学', '京都大学', '京都府立医科大学', '大阪大学',
+                '大阪公立大学', '神戸大学', '岡山大学', '広島大学', '九州大学', '熊本大学', '琉球大学',
+                '自治医科大学', '産業医科大学', '防衛医科大学校']
+DEPARTMENTS = ['内科', '外科', '小児科', '産婦人科', '整形外科', '救急科', '麻酔科', '精神科',
+               '皮膚科', '眼科', '耳鼻咽喉科', '泌尿器科', '脳神経外科', '循環器内科', '消化器内科',
+               '呼吸器内科', '放射線科', '総合診療科', '研修医']
+GRADUATION_YEARS = ['R7', 'R6', 'R5', 'R4', 'R3', 'R2', 'R1', 'H31', 'H30', 'H29']
+STATUS_VALUES = ['○', '×', '△', '済', '未']
+
+USER_AGENTS = [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:121.0) Gecko/20100101 Firefox/121.0',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 14_2) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.2 Safari/605.1.15',
+    'Mozilla/5.0 (iPad; CPU OS 17_2 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/15E148',
+]
+
+# ============================================
+# 実データの分布を学習
+# ============================================
+
+class WeightedChoice:
+    """出現頻度に比例して値を選ぶ（累積重み＋二分探索）"""
+
+    def __init__(self, counter):
+        self.values = list(counter.keys())
+        self.cum_weights = list(accumulate(counter.values()))
+        self.total = self.cum_weights[-1] if self.cum_weights else 0
+
+    def __bool__(self):
+        return self.total > 0
+
+    def pick(self, rng):
+        return self.values[bisect.bisect_right(self.cum_weights, rng.random() * self.total)]
+
+class DatasetProfile:
+    """実データCSVから学習した列構成・入力パターン・値の分布"""
+
+    def __init__(self, csv_filename):
+        with open(csv_filename, 'r', encoding='utf-8-sig', newline='') as f:
+            reader = csv.reader(f)
+            self.header = [h.strip() for h in next(reader)]
+            rows = [[v.strip().lstrip("'") for v in row] for row in reader]
+
+        self.templates = []  # 病院ごとの入力済みカラムの組
+        values = defaultdict(Counter)
+        by_pref = defaultdict(lambda: defaultdict(Counter))
+
+        for row in rows:
+            filled = tuple(k for k, v in zip(self.header, row) if v)
+            if 'コード' not in filled:
+                continue
+            record = dict(zip(self.header, row))
+            pref = record['コード'][:2]
+            self.templates.append((pref, filled))
+            for key in filled:
+                base = series_base(key)
+                values[base][record[key]] += 1
+                if base in PREFECTURE_KEYS:
+                    by_pref[pref][base][record[key]] += 1
+
+        self.values = {base: WeightedChoice(counter) for base, counter in values.items()}
+        self.values_by_pref = {
+            pref: {base: WeightedChoice(counter) for base, counter in bases.items()}
+            for pref, bases in by_pref.items()
+        }
+        self.series = {}
+        for key in self.header:
+            base, _, index = key.rpartition('_')
+            if base and index.isdigit():
+                self.series.setdefault(base, []).append(key)
+
+    def pick(self, rng, base, pref=None):
+        if pref and pref in self.values_by_pref and base in self.values_by_pref[pref]:
+            return self.values_by_pref[pref][base].pick(rng)
+        choice = self.values.get(base)
+        return choice.pick(rng) if choice else ''
+
+def series_base(key):
+    """'部署_12' -> '部署'（シリーズ列以外はそのまま）"""
+    base, _, index = key.rpartition('_')
+    return base if base and index.isdigit() else key
+
+def find_csv():
+    candidates = sorted(glob.glob('csv*.csv'))
+    return candidates[0] if candidates else None
+
+# ============================================
+# 病院データ生成
+# ============================================
+
+_DIGIT = re.compile(r'\d')
+
+def scramble_digits(rng, value, keep=4):
+    """先頭の数字（市外局番など）を残して残りの数字を振り直す"""
+    seen = 0
+
+    def replace(match):
+        nonlocal seen
+        seen += 1
+        return match.group(0) if seen <= keep else str(rng.randint(0, 9))
+
+    return _DIGIT.sub(replace, value)
+
+class HospitalGenerator:
+    """学習済みプロファイルから病院レコードを生成"""
+
+    def __init__(self, profile, rng, doctor_fill=0.0):
+        self.profile = profile
+        self.rng = rng
+        self.doctor_fill = doctor_fill
+        self.serials = Counter()
+        self.name_counts = Counter()
+
+    def _value(self, key, pref):
+        base = series_base(key)
+        rng = self.rng
+        if base == '郵便番号':
+            return scramble_digits(rng, self.profile.pick(rng, base, pref), keep=3)
+        if base in PHONE_KEYS:
+            return scramble_digits(rng, self.profile.pick(rng, base, pref))
+        if base in PREFECTURE_KEYS:
+            return self.profile.pick(rng, base, pref)
+        return self.profile.pick(rng, base)
+
+    def doctor_value(self, base):
+        """医師テーブルの値（語彙から生成）"""
+        rng = self.rng
+        if base == '印':
+            return rng.choice(DOCTOR_SURNAMES)
+        if base == '卒業':
+            return rng.choice(GRADUATION_YEARS)
+        if base == 'Dr./出身大学':
+            return f'{rng.choice(DOCTOR_SURNAMES)}/{rng.choice(UNIVERSITIES)}'
+        if base == '診療科':
+            return rng.choice(DEPARTMENTS)
+        if base in ('PHS', '直PHS'):
+            return str(rng.randint(1000, 99999))
+        if base in ('状況1', '状況2'):
+            return rng.choice(STATUS_VALUES)
+        return self.profile.pick(rng, base)
+
+    def _doctor_rows(self, record):
+        rows = min(int(self.rng.expovariate(1 / 6)) + 1, len(self.profile.series.get('印', [])))
+        for i in range(1, rows + 1):
+            for base in ('印', '卒業', 'Dr./出身大学', '診療科', 'PHS', '直PHS'):
+                if base in ('PHS', '直PHS') and self.rng.random() < 0.4:
+                    continue
+                record[f'{base}_{i}'] = self.doctor_value(base)
+
+    def generate(self):
+        """1件の病院レコードを生成し (code, kv) を返す"""
+        rng = self.rng
+        pref, filled = rng.choice(self.profile.templates)
+        self.serials[pref] += 1
+        serial = self.serials[pref]
+        code = f'{pref}-{serial:02d}'
+
+        record = {}
+        for key in filled:
+            record[key] = self._value(key, pref)
+
+        # 病院名は実在名を使い、重複した場合は分院番号を付ける
+        name = self.profile.pick(rng, '病院名')
+        self.name_counts[name] += 1
+        if self.name_counts[name] > 1:
+            name = f'{name} 第{self.name_counts[name]}分院'
+        record['コード'] = code
+        record['都道府県'] = f'{pref}({PREF_NAMES.get(pref, pref)})-{serial}'
+        record['病院名'] = name
+
+        if self.doctor_fill and rng.random() < self.doctor_fill:
+            self._doctor_rows(record)
+
+        # CSVと同じ列順に並べる
+        return code, {k: record[k] for k in self.profile.header if k in record}
+
+    def edit(self, kv):
+        """1回分の編集（数カ所の変更）を加えた新しいレコードを返す"""
+        rng = self.rng
+        new = dict(kv)
+        for _ in range(min(int(rng.expovariate(1 / 2)) + 1, 10)):
+            series_keys = [k for k in new if series_base(k) != k]
+            if series_keys and rng.random() < 0.7:
+                # 既存の値を書き換え
+                key = rng.choice(series_keys)
+            else:
+                # 新しい行を追加
+                base = rng.choice(list(self.profile.series))
+                key = rng.choice(self.profile.series[base][:10])
+            base = series_base(key)
+            if base in ('印', '卒業', 'Dr./出身大学', '診療科', 'PHS', '直PHS', '状況1', '状況2'):
+                new[key] = self.doctor_value(base)
+            elif rng.random() < 0.1:
+                new.pop(key, None)
+            else:
+                new[key] = self._value(key, kv['コード'][:2])
+        return new
+
+# ============================================
+# 出力
+# ============================================
+
+def write_csv(profile, generator, count, output):
+    """CSVとして出力（'-' の場合は標準出力へストリーム）"""
+    if output == '-':
+        f = sys.stdout
+        close = False
+    else:
+        f = open(output, 'w', encoding='utf-8-sig', newline='')
+        close = True
+    try:
+        writer = csv.writer(f)
+        writer.writerow(profile.header)
+        for i in range(count):
+            _, kv = generator.generate()
+            writer.writerow([kv.get(k, '') for k in profile.header])
+            if output != '-' and (i + 1) % 10000 == 0:
+                print(f'  ... {i + 1}件生成', file=sys.stderr)
+    except BrokenPipeError:
+        # パイプ先（head など）が先に終了した場合
+        sys.stdout = open(os.devnull, 'w')
+    finally:
+        if close:
+            f.close()
+
+# FTS5 の仮想テーブルが自動で作成するテーブル（仮想テーブル名_接尾辞）
+FTS5_SHADOW_SUFFIXES = ('_data', '_idx', '_content', '_docsize', '_config')
+
+def copy_schema(template, conn):
+    """
+    テンプレートDBと同じテーブル・インデックスを作成
+
+    トリガーと仮想テーブル（検索用テーブル）はコピーせず、データの書き込み後に
+    マイグレーションで作成します（書き込み中にトリガーを動かさないため）。
+    """
+    src = sqlite3.connect(template)
+    statements = src.execute('''
+        SELECT type, name, sql FROM sqlite_master
+        WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%' AND type IN ('table', 'index')
+        ORDER BY CASE type WHEN 'table' THEN 0 ELSE 1 END
+    ''').fetchall()
+    src.close()
+    virtual = [name for _, name, sql in statements if sql.upper().startswith('CREATE VIRTUAL TABLE')]
+    shadow = {name + suffix for name in virtual for suffix in FTS5_SHADOW_SUFFIXES}
+    for _, name, sql in statements:
+        if name in virtual or name in shadow:
+            continue
+        conn.execute(sql)
+
+def format_ts(dt):
+    return dt.strftime('%Y-%m-%d %H:%M:%S')
+
+def write_sqlite(args, profile, generator, rng):
+    """SQLiteファイルへ病院データ・ユーザー・履歴を書き込む"""
+    from werkzeug.security import generate_password_hash
+
+    if os.path.exists(args.output):
+        if not args.force:
+            raise SystemExit(f'出力先が既に存在します: {args.output}（--force で上書き）')
+        os.remove(args.output)
+
+    conn = sqlite3.connect(args.output)
+    conn.execute('PRAGMA journal_mode = OFF')
+    conn.execute('PRAGMA synchronous = OFF')
+    copy_schema(args.template, conn)
+
+    # ユーザー（管理者1人 + 一般ユーザー）
+    print(f'👥 ユーザーを作成中: {args.users + 1}人', file=sys.stderr)
+    hashed_password = generate_password_hash(args.password)
+    users = [(1, 'admin', 'admin')] + [(i + 1, f'user{i:03d}', 'user') for i in range(1, args.users + 1)]
+    conn.executemany(
+        'INSERT INTO users (id, username, password, email, role) VALUES (?, ?, ?, ?, ?)',
+        [(uid, name, hashed_password, f'{name}@example.com', role) for uid, name, role in users]
+    )
+
+    end = datetime.now().replace(microsecond=0)
+    start = end - timedelta(days=args.days)
+    span = (end - start).total_seconds()
+
+    print(f'🏥 病院データを生成中: {args.count}件', file=sys.stderr)
+    history_rows = 0
+    mdata_batch = []
+    history_batch = []
+
+    def flush():
+        conn.executemany('INSERT INTO mdata (code, kv, updated_at, updated_by) VALUES (?, ?, ?, ?)', mdata_batch)
+        conn.executemany('''
+            INSERT INTO history (code, action, old_data, new_data, changed_fields, user_id, username, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', history_batch)
+        mdata_batch.clear()
+        history_batch.clear()
+
+    for i in range(args.count):
+        code, kv = generator.generate()
+        updated_at = format_ts(start)
+        updated_by = None
+
+        # 編集履歴（一部の病院は長い履歴を持つ）
+        edits = int(rng.expovariate(1 / args.history_mean)) if args.history_mean else 0
+        if args.hot_fraction and rng.random() < args.hot_fraction:
+            edits *= args.hot_multiplier
+        if edits:
+            times = sorted(start + timedelta(seconds=rng.random() * span) for _ in range(edits))
+            for ts in times:
+                uid, username, _ = rng.choice(users)
+                new_kv = generator.edit(kv)
+                changed = [k for k in set(kv) | set(new_kv) if kv.get(k, '') != new_kv.get(k, '')]
+                history_batch.append((
+                    code, 'update',
+                    json.dumps(kv, ensure_ascii=False),
+                    json.dumps(new_kv, ensure_ascii=False),
+                    json.dumps(changed, ensure_ascii=False) if changed else None,
+                    uid, username, format_ts(ts)
+                ))
+                kv = new_kv
+                updated_at, updated_by = format_ts(ts), uid
+            history_rows += edits
+
+        mdata_batch.append((code, json.dumps(kv, ensure_ascii=False), updated_at, updated_by))
+        if len(mdata_batch) >= 1000 or len(history_batch) >= 5000:
+            flush()
+        if (i + 1) % 10000 == 0:
+            print(f'  ... {i + 1}件生成（履歴 {history_rows}件）', file=sys.stderr)
+    flush()
+
+    # ログイン履歴
+    print(f'📊 ログイン履歴を生成中: {args.logins}件', file=sys.stderr)
+    ips = [f'192.168.{rng.randint(0, 9)}.{rng.randint(2, 254)}' for _ in range(max(1, args.users))]
+    batch = []
+    for ts in sorted(start + timedelta(seconds=rng.random() * span) for _ in range(args.logins)):
+        uid, username, _ = rng.choice(users)
+        success = rng.random() >= args.failure_rate
+        batch.append((uid, username, format_ts(ts), rng.choice(ips), rng.choice(USER_AGENTS), int(success)))
+        if len(batch) >= 10000:
+            conn.executemany('''
+                INSERT INTO login_history (user_id, username, login_time, ip_address, user_agent, success)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', batch)
+            batch.clear()
+    conn.executemany('''
+        INSERT INTO login_history (user_id, username, login_time, ip_address, user_agent, success)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', batch)
+
+    conn.commit()
+    conn.close()
+
+    # スキーマを最新にする（テンプレートが古い場合のテーブル追加、集計・検索用テキストの作成）
+    import migrations
+    migrations.upgrade(args.output)
+
+    conn = sqlite3.connect(args.output)
+    conn.execute('ANALYZE')
+    conn.close()
+    return history_rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='スケール試験用の合成データ生成')
+    parser.add_argument('format', choices=['sqlite', 'csv'], help='出力形式')
+    parser.add_argument('output', help="出力先（csvの場合 '-' で標準出力）")
+    size = parser.add_mutually_exclusive_group()
+    size.add_argument('--scale', type=float, default=1.0, help='実データ件数に対する倍率（例: 10, 100）')
+    size.add_argument('--hospitals', type=int, help='病院数を直接指定')
+    parser.add_argument('--csv', help='学習元の実データCSV')
+    parser.add_argument('--template', default=TEMPLATE_DATABASE, help='スキーマのコピー元DB')
+    parser.add_argument('--seed', type=int, default=1, help='乱数シード（同じ値なら同じデータ）')
+    parser.add_argument('--doctor-fill', type=float, default=0.0,
+                        help='医師テーブルを埋める病院の割合（実CSVは0）')
+    parser.add_argument('--users', type=int, default=49, help='一般ユーザー数')
+    parser.add_argument('--password', default='User@2024', help='生成ユーザー共通のパスワード')
+    parser.add_argument('--history-mean', type=float, default=3.0, help='病院あたりの平均編集回数')
+    parser.add_argument('--hot-fraction', type=float, default=0.01, help='編集が集中する病院の割合')
+    parser.add_argument('--hot-multiplier', type=int, default=20, help='編集集中病院の編集回数倍率')
+    parser.add_argument('--logins', type=int, help='ログイン履歴の件数（既定: 病院数×20）')
+    parser.add_argument('--failure-rate', type=float, default=0.05, help='ログイン失敗の割合')
+    parser.add_argument('--days', type=int, default=730, help='履歴の期間（日）')
+    parser.add_argument('--force', action='store_true', help='出力先を上書き')
+    args = parser.parse_args(argv)
+
+    csv_filename = args.csv or find_csv()
+    if not csv_filename:
+        raise SystemExit('学習元のCSVが見つかりません（--csv で指定してください）')
+
+    started = time.perf_counter()
+    profile = DatasetProfile(csv_filename)
+    args.count = args.hospitals or int(round(len(profile.templates) * args.scale))
+    if args.logins is None:
+        args.logins = args.count * 20
+
+    rng = random.Random(args.seed)
+    generator = HospitalGenerator(profile, rng, args.doctor_fill)
+
+    if args.format == 'csv':
+        write_csv(profile, generator, args.count, args.output)
+        if args.output != '-':
+            print(f'✅ CSVを生成しました: {args.output}（{args.count}件, '
+                  f'{time.perf_counter() - started:.1f}秒）', file=sys.stderr)
+    else:
+        if not os.path.exists(args.template):
+            raise SystemExit(f'テンプレートDBが見つかりません: {args.template}')
+        history_rows = write_sqlite(args, profile, generator, rng)
+        size_mb = os.path.getsize(args.output) / 1024 / 1024
+        print(f'✅ SQLiteを生成しました: {args.output}', file=sys.stderr)
+        print(f'   病院: {args.count}件 / 履歴: {history_rows}件 / ログイン履歴: {args.logins}件 / '
+              f'{size_mb:.1f}MB / {time.perf_counter() - started:.1f}秒', file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,527 @@
+# -*- coding: utf-8 -*-
+"""
+郵便番号からの近隣病院検索（メモリ上のグリッドインデックス）
+
+郵便番号ごとの代表地点（緯度・経度）のCSVを geo_postcodes に読み込み、
+各病院の座標を 郵便番号 から求めて geo_hospitals に保存します。
+病院データの保存時は、郵便番号が変わった病院だけ座標を更新します
+（保存と同じトランザクション）。
+
+検索は座標を一定の大きさ（GEO_CELL_KM）のマスに分けたグリッドで行います。
+近いマスから順に調べ、k 件目までの距離より外側のマスに届いた時点で
+打ち切るため、病院数が増えても調べる件数はほぼ一定です。
+
+geo_hospitals が変更されると geo_version.version が増える（トリガー）ため、
+各ワーカーは値が変わっていればインデックスを作り直します。
+
+郵便番号のCSV（UTF-8 または Shift_JIS）:
+    郵便番号,緯度,経度        （postcode,lat,lon などの英語の列名も可）
+    0600000,43.0621,141.3544   （ヘッダーがない場合は先頭の3列）
+
+使い方:
+    python geo.py load-postcodes postcodes.csv
+    python geo.py rebuild
+    python geo.py nearest --postcode 004-0041 --k 5
+    python geo.py bench --points 100000
+"""
+
+import argparse
+import codecs
+import csv
+import heapq
+import math
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+
+import storage_codec
+
+DB_PATH = os.environ.get('DATABASE_PATH', 'hospital_data.sqlite3')
+
+# グリッドの1マスの大きさ（km）
+GEO_CELL_KM = float(os.environ.get('GEO_CELL_KM', 5))
+
+# 緯度1度あたりの距離（km）
+KM_PER_DEG = 111.195
+EARTH_RADIUS_KM = 6371.0
+
+# マスの外側までの距離の見積もりの余裕
+REACH_MARGIN = 0.95
+
+POSTCODE_COLUMNS = ('郵便番号', 'postcode', 'zipcode', 'zip')
+LAT_COLUMNS = ('緯度', 'lat', 'latitude')
+LON_COLUMNS = ('経度', 'lon', 'lng', 'longitude')
+
+def ensure_tables(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS geo_postcodes (
+            postcode TEXT PRIMARY KEY,
+            lat REAL NOT NULL,
+            lon REAL NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS geo_hospitals (
+            code TEXT PRIMARY KEY,
+            postcode TEXT NOT NULL,
+            lat REAL NOT NULL,
+            lon REAL NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS geo_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL
+        )
+    ''')
+    conn.execute('INSERT OR IGNORE INTO geo_version (id, version) VALUES (1, 0)')
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS geo_version_{event.lower()}
+            AFTER {event} ON geo_hospitals
+            BEGIN
+                UPDATE geo_version SET version = version + 1 WHERE id = 1;
+            END
+        ''')
+
+# ============================================
+# 郵便番号
+# ============================================
+
+def normalize_postcode(value):
+    """'004-0041' / '〒004－0041' などを7桁の数字に（正しくない場合は None）"""
+    if not isinstance(value, str):
+        value = '' if value is None else str(value)
+    digits = re.sub(r'\D', '', value.translate(str.maketrans('０１２３４５６７８９', '0123456789')))
+    return digits if len(digits) == 7 else None
+
+def _column(header, names):
+    for i, column in enumerate(header):
+        if column.strip().lower() in names:
+            return i
+    return None
+
+def read_postcode_csv(path):
+    """郵便番号のCSVから (郵便番号, 緯度, 経度) を順に返す"""
+    try:
+        with codecs.open(path, 'r', 'utf-8-sig') as f:
+            text = f.read()
+    except UnicodeDecodeError:
+        with codecs.open(path, 'r', 'cp932') as f:
+            text = f.read()
+
+    reader = csv.reader(text.splitlines())
+    first = next(reader, None)
+    if first is None:
+        return
+    columns = (_column(first, POSTCODE_COLUMNS), _column(first, LAT_COLUMNS), _column(first, LON_COLUMNS))
+    if None in columns:
+        # ヘッダーなし（先頭の3列）
+        columns = (0, 1, 2)
+        reader = [first] + list(reader)
+
+    for row in reader:
+        try:
+            postcode = normalize_postcode(row[columns[0]])
+            lat, lon = float(row[columns[1]]), float(row[columns[2]])
+        except (IndexError, ValueError):
+            continue
+        if postcode and -90 <= lat <= 90 and -180 <= lon <= 180:
+            yield postcode, lat, lon
+
+def load_postcodes(conn, path, replace=True):
+    """
+    郵便番号のCSVを geo_postcodes に読み込む（呼び出し元のトランザクション内で実行）
+
+    Returns:
+        読み込んだ件数
+    """
+    if replace:
+        conn.execute('DELETE FROM geo_postcodes')
+    rows = list(read_postcode_csv(path))
+    conn.executemany('INSERT OR REPLACE INTO geo_postcodes (postcode, lat, lon) VALUES (?, ?, ?)', rows)
+    return len(rows)
+
+def postcode_location(conn, postcode):
+    """
+    郵便番号の座標
+
+    一致する郵便番号がない場合は、上3桁が同じ郵便番号の平均（同じ地域）を使います。
+
+    Returns:
+        (緯度, 経度, 'postcode' / 'area') または None
+    """
+    postcode = normalize_postcode(postcode)
+    if not postcode:
+        return None
+    row = conn.execute('SELECT lat, lon FROM geo_postcodes WHERE postcode = ?', (postcode,)).fetchone()
+    if row:
+        return row[0], row[1], 'postcode'
+    row = conn.execute('''
+        SELECT AVG(lat), AVG(lon) FROM geo_postcodes WHERE postcode >= ? AND postcode < ?
+    ''', (postcode[:3], postcode[:3] + ':')).fetchone()
+    if row and row[0] is not None:
+        return row[0], row[1], 'area'
+    return None
+
+# ============================================
+# 病院の座標
+# ============================================
+
+def _set_hospital(conn, code, kv):
+    location = postcode_location(conn, (kv or {}).get('郵便番号'))
+    if location:
+        conn.execute('''
+            INSERT INTO geo_hospitals (code, postcode, lat, lon) VALUES (?, ?, ?, ?)
+            ON CONFLICT (code) DO UPDATE SET postcode = excluded.postcode, lat = excluded.lat, lon = excluded.lon
+            WHERE (postcode, lat, lon) IS NOT (excluded.postcode, excluded.lat, excluded.lon)
+        ''', (code, normalize_postcode(kv['郵便番号']), location[0], location[1]))
+        return True
+    conn.execute('DELETE FROM geo_hospitals WHERE code = ?', (code,))
+    return False
+
+def apply_change(conn, code, old_data, new_data, changed_fields):
+    """
+    保存1件分の変更を病院の座標に反映（呼び出し元のトランザクション内で実行）
+
+    Args:
+        changed_fields: diff_fields() の結果（old_data がない場合は新規作成）
+    """
+    if old_data and '郵便番号' not in changed_fields:
+        return
+    _set_hospital(conn, code, new_data)
+
+def fill(conn, codec):
+    """
+    全病院の座標を作り直す（呼び出し元のトランザクション内で実行）
+
+    Returns:
+        (座標が求まった病院数, 病院数)
+    """
+    located = total = 0
+    codes = set()
+    for code, kv in conn.execute('SELECT code, kv FROM mdata').fetchall():
+        total += 1
+        codes.add(code)
+        try:
+            data = codec.loads(kv)
+        except Exception:
+            data = None
+        located += _set_hospital(conn, code, data)
+    stale = [(code,) for (code,) in conn.execute('SELECT code FROM geo_hospitals') if code not in codes]
+    conn.executemany('DELETE FROM geo_hospitals WHERE code = ?', stale)
+    return located, total
+
+def rebuild(conn, codec):
+    """全病院の座標を作り直す"""
+    with conn:
+        ensure_tables(conn)
+        return fill(conn, codec)
+
+# ============================================
+# 距離
+# ============================================
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((p2 - p1) / 2) ** 2
+         + math.cos(p1) * math.cos(p2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+def _xyz(lat, lon):
+    """地球の中心を原点とした3次元座標（km）"""
+    p, l = math.radians(lat), math.radians(lon)
+    c = math.cos(p)
+    return (EARTH_RADIUS_KM * c * math.cos(l), EARTH_RADIUS_KM * c * math.sin(l), EARTH_RADIUS_KM * math.sin(p))
+
+def _chord(arc_km):
+    """大圏距離 → 弦の長さ"""
+    return 2 * EARTH_RADIUS_KM * math.sin(min(arc_km / (2 * EARTH_RADIUS_KM), math.pi / 2))
+
+def _arc(chord_km):
+    """弦の長さ → 大圏距離"""
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, chord_km / (2 * EARTH_RADIUS_KM)))
+
+# ============================================
+# グリッドインデックス
+# ============================================
+
+class GeoGrid:
+    """
+    座標のグリッド（作成後は変更しない）
+
+    各マスには地球の中心からの3次元座標（km）を保持し、2点間の直線距離
+    （弦の長さ）で比較します。弦の長さは大圏距離と順序が一致するため、
+    三角関数を使わずに近い順を正確に求められます。
+
+    Args:
+        points: [(病院コード, 緯度, 経度)]
+        cell_km: 1マスの大きさ（km）
+    """
+
+    def __init__(self, points, cell_km=GEO_CELL_KM):
+        self.cell_km = cell_km
+        self.codes = [p[0] for p in points]
+        self.lats = [p[1] for p in points]
+        self.lons = [p[2] for p in points]
+        self.positions = {code: i for i, code in enumerate(self.codes)}
+
+        # 経度方向のマスの幅が最も北でも cell_km 以上になるようにする
+        max_lat = max((abs(lat) for lat in self.lats), default=0.0)
+        self.dlat = cell_km / KM_PER_DEG
+        self.dlon = cell_km / (KM_PER_DEG * max(math.cos(math.radians(min(max_lat, 89.0))), 0.01))
+
+        cells = {}
+        for i, (lat, lon) in enumerate(zip(self.lats, self.lons)):
+            cells.setdefault(self._cell(lat, lon), []).append(_xyz(lat, lon) + (i,))
+        self.cells = cells
+        if cells:
+            rows = [c[0] for c in cells]
+            cols = [c[1] for c in cells]
+            self.bounds = (min(rows), max(rows), min(cols), max(cols))
+        else:
+            self.bounds = None
+
+    def __len__(self):
+        return len(self.codes)
+
+    def _cell(self, lat, lon):
+        return (math.floor(lat / self.dlat), math.floor(lon / self.dlon))
+
+    def location(self, code):
+        i = self.positions.get(code)
+        return None if i is None else (self.lats[i], self.lons[i])
+
+    def _ring(self, row, col, r):
+        """中心のマスから r マス離れたマス（チェビシェフ距離）"""
+        if r == 0:
+            yield row, col
+            return
+        for c in range(col - r, col + r + 1):
+            yield row - r, c
+            yield row + r, c
+        for rr in range(row - r + 1, row + r):
+            yield rr, col - r
+            yield rr, col + r
+
+    def _max_ring(self, row, col):
+        top, bottom, left, right = self.bounds
+        return max(row - top, bottom - row, col - left, right - col)
+
+    def nearest(self, lat, lon, k=10, radius_km=None, exclude=None):
+        """
+        近い順に病院を返す
+
+        Args:
+            k: 件数（radius_km を指定した場合は上限、None は無制限）
+            radius_km: この距離（km）以内の病院のみ
+            exclude: 除外する病院コード
+
+        Returns:
+            [(距離km, 病院コード)]（距離は大圏距離）
+        """
+        if not self.cells or (k is not None and k <= 0):
+            return []
+        row, col = self._cell(lat, lon)
+        cells = self.cells
+        qx, qy, qz = _xyz(lat, lon)
+        skip = self.positions.get(exclude) if exclude is not None else None
+        limit2 = _chord(radius_km) ** 2 if radius_km is not None else None
+
+        heap = []       # k 件の場合は (-弦², i) の最大ヒープ
+        found = []      # 件数無制限（radius_km のみ）の場合
+        max_ring = self._max_ring(row, col)
+        for r in range(max_ring + 1):
+            ring = self._ring(row, col, r)
+            swept = 8 * r > len(cells)
+            if swept:
+                # 周りにマスが少ない（離島など）場合は、残りのマスをまとめて調べる
+                ring = [c for c in cells if max(abs(c[0] - row), abs(c[1] - col)) >= r]
+            for cell in ring:
+                members = cells.get(cell)
+                if not members:
+                    continue
+                for x, y, z, i in members:
+                    d2 = (x - qx) ** 2 + (y - qy) ** 2 + (z - qz) ** 2
+                    if limit2 is not None and d2 > limit2:
+                        continue
+                    if i == skip:
+                        continue
+                    if k is None:
+                        found.append((d2, i))
+                    elif len(heap) < k:
+                        heapq.heappush(heap, (-d2, i))
+                    elif d2 < -heap[0][0]:
+                        heapq.heapreplace(heap, (-d2, i))
+            if swept:
+                break
+            # r マス目より外側の病院はおよそ (r × マスの大きさ) 以上離れている
+            # （経線・緯線に沿った距離と大圏距離の差の分だけ少し余裕を持たせる）
+            reach = r * self.cell_km * REACH_MARGIN
+            if radius_km is not None and reach >= radius_km:
+                break
+            if k is not None and len(heap) == k and -heap[0][0] <= _chord(reach) ** 2:
+                break
+
+        items = found if k is None else [(-d2, i) for d2, i in heap]
+        codes = self.codes
+        results = sorted((_arc(math.sqrt(d2)), codes[i]) for d2, i in items)
+        return results if k is None else results[:k]
+
+class GeoIndex:
+    """
+    病院の座標のインデックス（geo_version が変わると作り直す）
+
+    Args:
+        connect: DB接続を返す関数
+    """
+
+    def __init__(self, connect, cell_km=GEO_CELL_KM):
+        self.connect = connect
+        self.cell_km = cell_km
+        self.version = None
+        self.grid = GeoGrid([], cell_km)
+        self._lock = threading.Lock()
+
+    def _current_version(self, conn):
+        try:
+            row = conn.execute('SELECT version FROM geo_version WHERE id = 1').fetchone()
+        except sqlite3.OperationalError:
+            # マイグレーション前
+            return 0
+        return row[0] if row else 0
+
+    def load(self):
+        conn = self.connect()
+        try:
+            version = self._current_version(conn)
+            try:
+                points = conn.execute('SELECT code, lat, lon FROM geo_hospitals').fetchall()
+            except sqlite3.OperationalError:
+                points = []
+        finally:
+            conn.close()
+        self.grid = GeoGrid([tuple(p) for p in points], self.cell_km)
+        self.version = version
+        print(f"🗺️ 病院の座標を読み込みました: {len(points)}件")
+
+    def refresh_if_changed(self):
+        conn = self.connect()
+        try:
+            version = self._current_version(conn)
+        finally:
+            conn.close()
+        if version != self.version:
+            with self._lock:
+                if version != self.version:
+                    self.load()
+        return self.grid
+
+    def location(self, code):
+        return self.refresh_if_changed().location(code)
+
+    def nearest(self, lat, lon, k=10, radius_km=None, exclude=None):
+        return self.refresh_if_changed().nearest(lat, lon, k, radius_km, exclude)
+
+# ============================================
+# コマンドライン
+# ============================================
+
+def bench(points, queries, k, radius_km, cell_km, seed=1):
+    """日本の範囲に偏りのある点を作り、1回の検索時間を計測"""
+    rng = random.Random(seed)
+    # 都市部に集中させる（中心の周りに正規分布）
+    centers = [(rng.uniform(26.0, 44.0), rng.uniform(127.5, 145.0)) for _ in range(300)]
+    data = []
+    for n in range(points):
+        clat, clon = rng.choice(centers)
+        data.append((f'B{n:06d}', clat + rng.gauss(0, 0.15), clon + rng.gauss(0, 0.15)))
+    started = time.perf_counter()
+    grid = GeoGrid(data, cell_km)
+    build = time.perf_counter() - started
+
+    results = {'points': points, 'cells': len(grid.cells), 'build_ms': round(build * 1000, 1)}
+    probes = [rng.choice(data)[1:] for _ in range(queries)]
+    for name, kw in (('knn', {'k': k}), ('radius', {'k': None, 'radius_km': radius_km})):
+        timings = []
+        for lat, lon in probes:
+            t = time.perf_counter()
+            grid.nearest(lat, lon, **kw)
+            timings.append(time.perf_counter() - t)
+        timings.sort()
+        results[name] = {
+            'median_us': round(timings[len(timings) // 2] * 1e6, 1),
+            'p99_us': round(timings[int(len(timings) * 0.99)] * 1e6, 1),
+        }
+    # 全件の距離計算との比較（件数の少ない検索）
+    t = time.perf_counter()
+    for lat, lon in probes[:50]:
+        heapq.nsmallest(k, ((haversine_km(lat, lon, p[1], p[2]), p[0]) for p in data))
+    results['scan_median_us'] = round((time.perf_counter() - t) / 50 * 1e6, 1)
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='郵便番号からの近隣病院検索')
+    parser.add_argument('--database', default=DB_PATH, help='データベースファイル')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p_load = sub.add_parser('load-postcodes', help='郵便番号のCSVを読み込み、病院の座標を作り直す')
+    p_load.add_argument('csv', help='郵便番号,緯度,経度 のCSV')
+    p_load.add_argument('--append', action='store_true', help='既存の郵便番号を残して追加')
+
+    sub.add_parser('rebuild', help='病院の座標を作り直す（取り込み後など）')
+
+    p_near = sub.add_parser('nearest', help='近隣の病院を表示')
+    origin = p_near.add_mutually_exclusive_group(required=True)
+    origin.add_argument('--postcode')
+    origin.add_argument('--code', help='病院コード')
+    p_near.add_argument('--k', type=int, default=10)
+    p_near.add_argument('--radius-km', type=float)
+
+    p_bench = sub.add_parser('bench', help='検索時間の計測（合成データ、DBは使用しない）')
+    p_bench.add_argument('--points', type=int, default=100000)
+    p_bench.add_argument('--queries', type=int, default=2000)
+    p_bench.add_argument('--k', type=int, default=10)
+    p_bench.add_argument('--radius-km', type=float, default=10.0)
+    p_bench.add_argument('--cell-km', type=float, default=GEO_CELL_KM)
+
+    args = parser.parse_args(argv)
+    if args.command == 'bench':
+        import json
+        print(json.dumps(bench(args.points, args.queries, args.k, args.radius_km, args.cell_km),
+                         ensure_ascii=False, indent=2))
+        return
+
+    conn = sqlite3.connect(args.database)
+    try:
+        codec = storage_codec.get_codec(args.database)
+        if args.command == 'load-postcodes':
+            with conn:
+                ensure_tables(conn)
+                count = load_postcodes(conn, args.csv, replace=not args.append)
+            print(f"✅ 郵便番号を読み込みました: {count}件")
+            located, total = rebuild(conn, codec)
+            print(f"✅ 病院の座標を作り直しました: {located}/{total}件")
+        elif args.command == 'rebuild':
+            located, total = rebuild(conn, codec)
+            print(f"✅ 病院の座標を作り直しました: {located}/{total}件")
+        else:
+            index = GeoIndex(lambda: sqlite3.connect(args.database))
+            if args.postcode:
+                location = postcode_location(conn, args.postcode)
+                if not location:
+                    raise SystemExit(f"❌ 郵便番号が見つかりません: {args.postcode}")
+            else:
+                location = index.location(args.code)
+                if not location:
+                    raise SystemExit(f"❌ 病院の座標がありません: {args.code}")
+            for distance, code in index.nearest(location[0], location[1], args.k, args.radius_km, args.code):
+                print(f"{code:<10} {distance:8.2f} km")
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    main()
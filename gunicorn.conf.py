@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+"""
+gunicorn の設定
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+preload_app = True のため、アプリの読み込みと warmup()（病院一覧・テンプレート・
+静的ファイルの準備）はフォーク前に1回だけ行われ、ワーカー間で共有されます。
+
+    GUNICORN_BIND       待ち受けアドレス（既定: 0.0.0.0:5000）
+    GUNICORN_WORKERS    ワーカー数（既定: 1、2以上の場合は SOCKETIO_MESSAGE_QUEUE を設定し、
+                        流量制限をワーカー間で共有するには RATE_LIMIT_DB も設定）
+    GUNICORN_THREADS    ワーカーあたりのスレッド数（既定: 50）
+
+リバースプロキシ（nginx など）の後ろで動かす場合は、アプリ側で TRUSTED_PROXY_COUNT に
+プロキシの段数を設定してください（X-Forwarded-For からクライアントのアドレスを取得）。
+"""
+
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('GUNICORN_WORKERS', 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 50))
+preload_app = True
+
+# gthread ワーカーでは Socket.IO を threading モードで動かす（アプリの読み込み前に設定）
+os.environ.setdefault('SOCKETIO_ASYNC_MODE', 'threading')
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+リクエストを受け付けられる状態か（readiness）の確認
+
+ロードバランサーからの問い合わせ（/api/health/ready）ごとに確認すると負荷になるため、
+結果を HEALTH_CACHE_SECONDS 秒間再利用します。
+
+    HEALTH_CACHE_SECONDS          結果を再利用する時間（秒、既定: 5）
+    HEALTH_DB_LATENCY_MS          DBへの問い合わせの応答時間の上限（ミリ秒、既定: 500）
+    HEALTH_MAX_WAL_MB             WALファイルの大きさの上限（MB、既定: 256）
+    HEALTH_MAX_CHECKPOINT_LAG     チェックポイント未反映のWALフレーム数の上限（既定: 10000）
+    HEALTH_MAX_AUDIT_PENDING      監査ログの書き込み待ちの上限（既定: 5000）
+    HEALTH_SOCKETIO_LATENCY_MS    Socket.IO のバックグラウンド処理が始まるまでの上限（ミリ秒、既定: 500）
+    HEALTH_MIN_DISK_FREE_MB       DBのあるディスクの空き容量の下限（MB、既定: 1024）
+"""
+
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+def _env_int(name, default):
+    return int(os.environ.get(name, default))
+
+class ReadinessCheck:
+    """
+    DB・監査ログの書き込みスレッド・Socket.IO・ディスクの状態を上限と比較（スキーマのバージョンも確認）
+
+    Args:
+        connect: DB接続を返す関数
+        db_path: DBファイル（WALファイル・空き容量の確認用）
+        pending: 監査ログの書き込み待ちの件数を返す関数
+        socketio: flask_socketio.SocketIO（start_background_task / sleep を使う）
+        schema_version: 必要なスキーマのバージョン（PRAGMA user_version、None の場合は確認しない）
+    """
+
+    def __init__(self, connect, db_path, pending, socketio, schema_version=None, cache_seconds=None,
+                 clock=time.monotonic):
+        self.connect = connect
+        self.db_path = db_path
+        self.pending = pending
+        self.socketio = socketio
+        self.schema_version = schema_version
+        self.cache_seconds = cache_seconds if cache_seconds is not None else _env_int('HEALTH_CACHE_SECONDS', 5)
+        self.thresholds = {
+            'db_latency_ms': _env_int('HEALTH_DB_LATENCY_MS', 500),
+            'wal_mb': _env_int('HEALTH_MAX_WAL_MB', 256),
+            'checkpoint_lag': _env_int('HEALTH_MAX_CHECKPOINT_LAG', 10000),
+            'audit_pending': _env_int('HEALTH_MAX_AUDIT_PENDING', 5000),
+            'socketio_latency_ms': _env_int('HEALTH_SOCKETIO_LATENCY_MS', 500),
+            'disk_free_mb': _env_int('HEALTH_MIN_DISK_FREE_MB', 1024),
+        }
+        self.clock = clock
+        self._result = None
+        self._checked_at = None
+        self._running = False
+        self._lock = threading.Lock()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        # 親プロセスの結果は使わない
+        self._result = None
+        self._checked_at = None
+        self._running = False
+        self._lock = threading.Lock()
+
+    # ---------- 個々の確認 ----------
+
+    def check_db(self):
+        """DBへの問い合わせの応答時間（ロック待ちを含む）"""
+        limit = self.thresholds['db_latency_ms']
+        started = time.perf_counter()
+        conn = self.connect()
+        try:
+            conn.execute(f'PRAGMA busy_timeout = {limit * 2}')
+            conn.execute('SELECT 1 FROM mdata LIMIT 1').fetchone()
+            journal_mode = conn.execute('PRAGMA journal_mode').fetchone()[0]
+            schema_version = conn.execute('PRAGMA user_version').fetchone()[0]
+        finally:
+            conn.close()
+        latency = round((time.perf_counter() - started) * 1000, 2)
+        return {'ok': latency <= limit, 'latency_ms': latency, 'limit_ms': limit, 'journal_mode': journal_mode,
+                'schema_version': schema_version}
+
+    def check_schema(self, version):
+        """スキーマのバージョン（未適用のマイグレーションがあればAPIの一部が失敗する）"""
+        if version is None:
+            return {'ok': True, 'version': None, 'required': self.schema_version}
+        return {'ok': version >= self.schema_version, 'version': version, 'required': self.schema_version}
+
+    def check_wal(self, journal_mode):
+        """WALファイルの大きさとチェックポイント未反映のフレーム数（WALモード以外は対象外）"""
+        if journal_mode != 'wal':
+            return {'ok': True, 'journal_mode': journal_mode}
+        try:
+            size_mb = round(os.path.getsize(self.db_path + '-wal') / 1024 / 1024, 2)
+        except OSError:
+            size_mb = 0.0
+        conn = self.connect()
+        try:
+            # PASSIVE は他の接続を待たずに反映できる分だけ反映する
+            busy, frames, done = conn.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+        finally:
+            conn.close()
+        lag = max(0, frames - done) if frames >= 0 else None
+        return {
+            'ok': size_mb <= self.thresholds['wal_mb'] and (lag or 0) <= self.thresholds['checkpoint_lag'],
+            'journal_mode': journal_mode,
+            'size_mb': size_mb,
+            'limit_mb': self.thresholds['wal_mb'],
+            'checkpoint_lag': lag,
+            'checkpoint_busy': bool(busy),
+            'limit_lag': self.thresholds['checkpoint_lag']
+        }
+
+    def check_audit(self):
+        """監査ログの書き込み待ちの件数"""
+        pending = self.pending()
+        limit = self.thresholds['audit_pending']
+        return {'ok': pending <= limit, 'pending': pending, 'limit': limit}
+
+    def check_socketio(self):
+        """バックグラウンド処理が始まるまでの時間（イベントループが止まっていないか）"""
+        limit = self.thresholds['socketio_latency_ms']
+        started = time.perf_counter()
+        ran = []
+        self.socketio.start_background_task(ran.append, True)
+        # socketio.sleep は eventlet などではイベントループに処理を譲る
+        while not ran and time.perf_counter() - started < limit / 1000:
+            self.socketio.sleep(0.001)
+        latency = round((time.perf_counter() - started) * 1000, 2)
+        return {'ok': bool(ran), 'latency_ms': latency, 'limit_ms': limit,
+                'async_mode': self.socketio.async_mode}
+
+    def check_disk(self):
+        """DBのあるディスクの空き容量"""
+        usage = shutil.disk_usage(os.path.dirname(os.path.abspath(self.db_path)))
+        free_mb = usage.free // (1024 * 1024)
+        limit = self.thresholds['disk_free_mb']
+        return {'ok': free_mb >= limit, 'free_mb': free_mb, 'limit_mb': limit}
+
+    # ---------- まとめて確認 ----------
+
+    def run(self):
+        """すべての確認を実行（例外が出た項目は失敗とする）"""
+        checks = {}
+
+        def attempt(name, func, *args):
+            try:
+                checks[name] = func(*args)
+            except (sqlite3.Error, OSError, RuntimeError) as e:
+                checks[name] = {'ok': False, 'error': str(e)}
+            return checks[name]
+
+        db = attempt('db', self.check_db)
+        if self.schema_version is not None:
+            attempt('schema', self.check_schema, db.get('schema_version'))
+        attempt('wal', self.check_wal, db.get('journal_mode'))
+        attempt('audit_writer', self.check_audit)
+        attempt('socketio', self.check_socketio)
+        attempt('disk', self.check_disk)
+        failed = [name for name, result in checks.items() if not result['ok']]
+        return {'ready': not failed, 'failed': failed, 'checks': checks}
+
+    def status(self):
+        """
+        確認の結果（cache_seconds 以内の結果があれば再利用）
+
+        確認中に届いた問い合わせには前回の結果を返します（確認中は待たせない）。
+
+        Returns:
+            {'ready', 'failed': [項目], 'checks': {項目: {...}}, 'checked_seconds_ago'}
+        """
+        with self._lock:
+            result, checked_at = self._result, self._checked_at
+            stale = result is None or self.clock() - checked_at >= self.cache_seconds
+            if stale and not (self._running and result is not None):
+                self._running = True
+            else:
+                stale = False
+        if stale:
+            try:
+                result, checked_at = self.run(), self.clock()
+                with self._lock:
+                    self._result, self._checked_at = result, checked_at
+            finally:
+                self._running = False
+        return dict(result, checked_seconds_ago=round(self.clock() - checked_at, 3))
@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+"""
+変更履歴（history）の整理とアーカイブ
+
+- 直近 COMPACT_DAYS 日の履歴はそのまま残す
+- それより古い履歴は、同じユーザーによる連続した更新（MERGE_WINDOW_HOURS 以内）を
+  1件にまとめる（最初の変更前データと最後の変更後データを残す）
+- ARCHIVE_DAYS 日より古い履歴はアーカイブDB（hospital_data.archive.sqlite3）へ移動
+
+アーカイブDBは ATTACH して読み込み、/api/history/<code> はアーカイブ分も含めて
+ページングします。
+
+使い方:
+    python history_archive.py compact                  # まとめる + アーカイブへ移動
+    python history_archive.py compact --dry-run        # 件数のみ表示
+    python history_archive.py stats
+
+    HISTORY_COMPACT_DAYS        そのまま残す日数（既定: 90）
+    HISTORY_MERGE_WINDOW_HOURS  まとめる連続更新の間隔（既定: 24）
+    HISTORY_ARCHIVE_DAYS        アーカイブへ移動する日数（既定: 365）
+    HISTORY_ARCHIVE_PATH        アーカイブDBのパス（既定: <DB名>.archive.sqlite3）
+"""
+
+import argparse
+import os
+import sqlite3
+from datetime import datetime, timedelta, timezone
+
+import json_engine
+import storage_codec
+
+DB_PATH = os.environ.get('DATABASE_PATH', 'hospital_data.sqlite3')
+COMPACT_DAYS = int(os.environ.get('HISTORY_COMPACT_DAYS', 90))
+MERGE_WINDOW_HOURS = int(os.environ.get('HISTORY_MERGE_WINDOW_HOURS', 24))
+ARCHIVE_DAYS = int(os.environ.get('HISTORY_ARCHIVE_DAYS', 365))
+
+SCHEMA = 'archive'
+
+HISTORY_COLUMNS = ('id', 'code', 'action', 'old_data', 'new_data', 'changed_fields',
+                   'user_id', 'username', 'created_at', 'merged_count', 'first_created_at')
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+def archive_path(database):
+    """アーカイブDBのパス"""
+    path = os.environ.get('HISTORY_ARCHIVE_PATH')
+    if path:
+        return path
+    base, _ = os.path.splitext(database)
+    return f'{base}.archive.sqlite3'
+
+def ensure_columns(conn, schema='main'):
+    """history にまとめた件数の列を追加"""
+    columns = {row[1] for row in conn.execute(f'PRAGMA {schema}.table_info(history)')}
+    if 'merged_count' not in columns:
+        conn.execute(f'ALTER TABLE {schema}.history ADD COLUMN merged_count INTEGER NOT NULL DEFAULT 1')
+    if 'first_created_at' not in columns:
+        conn.execute(f'ALTER TABLE {schema}.history ADD COLUMN first_created_at TIMESTAMP')
+    conn.execute(f'''
+        CREATE INDEX IF NOT EXISTS {schema}.idx_history_code_created
+        ON history(code, created_at DESC, id DESC)
+    ''')
+
+def _create_archive_tables(conn):
+    conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS {SCHEMA}.history (
+            id INTEGER PRIMARY KEY,
+            code TEXT NOT NULL,
+            action TEXT NOT NULL,
+            old_data TEXT,
+            new_data TEXT,
+            changed_fields TEXT,
+            user_id INTEGER NOT NULL,
+            username TEXT NOT NULL,
+            created_at TIMESTAMP,
+            merged_count INTEGER NOT NULL DEFAULT 1,
+            first_created_at TIMESTAMP
+        )
+    ''')
+    ensure_columns(conn, SCHEMA)
+
+def attach(conn, database=DB_PATH, create=False):
+    """
+    アーカイブDBを ATTACH する
+
+    Args:
+        create: ファイルがない場合に作成する（整理ジョブ用）
+
+    Returns:
+        ATTACH した場合は True（アーカイブDBがない場合は False）
+    """
+    path = archive_path(database)
+    if not create and not os.path.exists(path):
+        return False
+    attached = {row[1] for row in conn.execute('PRAGMA database_list')}
+    if SCHEMA not in attached:
+        conn.execute(f'ATTACH DATABASE ? AS {SCHEMA}', (path,))
+    if create:
+        _create_archive_tables(conn)
+    return True
+
+# ============================================
+# 読み込み（APIから使用）
+# ============================================
+
+def _select(tiers, where):
+    columns = ', '.join(HISTORY_COLUMNS)
+    parts = [f"SELECT {columns}, 'hot' AS tier FROM main.history WHERE {where}"]
+    if 'cold' in tiers:
+        parts.append(f"SELECT {columns}, 'cold' AS tier FROM {SCHEMA}.history WHERE {where}")
+    return ' UNION ALL '.join(parts)
+
+def count_by_code(conn, code, tiers=('hot',)):
+    """病院ごとの履歴件数（アーカイブ分を含む）"""
+    total = conn.execute('SELECT COUNT(*) FROM main.history WHERE code = ?', (code,)).fetchone()[0]
+    if 'cold' in tiers:
+        total += conn.execute(f'SELECT COUNT(*) FROM {SCHEMA}.history WHERE code = ?', (code,)).fetchone()[0]
+    return total
+
+def page_by_code(conn, code, limit, offset, tiers=('hot',)):
+    """
+    病院ごとの履歴を新しい順に1ページ分取得
+
+    アーカイブへ移した行は必ず残っている行より古いため、
+    新しい順に並べると hot → cold の順に続きます。
+    """
+    params = [code] * len(tiers)
+    return conn.execute(f'''
+        {_select(tiers, 'code = ?')}
+        ORDER BY created_at DESC, id DESC
+        LIMIT ? OFFSET ?
+    ''', params + [limit, offset]).fetchall()
+
+def get_entry(conn, code, history_id, tiers=('hot',)):
+    """履歴1件を取得（アーカイブ分を含む）"""
+    params = [code, history_id] * len(tiers)
+    return conn.execute(_select(tiers, 'code = ? AND id = ?'), params).fetchone()
+
+# ============================================
+# 整理ジョブ
+# ============================================
+
+def _utcnow():
+    # CURRENT_TIMESTAMP と同じ UTC で比較する
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def _parse_time(value):
+    return datetime.strptime(value[:19], TIMESTAMP_FORMAT)
+
+def _diff(old_data, new_data):
+    """変更されたフィールド（app.diff_fields と同じ比較）"""
+    if not old_data or not new_data:
+        return []
+    return [key for key in set(old_data) | set(new_data) if old_data.get(key, '') != new_data.get(key, '')]
+
+def _runs(rows, window):
+    """同じユーザーによる連続した更新をまとめる単位に分ける"""
+    run = []
+    for row in rows:
+        if run:
+            last = run[-1]
+            mergeable = (
+                row['action'] == 'update'
+                and last['action'] in ('create', 'update')
+                and row['user_id'] == last['user_id']
+                and _parse_time(row['first_created_at'] or row['created_at']) - _parse_time(last['created_at']) <= window
+            )
+            if not mergeable:
+                yield run
+                run = []
+        run.append(row)
+    if run:
+        yield run
+
+def _merge(conn, codec, run):
+    """まとめた内容を最後の行に書き込み、それ以外の行を削除"""
+    first, last = run[0], run[-1]
+    old_data = codec.loads(first['old_data']) if first['old_data'] else None
+    new_data = codec.loads(last['new_data']) if last['new_data'] else None
+    changed_fields = _diff(old_data, new_data)
+    conn.execute('''
+        UPDATE history
+        SET action = ?, old_data = ?, changed_fields = ?, merged_count = ?, first_created_at = ?
+        WHERE id = ?
+    ''', (first['action'], first['old_data'],
+          json_engine.dumps(changed_fields) if changed_fields else None,
+          sum(row['merged_count'] for row in run),
+          first['first_created_at'] or first['created_at'],
+          last['id']))
+    conn.executemany('DELETE FROM history WHERE id = ?', [(row['id'],) for row in run[:-1]])
+
+def compact(conn, codec, compact_days=COMPACT_DAYS, merge_window_hours=MERGE_WINDOW_HOURS, now=None, dry_run=False):
+    """
+    古い履歴の連続した更新をまとめる
+
+    Returns:
+        {'codes', 'merged_rows', 'removed_rows'}
+    """
+    now = now or _utcnow()
+    cutoff = (now - timedelta(days=compact_days)).strftime(TIMESTAMP_FORMAT)
+    window = timedelta(hours=merge_window_hours)
+    result = {'codes': 0, 'merged_rows': 0, 'removed_rows': 0}
+
+    codes = [row[0] for row in conn.execute(
+        'SELECT DISTINCT code FROM history WHERE created_at < ?', (cutoff,))]
+    for code in codes:
+        rows = conn.execute('''
+            SELECT id, action, old_data, new_data, user_id, created_at, merged_count, first_created_at
+            FROM history
+            WHERE code = ? AND created_at < ?
+            ORDER BY created_at, id
+        ''', (code, cutoff)).fetchall()
+        runs = [run for run in _runs(rows, window) if len(run) > 1]
+        if not runs:
+            continue
+        result['codes'] += 1
+        result['merged_rows'] += len(runs)
+        result['removed_rows'] += sum(len(run) - 1 for run in runs)
+        if dry_run:
+            continue
+        with conn:
+            for run in runs:
+                _merge(conn, codec, run)
+    return result
+
+def move_to_archive(conn, archive_days=ARCHIVE_DAYS, now=None, batch_size=1000, dry_run=False):
+    """
+    古い履歴をアーカイブDBへ移動
+
+    同じ id で書き込むため、途中で中断しても再実行で重複しません。
+
+    Returns:
+        移動した件数
+    """
+    now = now or _utcnow()
+    cutoff = (now - timedelta(days=archive_days)).strftime(TIMESTAMP_FORMAT)
+    if dry_run:
+        return conn.execute('SELECT COUNT(*) FROM main.history WHERE created_at < ?', (cutoff,)).fetchone()[0]
+
+    columns = ', '.join(HISTORY_COLUMNS)
+    moved = 0
+    while True:
+        ids = [row[0] for row in conn.execute(
+            'SELECT id FROM main.history WHERE created_at < ? ORDER BY id LIMIT ?', (cutoff, batch_size))]
+        if not ids:
+            break
+        placeholders = ','.join('?' * len(ids))
+        with conn:
+            conn.execute(f'''
+                INSERT OR IGNORE INTO {SCHEMA}.history ({columns})
+                SELECT {columns} FROM main.history WHERE id IN ({placeholders})
+            ''', ids)
+            conn.execute(f'DELETE FROM main.history WHERE id IN ({placeholders})', ids)
+        moved += len(ids)
+        print(f"📦 履歴をアーカイブへ移動: {len(ids)}件（累計 {moved}件）")
+    return moved
+
+# ============================================
+# コマンドライン
+# ============================================
+
+def print_stats(conn, tiers):
+    hot = conn.execute('''
+        SELECT COUNT(*) AS n, MIN(created_at) AS oldest, SUM(merged_count > 1) AS merged
+        FROM main.history
+    ''').fetchone()
+    print(f"📊 history（hot）:  {hot[0]}行（最古: {hot[1] or '-'}、まとめた行: {hot[2] or 0}）")
+    if 'cold' in tiers:
+        cold = conn.execute(f'''
+            SELECT COUNT(*) AS n, MIN(created_at) AS oldest, MAX(created_at) AS newest
+            FROM {SCHEMA}.history
+        ''').fetchone()
+        print(f"📊 history（cold）: {cold[0]}行（{cold[1] or '-'} 〜 {cold[2] or '-'}）")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='変更履歴の整理とアーカイブ')
+    parser.add_argument('--database', default=DB_PATH, help='データベースファイル')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p_compact = sub.add_parser('compact', help='古い履歴をまとめてアーカイブへ移動')
+    p_compact.add_argument('--compact-days', type=int, default=COMPACT_DAYS, help='そのまま残す日数')
+    p_compact.add_argument('--merge-window-hours', type=int, default=MERGE_WINDOW_HOURS,
+                           help='まとめる連続更新の間隔（時間）')
+    p_compact.add_argument('--archive-days', type=int, default=ARCHIVE_DAYS, help='アーカイブへ移動する日数')
+    p_compact.add_argument('--dry-run', action='store_true', help='件数のみ表示')
+
+    sub.add_parser('stats', help='hot / cold の件数を表示')
+
+    args = parser.parse_args(argv)
+    conn = sqlite3.connect(args.database)
+    conn.row_factory = sqlite3.Row
+    try:
+        ensure_columns(conn)
+        conn.commit()
+        if args.command == 'compact':
+            codec = storage_codec.load_codec(conn)
+            result = compact(conn, codec, args.compact_days, args.merge_window_hours, dry_run=args.dry_run)
+            print(f"🧹 {result['codes']}病院 / {result['merged_rows']}件にまとめ、{result['removed_rows']}行を削除"
+                  + ('（dry-run）' if args.dry_run else ''))
+            attach(conn, args.database, create=not args.dry_run)
+            moved = move_to_archive(conn, args.archive_days, dry_run=args.dry_run)
+            print(f"✅ アーカイブへ移動: {moved}件" + ('（dry-run）' if args.dry_run else ''))
+        tiers = ('hot', 'cold') if attach(conn, args.database) else ('hot',)
+        print_stats(conn, tiers)
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+病院名・都道府県の一覧（メモリ上のインデックス）
+
+/api/prefectures・/api/hospitals・/api/mdata/search のたびに mdata の全件を
+読み込んで kv を解析しないよう、病院コードと病院名の一覧をメモリに保持します。
+
+mdata が更新されると mdata_version.version が増える（トリガー）ため、
+値が変わっていれば読み込み直します（他のワーカーでの保存も反映されます）。
+gunicorn --preload の場合はフォーク前に読み込み、ワーカー間で共有されます。
+"""
+
+import bisect
+import threading
+
+# 都道府県コードと名前のマッピング
+PREFECTURE_NAMES = {
+    '01': '北海道', '02': '青森県', '03': '岩手県', '04': '宮城県', '05': '秋田県',
+    '06': '山形県', '07': '福島県', '08': '茨城県', '09': '栃木県', '10': '群馬県',
+    '11': '埼玉県', '12': '千葉県', '13': '東京都', '14': '神奈川県', '15': '新潟県',
+    '16': '富山県', '17': '石川県', '18': '福井県', '19': '山梨県', '20': '長野県',
+    '21': '岐阜県', '22': '静岡県', '23': '愛知県', '24': '三重県', '25': '滋賀県',
+    '26': '京都府', '27': '大阪府', '28': '兵庫県', '29': '奈良県', '30': '和歌山県',
+    '31': '鳥取県', '32': '島根県', '33': '岡山県', '34': '広島県', '35': '山口県',
+    '36': '徳島県', '37': '香川県', '38': '愛媛県', '39': '高知県', '40': '福岡県',
+    '41': '佐賀県', '42': '長崎県', '43': '熊本県', '44': '大分県', '45': '宮崎県',
+    '46': '鹿児島県', '47': '沖縄県'
+}
+
+def prefecture_name(pref_code):
+    return PREFECTURE_NAMES.get(pref_code, f'都道府県{pref_code}')
+
+class HospitalIndex:
+    """
+    病院コード・病院名の一覧
+
+    Args:
+        connect: DB接続を返す関数
+        get_codec: kv のコーデックを返す関数
+    """
+
+    def __init__(self, connect, get_codec):
+        self.connect = connect
+        self.get_codec = get_codec
+        self.version = None
+        self.codes = ()         # 全病院コード（昇順）
+        self.names = {}         # code -> 病院名（病院名がある病院のみ）
+        self._lock = threading.Lock()
+
+    def _current_version(self, conn):
+        row = conn.execute('SELECT version FROM mdata_version WHERE id = 1').fetchone()
+        return row[0] if row else 0
+
+    def load(self):
+        """mdata の全件から一覧を作成"""
+        codec = self.get_codec()
+        conn = self.connect()
+        try:
+            version = self._current_version(conn)
+            rows = conn.execute('SELECT code, kv FROM mdata ORDER BY code').fetchall()
+        finally:
+            conn.close()
+
+        codes, names = [], {}
+        for code, kv in rows:
+            codes.append(code)
+            try:
+                name = codec.loads(kv).get('病院名', '')
+            except Exception:
+                # JSONのパースに失敗した場合は一覧に含めない
+                continue
+            if name:
+                names[code] = name
+
+        self.codes, self.names, self.version = tuple(codes), names, version
+        print(f"🏥 病院一覧を読み込みました: {len(codes)}件")
+
+    def refresh_if_changed(self):
+        """mdata が更新されていれば読み込み直す"""
+        conn = self.connect()
+        try:
+            version = self._current_version(conn)
+        finally:
+            conn.close()
+        if version != self.version:
+            # 同時に検知したスレッドのうち1つだけが読み込む
+            with self._lock:
+                if version != self.version:
+                    self.load()
+
+    # ============================================
+    # 参照
+    # ============================================
+
+    def prefectures(self):
+        """病院がある都道府県の一覧"""
+        self.refresh_if_changed()
+        pref_codes = sorted({code[:2] for code in self.codes})
+        return [{'code': pref_code, 'name': prefecture_name(pref_code)} for pref_code in pref_codes]
+
+    def search(self, prefix=''):
+        """病院コードの前方一致検索"""
+        self.refresh_if_changed()
+        codes = self.codes
+        if not prefix:
+            return list(codes)
+        start = bisect.bisect_left(codes, prefix)
+        end = start
+        while end < len(codes) and codes[end].startswith(prefix):
+            end += 1
+        return list(codes[start:end])
+
+    def hospitals(self, prefecture):
+        """都道府県内の病院（病院名がある病院のみ）"""
+        codes = self.search(f'{prefecture}-')
+        names = self.names
+        return [{'code': code, 'name': names[code]} for code in codes if code in names]
@@ -3,6 +3,10 @@ import json
 import csv
 import codecs
 
+import aggregate_stats
+import geo
+import storage_codec
+
 def import_csv_to_database(csv_filename, db_filename='hospital_data.sqlite3'):
     """
     CSVファイルからデータベースにデータをインポート（改良版）
@@ -88,6 +92,16 @@ def import_csv_to_database(csv_filename, db_filename='hospital_data.sqlite3'):
     # コミット
     conn.commit()
     
+    # 医師数の集計を作り直す（保存時の差分更新を通らないため）
+    codec = storage_codec.load_codec(conn)
+    doctors = aggregate_stats.rebuild(conn, codec)
+    print(f'📊 医師数の集計を作り直しました: {doctors}件')
+    
+    # 病院の座標を作り直す（郵便番号の座標が読み込まれている場合）
+    if cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'geo_postcodes'").fetchone():
+        located, total = geo.rebuild(conn, codec)
+        print(f'🗺️  病院の座標を作り直しました: {located}/{total}件')
+    
     # 結果を表示
     print('\n' + '='*50)
     print(f'✅ インポート完了!')
@@ -115,10 +129,14 @@ def import_csv_to_database(csv_filename, db_filename='hospital_data.sqlite3'):
     print('\n🎉 全ての処理が完了しました!')
 
 if __name__ == '__main__':
-    csv_filename = 'csv研修医有1072×837 .csv'
+    import sys
+    
+    # 引数でCSV・DBを指定可能（例: python import_csv_data.py scale_x10.csv scale.sqlite3）
+    csv_filename = sys.argv[1] if len(sys.argv) > 1 else 'csv研修医有1072×837 .csv'
+    db_filename = sys.argv[2] if len(sys.argv) > 2 else 'hospital_data.sqlite3'
     
     try:
-        import_csv_to_database(csv_filename)
+        import_csv_to_database(csv_filename, db_filename)
     except Exception as e:
         print(f'❌ エラーが発生しました: {e}')
         import traceback
@@ -74,62 +74,59 @@ async function fillFromServer() {
     return;
   }
 
-  // ロック切り替え
-  if (currentLockCode && currentLockCode !== code) {
-    await releaseLock(currentLockCode);
-  }
-
-  const ok = await acquireLock(code);
-  if (!ok) {
-    decorateCodeSelect();
-    return;
-  }
-
   isLoadingData = true;
   setStatus('データ取得中...');
   
   try {
-    const r = await fetch(`${API}/api/mdata/${encodeURIComponent(code)}`);
+    // 前の病院のロック解放・ロック取得・データ取得を1回のリクエストで行う
+    const previous = currentLockCode && currentLockCode !== code ? currentLockCode : null;
+    if (previous) stopHeartbeat();
+    const r = await fetch(`${API}/api/mdata/${encodeURIComponent(code)}/open`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ release: previous, fields: 'meta,main,facilities,vendors', shape: 'tables' })
+    });
     const j = await safeJSON(r);
+    if (previous) forgetLock(previous);
+    
+    if (r.status === 409) {
+      isLoadingData = false;
+      currentLocks[code] = j.lock || { username: j.locked_by };
+      decorateCodeSelect();
+      setStatus(`このコードは ${j.locked_by} が使用中です`, 'error');
+      return;
+    }
+    
+    if (r.status === 429) {
+      isLoadingData = false;
+      setStatus(busyMessage(r, j), 'error');
+      return;
+    }
     
     if (!r.ok || !j.ok) {
       isLoadingData = false;
       setStatus('データが見つかりません', 'error');
-      await releaseLock(code);
       return;
     }
 
-    currentData = { code: j.code, kv: j.kv || {} };
+    LOCK_AVAILABLE = true;
+    currentLockCode = code;
+    currentLocks[code] = { ...j.lock, code };
+    decorateCodeSelect();
+    updateActiveUsersCount();
+    startHeartbeat();
+
+    currentData = { code: j.code, kv: j.kv || {}, version: j.version, history: j.history };
     const kv = currentData.kv;
 
     // メタ情報設定
     setMeta(kv);
 
-    // テーブルデータ設定
-    setTableData(
-      document.getElementById('tbody'),
-      kv,
-      9,
-      TABLE_KEYS.main,
-      DEFAULT_ROWS.main,
-      'main'
-    );
-    setTableData(
-      document.getElementById('facilities-tbody'),
-      kv,
-      3,
-      TABLE_KEYS.facilities,
-      DEFAULT_ROWS.facilities,
-      'facilities'
-    );
-    setTableData(
-      document.getElementById('vendors-tbody'),
-      kv,
-      4,
-      TABLE_KEYS.vendors,
-      DEFAULT_ROWS.vendors,
-      'vendors'
-    );
+    // テーブルデータ設定（サーバーで行の配列に変換済み）
+    const tables = j.tables || {};
+    setTableRows(document.getElementById('tbody'), tables.main || [], 9, DEFAULT_ROWS.main, 'main');
+    setTableRows(document.getElementById('facilities-tbody'), tables.facilities || [], 3, DEFAULT_ROWS.facilities, 'facilities');
+    setTableRows(document.getElementById('vendors-tbody'), tables.vendors || [], 4, DEFAULT_ROWS.vendors, 'vendors');
 
     setStatus(LOCK_AVAILABLE ? `編集中: ${currentUsername}` : '転記完了', 'success');
     setButtons(true);
@@ -167,7 +164,15 @@ async function saveToServer() {
       setStatus(`保存しました（${j.updated ?? 0}項目）`, 'success');
       syncMetaFields();
       window.isDirty = false;
-      alert('変更を保存しました。');
+      const warnings = formatViolations(j.warnings);
+      alert(warnings ? `変更を保存しました。\n\n確認してください:\n${warnings}` : '変更を保存しました。');
+    } else if (r.status === 429) {
+      // 混雑中（変更は画面に残っているため、時間をおいて保存し直す）
+      setStatus(busyMessage(r, j), 'error');
+    } else if (j && j.violations) {
+      // 入力チェックのエラー（保存されていない）
+      setStatus('入力内容を確認してください', 'error');
+      alert(`保存できませんでした。\n\n${formatViolations(j.violations)}`);
     } else {
       setStatus((j && j.error) || '保存失敗', 'error');
     }
@@ -176,6 +181,17 @@ async function saveToServer() {
   }
 }
 
+// 429（流量制限・混雑）の表示
+function busyMessage(r, j) {
+  const seconds = Number(r.headers.get('Retry-After')) || (j && j.retry_after) || 1;
+  return `サーバーが混雑しています。${seconds}秒ほど待ってから再度お試しください`;
+}
+
+// 入力チェックの結果を1行ずつの文字列に
+function formatViolations(violations) {
+  return (violations || []).map(v => `・${v.field}: ${v.message}`).join('\n');
+}
+
 /* ===== 保存データ収集 ===== */
 function collectForSave() {
   if (!currentData || !currentData.code) return null;
@@ -6,7 +6,7 @@ async function detectLockAPI() {
     if (r.ok && j.ok) {
       LOCK_AVAILABLE = true;
       console.log('✅ Lock API enabled');
-      currentLocks = j.locks || {};
+      currentLocks = locksByCode(j.locks);
       updateActiveUsersCount();
     } else {
       LOCK_AVAILABLE = false;
@@ -18,6 +18,12 @@ async function detectLockAPI() {
   }
 }
 
+// /api/lock/status はロックの配列を返すため、コードをキーにした形に変換
+function locksByCode(locks) {
+  if (!Array.isArray(locks)) return locks || {};
+  return Object.fromEntries(locks.map(lock => [lock.code, lock]));
+}
+
 /* ===== ハートビート（生存確認） ===== */
 function startHeartbeat() {
   if (!LOCK_AVAILABLE || !currentLockCode) return;
@@ -25,15 +31,16 @@ function startHeartbeat() {
   heartbeatInterval = setInterval(async () => {
     if (currentLockCode) {
       try {
-        await fetch(`${API}/api/lock/heartbeat`, {
+        const r = await fetch(`${API}/api/lock/heartbeat`, {
           method: 'POST',
           headers: { 'Content-Type': 'application/json' },
-          body: JSON.stringify({
-            code: currentLockCode,
-            user_id: currentUserId,
-            timestamp: Date.now()
-          })
+          body: JSON.stringify({ code: currentLockCode })
         });
+        if (r.status === 409) {
+          // ロックが解除された（保存すると他のユーザーの編集と重なる可能性がある）
+          stopHeartbeat();
+          setStatus('編集中のロックが解除されました。開き直してから保存してください', 'error');
+        }
       } catch (e) {
         console.warn('Heartbeat failed:', e);
       }
@@ -59,11 +66,7 @@ async function acquireLock(code) {
   }
 
   try {
-    const r = await fetch(`${API}/api/lock/acquire`, {
-      method: 'POST',
-      headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify({ code, user_id: currentUserId, username: currentUsername })
-    });
+    const r = await fetch(`${API}/api/lock/${encodeURIComponent(code)}`, { method: 'POST' });
     const j = await safeJSON(r);
 
     if (r.ok && j.ok) {
@@ -105,27 +108,26 @@ async function releaseLock(code) {
   }
 
   try {
-    const payload = JSON.stringify({ code, user_id: currentUserId });
-    if (document.visibilityState === 'hidden') {
-      const blob = new Blob([payload], { type: 'application/json' });
-      navigator.sendBeacon?.(`${API}/api/lock/release`, blob);
-    } else {
-      await fetch(`${API}/api/lock/release`, {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: payload
-      });
-    }
+    // keepalive: ページ離脱・非表示時もリクエストを送信しきる
+    await fetch(`${API}/api/lock/${encodeURIComponent(code)}`, {
+      method: 'DELETE',
+      keepalive: true
+    });
   } catch (e) {
     console.warn('ロック解除エラー:', e);
   } finally {
-    if (currentLocks[code] && currentLocks[code].user_id === currentUserId) {
-      delete currentLocks[code];
-    }
-    if (currentLockCode === code) currentLockCode = null;
-    decorateCodeSelect();
-    updateActiveUsersCount();
+    forgetLock(code);
+  }
+}
+
+// 自分のロックを画面上の状態から削除
+function forgetLock(code) {
+  if (currentLocks[code] && currentLocks[code].user_id === currentUserId) {
+    delete currentLocks[code];
   }
+  if (currentLockCode === code) currentLockCode = null;
+  decorateCodeSelect();
+  updateActiveUsersCount();
 }
 
 /* ===== ロック一覧取得 ===== */
@@ -135,7 +137,7 @@ async function fetchLocks() {
     const r = await fetch(`${API}/api/lock/status`);
     const j = await safeJSON(r);
     if (r.ok && j.ok && j.locks) {
-      currentLocks = j.locks;
+      currentLocks = locksByCode(j.locks);
       updateActiveUsersCount();
     }
   } catch (e) {
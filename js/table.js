@@ -110,19 +110,26 @@ function setMeta(kv) {
 /* ===== テーブルデータ設定 ===== */
 function setTableData(tbody, kv, cols, keys, minRows, idPrefix) {
   const dataRows = getRowCountFromData(kv, keys);
-  const displayRows = Math.max(dataRows, minRows);
+  const rows = [];
+  for (let n = 1; n <= dataRows; n++) {
+    rows.push(keys.map(key => readSeries(kv, key, n)));
+  }
+  setTableRows(tbody, rows, cols, minRows, idPrefix);
+}
+
+/* ===== テーブルデータ設定（サーバーで行の配列に変換済み: shape=tables） ===== */
+function setTableRows(tbody, rows, cols, minRows, idPrefix) {
+  const displayRows = Math.max(rows.length, minRows);
   
   tbody.innerHTML = '';
   buildRows(tbody, displayRows, cols, idPrefix);
   
   const cells = tbody.querySelectorAll('.editable[contenteditable]');
-  for (let i = 0; i < displayRows; i++) {
-    const n = i + 1;
+  for (let i = 0; i < rows.length; i++) {
     for (let j = 0; j < cols; j++) {
       const cell = cells[i * cols + j];
       if (cell) {
-        const value = i < dataRows ? readSeries(kv, keys[j], n) : '';
-        cell.textContent = value || '';
+        cell.textContent = rows[i][j] || '';
       }
     }
   }
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+JSONエンジンの切り替え
+
+orjson / msgspec がインストールされていればそれを使い、なければ標準の json で
+動作します。病院データ（837項目）の保存・読み込み、履歴、APIレスポンス、
+Socket.IO のパケットで共通して使います。
+
+環境変数 JSON_ENGINE で明示的に選択できます（auto / orjson / msgspec / stdlib）。
+
+    pip install orjson   # 任意（高速化）
+"""
+
+import json as _json
+import os
+
+JSON_ENGINE = os.environ.get('JSON_ENGINE', 'auto')
+
+def _stdlib_engine():
+    def dumps_bytes(obj, sort_keys=False, default=None):
+        return _json.dumps(obj, ensure_ascii=False, sort_keys=sort_keys, default=default,
+                           separators=(',', ':')).encode('utf-8')
+
+    def loads(s):
+        return _json.loads(s)
+
+    return 'stdlib', dumps_bytes, loads
+
+def _orjson_engine():
+    import orjson
+
+    base_option = orjson.OPT_NON_STR_KEYS
+
+    def dumps_bytes(obj, sort_keys=False, default=None):
+        option = base_option | orjson.OPT_SORT_KEYS if sort_keys else base_option
+        return orjson.dumps(obj, default=default, option=option)
+
+    def loads(s):
+        return orjson.loads(s)
+
+    return 'orjson', dumps_bytes, loads
+
+def _msgspec_engine():
+    import msgspec
+
+    encoders = {}
+    decoder = msgspec.json.Decoder()
+
+    def dumps_bytes(obj, sort_keys=False, default=None):
+        key = (sort_keys, default)
+        encoder = encoders.get(key)
+        if encoder is None:
+            encoder = encoders[key] = msgspec.json.Encoder(
+                enc_hook=default, order='sorted' if sort_keys else None)
+        return encoder.encode(obj)
+
+    def loads(s):
+        try:
+            return decoder.decode(s)
+        except msgspec.DecodeError as e:
+            # 標準jsonと同様に ValueError として扱えるようにする
+            raise ValueError(str(e)) from e
+
+    return 'msgspec', dumps_bytes, loads
+
+_ENGINES = {
+    'orjson': _orjson_engine,
+    'msgspec': _msgspec_engine,
+    'stdlib': _stdlib_engine,
+}
+
+def load_engine(name='auto'):
+    """
+    JSONエンジンを読み込み (名前, dumps_bytes, loads) を返す
+
+    Args:
+        name: 'auto' の場合は orjson → msgspec → stdlib の順に試す
+    """
+    if name != 'auto':
+        if name not in _ENGINES:
+            raise ValueError(f'Unknown JSON engine: {name}')
+        return _ENGINES[name]()
+
+    for candidate in ('orjson', 'msgspec'):
+        try:
+            return _ENGINES[candidate]()
+        except ImportError:
+            continue
+    return _stdlib_engine()
+
+ENGINE_NAME, dumps_bytes, _loads = load_engine(JSON_ENGINE)
+
+def dumps(obj, sort_keys=False, default=None, **kwargs):
+    """
+    JSON文字列に変換（日本語はエスケープしない）
+
+    Socket.IO から separators などが渡されても無視します（常にコンパクトな出力）。
+    """
+    return dumps_bytes(obj, sort_keys=sort_keys, default=default).decode('utf-8')
+
+def loads(s, **kwargs):
+    """JSON文字列（str / bytes）を解析"""
+    return _loads(s)
+
+# ============================================
+# Flask 用 JSONプロバイダ
+# ============================================
+
+try:
+    from flask.json.provider import DefaultJSONProvider
+except ImportError:  # Flaskなしでスクリプトから使う場合
+    DefaultJSONProvider = None
+
+if DefaultJSONProvider is not None:
+    class FastJSONProvider(DefaultJSONProvider):
+        """jsonify / request.json を選択中のJSONエンジンで処理する"""
+
+        ensure_ascii = False
+
+        def dumps(self, obj, **kwargs):
+            return dumps(obj, sort_keys=kwargs.get('sort_keys', self.sort_keys), default=self.default)
+
+        def loads(self, s, **kwargs):
+            # セッションのタグ付きJSON（object_hook 指定）は標準jsonで処理
+            if kwargs:
+                return super().loads(s, **kwargs)
+            return loads(s)
+
+        def response(self, *args, **kwargs):
+            obj = self._prepare_response_obj(args, kwargs)
+            return self._app.response_class(
+                dumps_bytes(obj, sort_keys=self.sort_keys, default=self.default),
+                mimetype=self.mimetype,
+            )
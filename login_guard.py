@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+ログイン処理の保護
+
+- PasswordVerifier: パスワードハッシュの検証を別プロセスで実行（リクエスト処理を止めない）
+- LoginThrottle: IPアドレス・ユーザー名ごとの失敗回数を記録し、上限を超えた試行を
+  DB検索やハッシュ計算の前に拒否
+
+    LOGIN_HASH_WORKERS         ハッシュ検証プロセス数（0 の場合はリクエスト内で実行）
+    LOGIN_HASH_QUEUE           検証待ちの上限（超えた場合は混雑として拒否）
+    LOGIN_MAX_FAILURES_USER    ユーザー名ごとの失敗上限（既定: 5回）
+    LOGIN_MAX_FAILURES_IP      IPアドレスごとの失敗上限（既定: 20回）
+    LOGIN_FAILURE_WINDOW       失敗回数を数える期間（秒、既定: 600）
+    LOGIN_LOCKOUT_SECONDS      上限到達後に拒否する時間（秒、既定: 300）
+"""
+
+import multiprocessing
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+
+from werkzeug.security import check_password_hash
+
+def _env_int(name, default):
+    return int(os.environ.get(name, default))
+
+def _in_greenthread():
+    """eventlet のハブ上（グリーンスレッド内）で実行中か"""
+    try:
+        import greenlet
+    except ImportError:
+        return False
+    # 通常のOSスレッド（threaded な WSGI サーバーなど）では親を持たない
+    return greenlet.getcurrent().parent is not None
+
+# ============================================
+# パスワード検証（プロセスプール）
+# ============================================
+
+class PasswordVerifier:
+    """
+    check_password_hash をプロセスプールで実行
+
+    Args:
+        workers: プロセス数（0 の場合は呼び出し元で直接実行）
+        max_pending: 同時に受け付ける検証数の上限
+        async_mode: Socket.IO の非同期モード（'eventlet' の場合は待機中に他の処理へ譲る）
+    """
+
+    def __init__(self, workers=None, max_pending=None, async_mode=None):
+        if workers is None:
+            workers = _env_int('LOGIN_HASH_WORKERS', min(4, os.cpu_count() or 1))
+        self.workers = workers
+        self.max_pending = max_pending or _env_int('LOGIN_HASH_QUEUE', max(1, workers) * 8)
+        self.async_mode = async_mode
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._executor = None
+        self._lock = threading.Lock()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        # プロセスプールはフォーク先で使えないため、子プロセスで作り直す
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        # 初回のログイン時にプロセスを起動
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    methods = multiprocessing.get_all_start_methods()
+                    context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+        return self._executor
+
+    def _wait(self, future):
+        if self.async_mode == 'eventlet' and _in_greenthread():
+            # OSスレッドで待機し、イベントループを止めない
+            from eventlet import tpool
+            return tpool.execute(future.result)
+        return future.result()
+
+    def verify(self, pwhash, password):
+        """
+        パスワードを検証
+
+        Returns:
+            True / False、検証待ちが上限を超えている場合は None
+        """
+        if not self._slots.acquire(blocking=False):
+            return None
+        try:
+            if self.workers <= 0:
+                return check_password_hash(pwhash, password)
+            future = self._get_executor().submit(check_password_hash, pwhash, password)
+            return self._wait(future)
+        finally:
+            self._slots.release()
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+# ============================================
+# 失敗回数の記録と拒否
+# ============================================
+
+class LoginThrottle:
+    """
+    IPアドレス・ユーザー名ごとのログイン失敗をメモリ上で記録
+
+    失敗回数が期間内に上限へ達したキーは、最後の失敗から lockout 秒間拒否します。
+    記録するキー数には上限があり、古いものから破棄します。
+    """
+
+    def __init__(self, max_user_failures=None, max_ip_failures=None, window=None, lockout=None,
+                 max_keys=100000, clock=time.monotonic):
+        self.max_user_failures = max_user_failures or _env_int('LOGIN_MAX_FAILURES_USER', 5)
+        self.max_ip_failures = max_ip_failures or _env_int('LOGIN_MAX_FAILURES_IP', 20)
+        self.window = window or _env_int('LOGIN_FAILURE_WINDOW', 600)
+        self.lockout = lockout or _env_int('LOGIN_LOCKOUT_SECONDS', 300)
+        self.max_keys = max_keys
+        self.clock = clock
+        self._failures = OrderedDict()  # key -> deque[失敗時刻]
+        self._lock = threading.Lock()
+        self.rejected = 0
+
+    def _keys(self, ip_address, username):
+        keys = []
+        if ip_address:
+            keys.append((f'ip:{ip_address}', self.max_ip_failures))
+        if username:
+            keys.append((f'user:{username.lower()}', self.max_user_failures))
+        return keys
+
+    def _prune(self, failures, now):
+        while failures and failures[0] <= now - self.window:
+            failures.popleft()
+
+    def check(self, ip_address, username):
+        """
+        試行を受け付けるか確認
+
+        Returns:
+            拒否する場合は再試行までの秒数、受け付ける場合は 0
+        """
+        now = self.clock()
+        retry_after = 0
+        with self._lock:
+            for key, limit in self._keys(ip_address, username):
+                failures = self._failures.get(key)
+                if not failures:
+                    continue
+                self._prune(failures, now)
+                if len(failures) >= limit:
+                    remaining = failures[-1] + self.lockout - now
+                    if remaining > 0:
+                        retry_after = max(retry_after, remaining)
+            if retry_after:
+                self.rejected += 1
+        return int(retry_after + 0.999)
+
+    def failure(self, ip_address, username):
+        """ログイン失敗を記録"""
+        now = self.clock()
+        with self._lock:
+            for key, limit in self._keys(ip_address, username):
+                failures = self._failures.pop(key, None)
+                if failures is None:
+                    failures = deque(maxlen=max(self.max_user_failures, self.max_ip_failures))
+                self._prune(failures, now)
+                failures.append(now)
+                self._failures[key] = failures
+            while len(self._failures) > self.max_keys:
+                self._failures.popitem(last=False)
+
+    def success(self, ip_address, username):
+        """ログイン成功時にユーザー名の失敗記録を消去"""
+        with self._lock:
+            if username:
+                self._failures.pop(f'user:{username.lower()}', None)
+
+    def stats(self):
+        with self._lock:
+            return {'tracked_keys': len(self._failures), 'rejected': self.rejected}
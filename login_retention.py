@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+"""
+ログイン履歴（login_history）の保持期間管理
+
+保持期間を過ぎた行を
+  1. 月ごとの圧縮ファイル（archive/login_history/login_history-YYYY-MM.jsonl.gz）へ書き出し
+  2. 日別・ユーザー別の集計テーブル（login_history_daily）へ加算
+  3. login_history から削除
+します。login_history の行数は保持期間分に収まり、長い期間の集計は
+login_history_daily から取得します。
+
+使い方:
+    python login_retention.py apply --days 90
+    python login_retention.py stats
+
+    LOGIN_HISTORY_RETENTION_DAYS   保持日数（既定: 90）
+    LOGIN_HISTORY_ARCHIVE_DIR      アーカイブの保存先（既定: archive/login_history）
+"""
+
+import argparse
+import gzip
+import json
+import os
+import sqlite3
+from datetime import date, timedelta
+
+DB_PATH = os.environ.get('DATABASE_PATH', 'hospital_data.sqlite3')
+RETENTION_DAYS = int(os.environ.get('LOGIN_HISTORY_RETENTION_DAYS', 90))
+ARCHIVE_DIR = os.environ.get('LOGIN_HISTORY_ARCHIVE_DIR', os.path.join('archive', 'login_history'))
+
+BATCH_SIZE = 5000
+
+def ensure_tables(conn):
+    """集計テーブル・アーカイブ記録テーブルを作成"""
+    # 日別・ユーザー別の集計（存在しないユーザー名での失敗は user_id = 0）
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS login_history_daily (
+            day TEXT NOT NULL,
+            username TEXT NOT NULL,
+            user_id INTEGER NOT NULL DEFAULT 0,
+            success_count INTEGER NOT NULL DEFAULT 0,
+            failure_count INTEGER NOT NULL DEFAULT 0,
+            distinct_ips INTEGER NOT NULL DEFAULT 0,
+            ip_addresses TEXT,
+            first_login TIMESTAMP,
+            last_login TIMESTAMP,
+            PRIMARY KEY (day, username, user_id)
+        )
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_login_history_daily_user
+        ON login_history_daily(user_id, day)
+    ''')
+
+    # 書き出したアーカイブファイルの記録
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS login_history_archive (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            month TEXT NOT NULL,
+            path TEXT NOT NULL,
+            rows INTEGER NOT NULL,
+            min_id INTEGER,
+            max_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+def cutoff_day(days, today=None):
+    """保持期間の境界日（この日より前の行が対象、日単位で揃える）"""
+    today = today or date.today()
+    return (today - timedelta(days=days)).isoformat()
+
+def _rollup(conn, rows):
+    """行を日別・ユーザー別に集計して login_history_daily へ加算"""
+    groups = {}
+    for row in rows:
+        key = (row['login_time'][:10], row['username'], row['user_id'] or 0)
+        g = groups.get(key)
+        if g is None:
+            g = groups[key] = {
+                'success': 0, 'failure': 0, 'ips': set(),
+                'first': row['login_time'], 'last': row['login_time'],
+            }
+        if row['success']:
+            g['success'] += 1
+        else:
+            g['failure'] += 1
+        if row['ip_address']:
+            g['ips'].add(row['ip_address'])
+        g['first'] = min(g['first'], row['login_time'])
+        g['last'] = max(g['last'], row['login_time'])
+
+    for (day, username, user_id), g in groups.items():
+        existing = conn.execute(
+            'SELECT ip_addresses FROM login_history_daily WHERE day = ? AND username = ? AND user_id = ?',
+            (day, username, user_id)).fetchone()
+        ips = set(g['ips'])
+        if existing and existing['ip_addresses']:
+            ips.update(json.loads(existing['ip_addresses']))
+        conn.execute('''
+            INSERT INTO login_history_daily
+                (day, username, user_id, success_count, failure_count, distinct_ips, ip_addresses,
+                 first_login, last_login)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(day, username, user_id) DO UPDATE SET
+                success_count = login_history_daily.success_count + excluded.success_count,
+                failure_count = login_history_daily.failure_count + excluded.failure_count,
+                distinct_ips = excluded.distinct_ips,
+                ip_addresses = excluded.ip_addresses,
+                first_login = MIN(login_history_daily.first_login, excluded.first_login),
+                last_login = MAX(login_history_daily.last_login, excluded.last_login)
+        ''', (day, username, user_id, g['success'], g['failure'], len(ips),
+              json.dumps(sorted(ips)), g['first'], g['last']))
+    return len(groups)
+
+def _archive(rows, archive_dir):
+    """
+    行を月ごとの gzip ファイルへ追記
+
+    Returns:
+        [(月, パス, 追記前のサイズ, 件数, 最小id, 最大id)]
+    """
+    months = {}
+    for row in rows:
+        months.setdefault(row['login_time'][:7], []).append(row)
+
+    os.makedirs(archive_dir, exist_ok=True)
+    written = []
+    for month, month_rows in sorted(months.items()):
+        path = os.path.join(archive_dir, f'login_history-{month}.jsonl.gz')
+        size_before = os.path.getsize(path) if os.path.exists(path) else 0
+        # 追記ごとに gzip のメンバーが増える（zcat / gzip.open でまとめて読める）
+        with open(path, 'ab') as raw:
+            with gzip.GzipFile(fileobj=raw, mode='wb', mtime=0) as f:
+                for row in month_rows:
+                    f.write(json.dumps(dict(row), ensure_ascii=False).encode('utf-8') + b'\n')
+            raw.flush()
+            os.fsync(raw.fileno())
+        written.append((month, path, size_before, len(month_rows),
+                        month_rows[0]['id'], month_rows[-1]['id']))
+    return written
+
+def _rollback_archive(written):
+    """DBへの反映に失敗した場合、追記した分を取り消す"""
+    for _, path, size_before, _, _, _ in written:
+        with open(path, 'r+b') as f:
+            f.truncate(size_before)
+
+def apply_retention(conn, days=RETENTION_DAYS, archive_dir=ARCHIVE_DIR, today=None, batch_size=BATCH_SIZE):
+    """
+    保持期間を過ぎたログイン履歴をアーカイブ・集計して削除
+
+    Returns:
+        {'cutoff', 'archived', 'rollup_rows', 'files'}
+    """
+    ensure_tables(conn)
+    conn.commit()
+    cutoff = cutoff_day(days, today)
+    result = {'cutoff': cutoff, 'archived': 0, 'rollup_rows': 0, 'files': []}
+
+    while True:
+        rows = conn.execute('''
+            SELECT id, user_id, username, login_time, ip_address, user_agent, success
+            FROM login_history
+            WHERE login_time < ?
+            ORDER BY id
+            LIMIT ?
+        ''', (cutoff, batch_size)).fetchall()
+        if not rows:
+            break
+
+        # アーカイブを書き出してから、集計・削除を1トランザクションで反映
+        written = _archive(rows, archive_dir)
+        try:
+            with conn:
+                result['rollup_rows'] += _rollup(conn, rows)
+                for month, path, _, count, min_id, max_id in written:
+                    conn.execute('''
+                        INSERT INTO login_history_archive (month, path, rows, min_id, max_id)
+                        VALUES (?, ?, ?, ?, ?)
+                    ''', (month, path, count, min_id, max_id))
+                conn.executemany('DELETE FROM login_history WHERE id = ?', [(row['id'],) for row in rows])
+        except Exception:
+            _rollback_archive(written)
+            raise
+
+        result['archived'] += len(rows)
+        result['files'] = sorted(set(result['files']) | {path for _, path, *_ in written})
+        print(f"📦 ログイン履歴をアーカイブ: {len(rows)}件（累計 {result['archived']}件）")
+
+    return result
+
+# ============================================
+# 集計の取得（APIから使用）
+# ============================================
+
+def daily_summary(conn, start=None, end=None, user_id=None):
+    """
+    日別のログイン件数（集計テーブルと保持期間内の行を合わせて返す）
+
+    集計テーブルの日と login_history に残っている日は重ならないため、
+    そのまま合算できます。
+
+    Args:
+        start / end: 'YYYY-MM-DD'（両端を含む）
+        user_id: 指定した場合はそのユーザーのみ
+
+    Returns:
+        [{'day', 'success', 'failure', 'distinct_ips'}]（distinct_ips はユーザーごとの値の合計）
+    """
+    conditions_daily, conditions_raw, params_daily, params_raw = [], [], [], []
+    if start:
+        conditions_daily.append('day >= ?')
+        params_daily.append(start)
+        conditions_raw.append('login_time >= ?')
+        params_raw.append(start)
+    if end:
+        conditions_daily.append('day <= ?')
+        params_daily.append(end)
+        # end の日の終わりまで含める
+        conditions_raw.append('login_time < ?')
+        params_raw.append((date.fromisoformat(end) + timedelta(days=1)).isoformat())
+    if user_id:
+        conditions_daily.append('user_id = ?')
+        params_daily.append(user_id)
+        conditions_raw.append('user_id = ?')
+        params_raw.append(user_id)
+
+    where_daily = f"WHERE {' AND '.join(conditions_daily)}" if conditions_daily else ''
+    where_raw = f"WHERE {' AND '.join(conditions_raw)}" if conditions_raw else ''
+
+    rows = conn.execute(f'''
+        SELECT day, SUM(success) AS success, SUM(failure) AS failure, SUM(distinct_ips) AS distinct_ips
+        FROM (
+            SELECT day, success_count AS success, failure_count AS failure, distinct_ips
+            FROM login_history_daily {where_daily}
+            UNION ALL
+            SELECT substr(login_time, 1, 10) AS day,
+                   SUM(success != 0), SUM(success = 0), COUNT(DISTINCT ip_address)
+            FROM login_history {where_raw}
+            GROUP BY day, username, user_id
+        )
+        GROUP BY day
+        ORDER BY day
+    ''', params_daily + params_raw).fetchall()
+    return [dict(row) for row in rows]
+
+def archived_before(conn):
+    """アーカイブ済み（明細が login_history にない）期間の終わり"""
+    row = conn.execute('SELECT MAX(day) AS day FROM login_history_daily').fetchone()
+    return row['day'] if row else None
+
+# ============================================
+# コマンドライン
+# ============================================
+
+def print_stats(conn):
+    ensure_tables(conn)
+    raw = conn.execute('SELECT COUNT(*) AS n, MIN(login_time) AS oldest FROM login_history').fetchone()
+    daily = conn.execute('SELECT COUNT(*) AS n, MIN(day) AS oldest, MAX(day) AS newest FROM login_history_daily').fetchone()
+    files = conn.execute('SELECT COUNT(DISTINCT path) AS n, SUM(rows) AS rows FROM login_history_archive').fetchone()
+    print(f"📊 login_history:        {raw['n']}行（最古: {raw['oldest'] or '-'}）")
+    print(f"📊 login_history_daily:  {daily['n']}行（{daily['oldest'] or '-'} 〜 {daily['newest'] or '-'}）")
+    print(f"📊 アーカイブ:           {files['n']}ファイル / {files['rows'] or 0}行")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='ログイン履歴の保持期間管理')
+    parser.add_argument('--database', default=DB_PATH, help='データベースファイル')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p_apply = sub.add_parser('apply', help='保持期間を過ぎた行をアーカイブ・集計して削除')
+    p_apply.add_argument('--days', type=int, default=RETENTION_DAYS, help='保持日数')
+    p_apply.add_argument('--archive-dir', default=ARCHIVE_DIR, help='アーカイブの保存先')
+
+    sub.add_parser('stats', help='行数・アーカイブ状況を表示')
+
+    args = parser.parse_args(argv)
+    conn = sqlite3.connect(args.database)
+    conn.row_factory = sqlite3.Row
+    try:
+        if args.command == 'apply':
+            print(f"🧹 {args.days}日より前のログイン履歴を整理します")
+            result = apply_retention(conn, args.days, args.archive_dir)
+            print(f"✅ 完了: {result['archived']}件をアーカイブ（境界: {result['cutoff']}）")
+        print_stats(conn)
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    main()
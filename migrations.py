@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""
+データベースのスキーマ管理（PRAGMA user_version によるバージョン管理）
+
+MIGRATIONS に並べた関数を順番に1回だけ適用し、適用済みのバージョンを
+PRAGMA user_version に記録します。アプリの起動時はバージョンの確認
+（PRAGMA の読み込み1回）だけを行い、スキーマの変更は行いません。
+
+使い方:
+    python migrations.py upgrade     # 未適用のマイグレーションを適用
+    python migrations.py status      # 現在のバージョンを表示
+
+マイグレーションを追加する場合は、関数を作成して MIGRATIONS の末尾に追加します
+（既存の関数は変更しないでください）。
+"""
+
+import argparse
+import os
+import sqlite3
+
+import aggregate_stats
+import change_log
+import find_replace
+import geo
+import history_archive
+import login_retention
+import storage_codec
+
+DB_PATH = os.environ.get('DATABASE_PATH', 'hospital_data.sqlite3')
+
+# ============================================
+# マイグレーション
+# ============================================
+
+def m001_initial_schema(conn):
+    """users / password_reset_tokens / mdata / locks / history"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            email TEXT UNIQUE NOT NULL,
+            role TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS password_reset_tokens (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            token TEXT UNIQUE NOT NULL,
+            expires_at TIMESTAMP NOT NULL,
+            used INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS mdata (
+            code TEXT PRIMARY KEY,
+            kv TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_by INTEGER,
+            FOREIGN KEY (updated_by) REFERENCES users (id)
+        )
+    ''')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS locks (
+            code TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            username TEXT NOT NULL,
+            locked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            code TEXT NOT NULL,
+            action TEXT NOT NULL,
+            old_data TEXT,
+            new_data TEXT,
+            changed_fields TEXT,
+            user_id INTEGER NOT NULL,
+            username TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_history_code ON history(code)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_history_user ON history(user_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_history_created ON history(created_at DESC)')
+
+LOGIN_HISTORY_SQL = '''
+    CREATE TABLE {name} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        username TEXT NOT NULL,
+        login_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        ip_address TEXT,
+        user_agent TEXT,
+        success BOOLEAN DEFAULT 1,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    )
+'''
+
+def m002_login_history(conn):
+    """
+    login_history を作成
+
+    存在しないユーザー名でのログイン失敗も記録するため user_id は NULL を許可します。
+    create_login_history_table.py で作成済み（user_id NOT NULL）の場合は作り直します。
+    """
+    columns = {row[1]: row for row in conn.execute('PRAGMA table_info(login_history)')}
+    if not columns:
+        conn.execute(LOGIN_HISTORY_SQL.format(name='login_history'))
+    elif columns['user_id'][3]:  # notnull
+        conn.execute(LOGIN_HISTORY_SQL.format(name='login_history_new'))
+        conn.execute('''
+            INSERT INTO login_history_new (id, user_id, username, login_time, ip_address, user_agent, success)
+            SELECT id, user_id, username, login_time, ip_address, user_agent, success FROM login_history
+        ''')
+        conn.execute('DROP TABLE login_history')
+        conn.execute('ALTER TABLE login_history_new RENAME TO login_history')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_login_history_user ON login_history(user_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_login_history_time ON login_history(login_time DESC)')
+
+def m003_history_compaction(conn):
+    """history の merged_count / first_created_at（history_archive.py）"""
+    history_archive.ensure_columns(conn)
+
+def m004_login_history_rollups(conn):
+    """login_history_daily / login_history_archive（login_retention.py）"""
+    login_retention.ensure_tables(conn)
+
+def m005_mdata_version(conn):
+    """
+    mdata の更新回数（各ワーカーのメモリ上の一覧を更新するための目印）
+
+    mdata への INSERT / UPDATE / DELETE のたびにトリガーで version を1増やします。
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS mdata_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL
+        )
+    ''')
+    conn.execute('INSERT OR IGNORE INTO mdata_version (id, version) VALUES (1, 0)')
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS mdata_version_{event.lower()}
+            AFTER {event} ON mdata
+            BEGIN
+                UPDATE mdata_version SET version = version + 1 WHERE id = 1;
+            END
+        ''')
+
+def m006_mdata_search(conn):
+    """一括検索・置換用の検索テーブル（find_replace.py）"""
+    find_replace.ensure_index(conn)
+
+def m007_aggregate_stats(conn):
+    """医師数などの集計テーブル（aggregate_stats.py）を作成し、全件から集計"""
+    aggregate_stats.ensure_tables(conn)
+    aggregate_stats.fill(conn, storage_codec.load_codec(conn))
+
+def m008_geo(conn):
+    """郵便番号の座標・病院の座標（geo.py、郵便番号は geo.py load-postcodes で読み込み）"""
+    geo.ensure_tables(conn)
+
+def m009_change_log(conn):
+    """mdata の変更の記録（change_log.py、メモリ上のインデックスの差分更新用）"""
+    change_log.ensure_tables(conn)
+
+def m010_drop_heartbeat_locks(conn):
+    """以前のハートビート（POST /api/lock/heartbeat）が病院コード 'heartbeat' として取得したロックを削除"""
+    conn.execute("DELETE FROM locks WHERE code = 'heartbeat'")
+
+MIGRATIONS = [
+    m001_initial_schema,
+    m002_login_history,
+    m003_history_compaction,
+    m004_login_history_rollups,
+    m005_mdata_version,
+    m006_mdata_search,
+    m007_aggregate_stats,
+    m008_geo,
+    m009_change_log,
+    m010_drop_heartbeat_locks,
+]
+
+LATEST_VERSION = len(MIGRATIONS)
+
+# ============================================
+# 適用
+# ============================================
+
+def current_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def pending(database=DB_PATH):
+    """未適用のマイグレーション数（DBファイルがない場合は全件）"""
+    if not os.path.exists(database):
+        return LATEST_VERSION
+    conn = sqlite3.connect(database)
+    try:
+        return max(0, LATEST_VERSION - current_version(conn))
+    finally:
+        conn.close()
+
+def upgrade(database=DB_PATH, target=LATEST_VERSION):
+    """
+    未適用のマイグレーションを順番に適用
+
+    1件ずつ BEGIN IMMEDIATE のトランザクションで適用し、同じトランザクション内で
+    user_version を更新します（複数プロセスから同時に実行しても1回だけ適用されます）。
+
+    Returns:
+        適用したマイグレーションの名前のリスト
+    """
+    conn = sqlite3.connect(database, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    applied = []
+    try:
+        while True:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                version = current_version(conn)
+                if version >= target:
+                    conn.execute('COMMIT')
+                    break
+                migration = MIGRATIONS[version]
+                migration(conn)
+                conn.execute(f'PRAGMA user_version = {version + 1}')
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            applied.append(migration.__name__)
+            print(f"🔧 マイグレーション適用: {version + 1:03d} {migration.__name__}")
+    finally:
+        conn.close()
+    return applied
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='データベースのスキーマ管理')
+    parser.add_argument('--database', default=DB_PATH, help='データベースファイル')
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('upgrade', help='未適用のマイグレーションを適用')
+    sub.add_parser('status', help='現在のバージョンを表示')
+    args = parser.parse_args(argv)
+
+    if args.command == 'upgrade':
+        applied = upgrade(args.database)
+        if applied:
+            print(f"✅ {len(applied)}件のマイグレーションを適用しました（バージョン {LATEST_VERSION}）")
+        else:
+            print(f"✅ スキーマは最新です（バージョン {LATEST_VERSION}）")
+    else:
+        remaining = pending(args.database)
+        print(f"📋 バージョン: {LATEST_VERSION - remaining} / {LATEST_VERSION}（未適用: {remaining}件）")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+"""
+APIの流量制限と過負荷時の受付制限
+
+- RateLimiter: ユーザー（未ログインはIPアドレス）とルートの種類ごとのトークンバケット。
+  バケットはプロセス内（既定）か、RATE_LIMIT_DB の SQLite ファイルに保存し、
+  後者は複数ワーカー（GUNICORN_WORKERS >= 2）で共有されます。
+- AdmissionControl: 処理中のリクエスト数・監査ログの書き込み待ち・DBの書き込みロックの
+  待ち時間が上限を超えている間、後回しにできるリクエストを 429 で断ります。
+
+    RATE_LIMIT_ENABLED         0 の場合は流量制限を行わない（既定: 1）
+    RATE_LIMITS                種類ごとの上限（例: "search=2/10,bulk=0.2/3" = 毎秒の補充数/最大数）
+    RATE_LIMIT_DB              バケットを共有する SQLite ファイル（省略時はプロセス内）
+    ADMISSION_MAX_INFLIGHT     プロセスごとの処理中リクエスト数の上限（既定: 40）
+    ADMISSION_MAX_AUDIT_PENDING 監査ログの書き込み待ちの上限（既定: 5000）
+    ADMISSION_DB_LATENCY_MS    書き込みロックの待ち時間の上限（ミリ秒、既定: 1000）
+    ADMISSION_PROBE_SECONDS    書き込みロックの待ち時間を測る間隔（秒、既定: 2）
+"""
+
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+def _env_int(name, default):
+    return int(os.environ.get(name, default))
+
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', '1') != '0'
+RATE_LIMIT_DB = os.environ.get('RATE_LIMIT_DB', '')
+
+# ルートの種類ごとの (毎秒の補充数, バケットの最大数)
+DEFAULT_LIMITS = {
+    'read': (10, 40),      # 参照（GET）
+    'write': (5, 20),      # 保存・削除
+    'search': (2, 10),     # 一覧・検索（件数の多い応答）
+    'bulk': (0.2, 3),      # 全件の処理（一括保存・置換・重複検出・レポート・スナップショット）
+    'lock': (2, 10),       # ロックの取得・解放
+    'heartbeat': (0.2, 3), # 編集中のハートビート（30秒ごと）
+    'socket': (1, 5),      # Socket.IO の接続
+}
+
+# 過負荷の間も受け付ける種類（編集中の保存・ロックを優先する）
+UNSHEDDABLE = frozenset({'write', 'lock', 'heartbeat', 'socket'})
+
+def parse_limits(value, defaults=DEFAULT_LIMITS):
+    """
+    RATE_LIMITS（"種類=補充数/最大数,..."）を DEFAULT_LIMITS に上書き
+
+    Raises:
+        ValueError: 書式が正しくない、または未知の種類
+    """
+    limits = dict(defaults)
+    for item in filter(None, (part.strip() for part in (value or '').split(','))):
+        name, _, spec = item.partition('=')
+        name = name.strip()
+        if name not in limits:
+            raise ValueError(f'Unknown rate limit class: {name}')
+        rate, _, burst = spec.partition('/')
+        rate = float(rate)
+        burst = float(burst) if burst else max(1.0, rate)
+        if rate <= 0 or burst < 1:
+            raise ValueError(f'Invalid rate limit: {item}')
+        limits[name] = (rate, burst)
+    return limits
+
+def retry_after(tokens, rate):
+    """トークンが1つたまるまでの秒数（Retry-After ヘッダー用に切り上げ）"""
+    return max(1, math.ceil((1 - tokens) / rate))
+
+# ============================================
+# バケットの保存先
+# ============================================
+
+class MemoryBuckets:
+    """
+    プロセス内のバケット
+
+    保持するキー数には上限があり、古いものから破棄します（満杯のバケットと同じ扱い）。
+    """
+
+    name = 'memory'
+
+    def __init__(self, max_keys=100000, clock=time.monotonic):
+        self.max_keys = max_keys
+        self.clock = clock
+        self._buckets = OrderedDict()  # key -> [トークン数, 更新時刻]
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        """
+        トークンを1つ使う
+
+        Returns:
+            (受け付けるか, 残りのトークン数)
+        """
+        now = self.clock()
+        with self._lock:
+            bucket = self._buckets.pop(key, None)
+            if bucket is None:
+                bucket = [burst, now]
+            tokens = min(burst, bucket[0] + max(0.0, now - bucket[1]) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            bucket[0], bucket[1] = tokens, now
+            self._buckets[key] = bucket
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return allowed, tokens
+
+    def size(self):
+        with self._lock:
+            return len(self._buckets)
+
+class SQLiteBuckets:
+    """
+    SQLite ファイルのバケット（同じホストの複数ワーカーで共有）
+
+    1回の UPSERT で補充・消費・判定を行うため、ワーカー間でロックを取り合いません。
+    ファイルは流量制限専用（WAL・synchronous=OFF）で、病院データのDBとは分けます。
+    """
+
+    name = 'sqlite'
+
+    TAKE = '''
+        INSERT INTO rate_buckets (key, tokens, updated, allowed) VALUES (:key, :burst - 1, :now, 1)
+        ON CONFLICT (key) DO UPDATE SET
+            tokens = MIN(:burst, tokens + MAX(0, :now - updated) * :rate)
+                     - (MIN(:burst, tokens + MAX(0, :now - updated) * :rate) >= 1),
+            allowed = MIN(:burst, tokens + MAX(0, :now - updated) * :rate) >= 1,
+            updated = MAX(updated, :now)
+        RETURNING allowed, tokens
+    '''
+
+    def __init__(self, path, idle_seconds=3600, prune_every=1000, clock=time.time):
+        self.path = path
+        self.idle_seconds = idle_seconds
+        self.prune_every = prune_every
+        self.clock = clock
+        self._local = threading.local()
+        self._count = 0
+        self._ensure_table()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        # 接続はフォーク先で使えないため、子プロセスで作り直す
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=1, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA synchronous = OFF')
+            self._local.conn = conn
+        return conn
+
+    def _ensure_table(self):
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        try:
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS rate_buckets (
+                    key TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    updated REAL NOT NULL,
+                    allowed INTEGER NOT NULL
+                ) WITHOUT ROWID
+            ''')
+        finally:
+            conn.close()
+
+    def take(self, key, rate, burst):
+        now = self.clock()
+        conn = self._connect()
+        allowed, tokens = conn.execute(self.TAKE, {'key': key, 'rate': rate, 'burst': burst, 'now': now}).fetchone()
+        self._count += 1
+        if self._count % self.prune_every == 0:
+            # しばらく使われていない（満杯に戻った）バケットを削除
+            conn.execute('DELETE FROM rate_buckets WHERE updated < ?', (now - self.idle_seconds,))
+        return bool(allowed), tokens
+
+    def size(self):
+        return self._connect().execute('SELECT COUNT(*) FROM rate_buckets').fetchone()[0]
+
+# ============================================
+# 流量制限
+# ============================================
+
+class RateLimiter:
+    """
+    ユーザーとルートの種類ごとのトークンバケット
+
+    Args:
+        limits: {種類: (毎秒の補充数, 最大数)}（省略時は RATE_LIMITS / DEFAULT_LIMITS）
+        store: MemoryBuckets / SQLiteBuckets（省略時は RATE_LIMIT_DB に従う）
+        enabled: False の場合は常に受け付ける
+    """
+
+    def __init__(self, limits=None, store=None, enabled=None):
+        self.limits = limits or parse_limits(os.environ.get('RATE_LIMITS'))
+        self.store = store or (SQLiteBuckets(RATE_LIMIT_DB) if RATE_LIMIT_DB else MemoryBuckets())
+        self.enabled = RATE_LIMIT_ENABLED if enabled is None else enabled
+        self._lock = threading.Lock()
+        self._counts = {name: {'allowed': 0, 'limited': 0} for name in self.limits}
+        self.errors = 0
+
+    def check(self, route_class, client):
+        """
+        リクエストを受け付けるか確認
+
+        Args:
+            route_class: DEFAULT_LIMITS の種類
+            client: 'user:<id>' / 'ip:<アドレス>'
+
+        Returns:
+            拒否する場合は再試行までの秒数、受け付ける場合は 0
+        """
+        if not self.enabled:
+            return 0
+        rate, burst = self.limits[route_class]
+        try:
+            allowed, tokens = self.store.take(f'{route_class}:{client}', rate, burst)
+        except sqlite3.Error as e:
+            # 保存先に書けない場合は制限せずに受け付ける
+            with self._lock:
+                self.errors += 1
+            print(f"⚠️ 流量制限の記録に失敗: {e}")
+            return 0
+        with self._lock:
+            self._counts[route_class]['allowed' if allowed else 'limited'] += 1
+        return 0 if allowed else retry_after(tokens, rate)
+
+    def stats(self):
+        with self._lock:
+            classes = {
+                name: {'rate': rate, 'burst': burst, **self._counts[name]}
+                for name, (rate, burst) in self.limits.items()
+            }
+            errors = self.errors
+        try:
+            tracked = self.store.size()
+        except sqlite3.Error:
+            tracked = None
+        return {
+            'enabled': self.enabled,
+            'store': self.store.name,
+            'classes': classes,
+            'tracked_keys': tracked,
+            'errors': errors
+        }
+
+# ============================================
+# 過負荷時の受付制限
+# ============================================
+
+class AdmissionControl:
+    """
+    処理中のリクエスト数・監査ログの書き込み待ち・DBの書き込みロックの待ち時間を監視し、
+    いずれかが上限を超えている間は UNSHEDDABLE 以外のリクエストを断る
+
+    書き込みロックの待ち時間は専用のスレッドが probe_seconds ごとに
+    BEGIN IMMEDIATE → ROLLBACK で測ります（ロックはすぐ解放し、コミットはしません）。
+
+    Args:
+        connect: DB接続を返す関数（測定用のスレッドで使う）
+        pending: 監査ログの書き込み待ちの件数を返す関数
+    """
+
+    def __init__(self, connect, pending, max_inflight=None, max_audit_pending=None,
+                 db_latency_ms=None, probe_seconds=None):
+        self.connect = connect
+        self.pending = pending
+        self.max_inflight = max_inflight or _env_int('ADMISSION_MAX_INFLIGHT', 40)
+        self.max_audit_pending = max_audit_pending or _env_int('ADMISSION_MAX_AUDIT_PENDING', 5000)
+        self.db_latency_ms = db_latency_ms or _env_int('ADMISSION_DB_LATENCY_MS', 1000)
+        self.probe_seconds = probe_seconds or _env_int('ADMISSION_PROBE_SECONDS', 2)
+        self.inflight = 0
+        self.shed = 0
+        self.last_latency_ms = None
+        self._lock = threading.Lock()
+        self._pid = None
+        self._stop = threading.Event()
+
+    def start(self):
+        """測定用のスレッドを開始（フォーク後のプロセスでは改めて開始）"""
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self.inflight = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        threading.Thread(target=self._run, name='admission-probe', daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def probe(self):
+        """書き込みロックを取得するまでの時間（ミリ秒、上限の2倍で打ち切り）"""
+        timeout = self.db_latency_ms * 2 / 1000
+        conn = self.connect()
+        try:
+            conn.execute(f'PRAGMA busy_timeout = {int(timeout * 1000)}')
+            started = time.perf_counter()
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                conn.execute('ROLLBACK')
+            except sqlite3.OperationalError:
+                return timeout * 1000
+            return (time.perf_counter() - started) * 1000
+        finally:
+            conn.close()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.last_latency_ms = round(self.probe(), 2)
+            except sqlite3.Error as e:
+                print(f"⚠️ DB待ち時間の測定に失敗: {e}")
+            self._stop.wait(self.probe_seconds)
+
+    def overloaded(self):
+        """上限を超えている項目（なければ None）"""
+        if self.inflight > self.max_inflight:
+            return 'inflight'
+        if self.last_latency_ms is not None and self.last_latency_ms > self.db_latency_ms:
+            return 'db_latency'
+        if self.pending() > self.max_audit_pending:
+            return 'audit_pending'
+        return None
+
+    def enter(self, route_class):
+        """
+        リクエストの開始（受け付けた場合は処理後に leave() を呼ぶ）
+
+        Returns:
+            断る場合は理由（'inflight' など）、受け付ける場合は None
+        """
+        reason = None if route_class in UNSHEDDABLE else self.overloaded()
+        with self._lock:
+            if reason:
+                self.shed += 1
+            else:
+                self.inflight += 1
+        return reason
+
+    def leave(self):
+        with self._lock:
+            self.inflight -= 1
+
+    def retry_after(self):
+        return max(1, self.probe_seconds)
+
+    def stats(self):
+        return {
+            'inflight': self.inflight,
+            'max_inflight': self.max_inflight,
+            'audit_pending': self.pending(),
+            'max_audit_pending': self.max_audit_pending,
+            'db_latency_ms': self.last_latency_ms,
+            'max_db_latency_ms': self.db_latency_ms,
+            'overloaded': self.overloaded(),
+            'shed': self.shed
+        }
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+読み込み専用のメモリ上のコピー（リードレプリカ）
+
+READ_REPLICA=1 の場合、各ワーカーがDB全体をメモリ上（SQLite の共有キャッシュ）に
+コピーし、参照のみのAPI（病院データの取得・病院一覧・検索）はコピーから読み込みます。
+書き込みとDBファイルのロックを取り合わないため、保存が多い時間帯も参照が待たされません。
+
+コピーの更新:
+    READ_REPLICA_CHECK_INTERVAL 秒ごとに（参照のタイミングで）DBファイルの
+    PRAGMA data_version を確認し、他の接続からの書き込みがあれば backup() で
+    新しいコピーを作成して切り替えます（読み込み中の接続は古いコピーをそのまま使えます）。
+    このワーカーで保存した直後は mark_stale() で次の参照時に必ず確認します。
+
+遅延（コピーに反映されていない時間）は status() / /api/replica/status で確認できます。
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+READ_REPLICA = os.environ.get('READ_REPLICA', '0').lower() in ('1', 'true', 'yes', 'on')
+CHECK_INTERVAL = float(os.environ.get('READ_REPLICA_CHECK_INTERVAL', 0.5))
+# 切り替え中のコピーに接続してしまった場合に接続し直す回数
+REOPEN_ATTEMPTS = 5
+
+class ReadReplica:
+    """
+    メモリ上のコピーへの接続を返す
+
+    Args:
+        database: DBファイルのパス
+        enabled: False の場合は常にDBファイルへ接続（既定: READ_REPLICA）
+        check_interval: data_version を確認する間隔（秒）
+    """
+
+    def __init__(self, database, enabled=None, check_interval=None):
+        self.database = database
+        self.enabled = READ_REPLICA if enabled is None else enabled
+        self.check_interval = CHECK_INTERVAL if check_interval is None else check_interval
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # SQLite の接続はフォーク先で使えないため、子プロセスでは作り直す
+        self._lock = threading.Lock()
+        self._watch = None          # data_version を確認する接続（DBファイル）
+        self._keeper = None         # メモリ上のコピーを保持する接続
+        self._previous_keeper = None
+        self._uri = None
+        self._dirty = False
+        self._checked_at = 0.0
+        self._stale_since = None
+        self.generation = 0
+        self.version = None
+        self.synced_at = None
+        self.refreshes = 0
+        self.last_refresh_ms = None
+        self.last_lag_ms = None
+
+    # ============================================
+    # 接続
+    # ============================================
+
+    def connect(self):
+        """参照用の接続（無効な場合はDBファイルへの接続）"""
+        if not self.enabled:
+            conn = sqlite3.connect(self.database)
+        else:
+            self._refresh_if_due()
+            conn = sqlite3.connect(self._uri, uri=True)
+            # URI の取得から接続までの間にコピーが2回以上切り替わると、古いコピーは解放済みで
+            # 空のDBが開かれる（schema_version が 0）ため、現在のコピーに接続し直す
+            for _ in range(REOPEN_ATTEMPTS):
+                if conn.execute('PRAGMA schema_version').fetchone()[0]:
+                    break
+                conn.close()
+                conn = sqlite3.connect(self._uri, uri=True)
+            conn.execute('PRAGMA query_only = 1')
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def mark_stale(self):
+        """このワーカーで書き込んだ後に呼ぶ（次の参照時に確認する）"""
+        self._dirty = True
+
+    # ============================================
+    # 更新
+    # ============================================
+
+    def _data_version(self):
+        if self._watch is None:
+            self._watch = sqlite3.connect(self.database, check_same_thread=False)
+        return self._watch.execute('PRAGMA data_version').fetchone()[0]
+
+    def _refresh_if_due(self):
+        if (self._uri is not None and not self._dirty
+                and time.monotonic() - self._checked_at < self.check_interval):
+            return
+        # 確認・更新は1スレッドのみ（コピーがあれば他のスレッドは待たずに現在のコピーを使う）
+        if not self._lock.acquire(blocking=self._uri is None):
+            return
+        try:
+            previous_check = self._checked_at
+            self._checked_at = time.monotonic()
+            self._dirty = False
+            version = self._data_version()
+            if self._uri is not None and version == self.version:
+                return
+            if self._uri is not None:
+                # 前回の確認から今回までの間に書き込まれた（遅延の上限の起点）
+                self._stale_since = previous_check
+            self._snapshot(version)
+        finally:
+            self._lock.release()
+
+    def refresh(self):
+        """すぐにコピーを作り直す"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._checked_at = time.monotonic()
+            self._snapshot(self._data_version())
+
+    def _snapshot(self, version):
+        started = time.monotonic()
+        generation = self.generation + 1
+        uri = f'file:replica-{os.getpid()}-{id(self)}-{generation}?mode=memory&cache=shared'
+        keeper = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        src = sqlite3.connect(self.database)
+        try:
+            src.backup(keeper)
+        finally:
+            src.close()
+
+        # 切り替え（古いコピーは使用中の接続がすべて閉じられると解放される）
+        # 切り替え直前に古い URI を取得した接続が空のDBを開かないよう、1世代前まで保持する
+        old_keeper = self._previous_keeper
+        self._previous_keeper = self._keeper
+        self._keeper, self._uri = keeper, uri
+        self.generation, self.version = generation, version
+        self.synced_at = datetime.now()
+        self.refreshes += 1
+        finished = time.monotonic()
+        self.last_refresh_ms = round((finished - started) * 1000, 2)
+        if self._stale_since is not None:
+            self.last_lag_ms = round((finished - self._stale_since) * 1000, 2)
+            self._stale_since = None
+        if old_keeper is not None:
+            old_keeper.close()
+
+    # ============================================
+    # 状態
+    # ============================================
+
+    def status(self):
+        """
+        コピーの状態
+
+        lag_ms: 最後の更新で、書き込みがコピーに反映されるまでの時間（上限値）
+        checked_seconds_ago: 最後に data_version を確認してからの時間
+            （その後の書き込みはまだコピーに反映されていない可能性がある）
+        """
+        if not self.enabled:
+            return {'enabled': False}
+        return {
+            'enabled': True,
+            'generation': self.generation,
+            'data_version': self.version,
+            'synced_at': self.synced_at.isoformat() if self.synced_at else None,
+            'checked_seconds_ago': round(time.monotonic() - self._checked_at, 3) if self.synced_at else None,
+            'lag_ms': self.last_lag_ms,
+            'refreshes': self.refreshes,
+            'last_refresh_ms': self.last_refresh_ms,
+            'check_interval': self.check_interval,
+        }
@@ -0,0 +1,435 @@
+# -*- coding: utf-8 -*-
+"""
+似ている病院の検索（出身大学・診療科・関連病院施設等の共通度）
+
+kv の連番の列（Dr./出身大学_n, 診療科_n, 関連病院施設等_n, 部署_n）の値を特徴として
+病院ごとに疎ベクトルを作り、コサイン類似度の高い順に返します。
+
+    重み = 列ごとの重み（FEATURE_SERIES） × IDF（多くの病院にある値ほど小さい）
+
+ベクトルのノルムは作成時に計算しておき、検索では特徴ごとの転置リスト
+（その特徴を持つ病院と重み）から内積を求めます。NumPy があれば転置リストを
+配列にまとめて np.bincount で計算し、ない場合は Python の辞書で計算します
+（SIMILARITY_ENGINE=python で NumPy を使わないことも可能）。
+
+病院データが変更されると change_log（mdata_changes）に記録されるため、検索の前に
+変更された病院のベクトルだけを作り直します（他のワーカーでの保存も反映されます）。
+IDF は全件の読み込み時に計算し、その後に初めて現れた値は現在の病院数・出現数から
+計算します（全件を読み込み直すと正確な値に戻ります）。
+
+使い方:
+    python similarity.py similar 01-02 --k 10
+    python similarity.py bench --queries 300
+"""
+
+import argparse
+import functools
+import heapq
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import defaultdict
+
+import change_log
+import storage_codec
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+DB_PATH = os.environ.get('DATABASE_PATH', 'hospital_data.sqlite3')
+
+# auto（NumPy があれば使用）/ numpy / python
+SIMILARITY_ENGINE = os.environ.get('SIMILARITY_ENGINE', 'auto')
+
+# 特徴にする連番の列: 列名 → (特徴の種類, 重み)
+FEATURE_SERIES = {
+    'Dr./出身大学': ('university', 1.0),
+    '診療科': ('department', 1.0),
+    '関連病院施設等': ('facility', 1.0),
+    '部署': ('section', 0.5),
+}
+KIND_WEIGHTS = {kind: weight for kind, weight in FEATURE_SERIES.values()}
+SERIES_RE = re.compile(r'^(.+)_(\d+)$')
+
+@functools.lru_cache(maxsize=100000)
+def normalize(value):
+    """全角・半角、大文字・小文字、空白の違いをそろえる"""
+    return ' '.join(unicodedata.normalize('NFKC', value).lower().split())
+
+@functools.lru_cache(maxsize=None)
+def feature_kind(key):
+    """列名の特徴の種類（特徴にしない列は None）"""
+    m = SERIES_RE.match(key)
+    return FEATURE_SERIES[m.group(1)][0] if m and m.group(1) in FEATURE_SERIES else None
+
+def extract(kv):
+    """kv の特徴（'university:北海道大学' などの集合）"""
+    features = set()
+    for key, value in (kv or {}).items():
+        kind = feature_kind(key)
+        if kind is None:
+            continue
+        value = normalize(value if isinstance(value, str) else str(value))
+        if value:
+            features.add(f'{kind}:{value}')
+    return features
+
+def resolve_engine(engine):
+    if engine not in ('auto', 'numpy', 'python'):
+        raise ValueError(f'Unknown engine: {engine}')
+    if engine == 'python' or numpy is None:
+        return 'python'
+    return 'numpy'
+
+class SimilarityIndex:
+    """
+    病院ごとの特徴ベクトルと転置リスト
+
+    Args:
+        connect: DB接続を返す関数
+        get_codec: kv のコーデックを返す関数
+        engine: 'auto' / 'numpy' / 'python'
+    """
+
+    def __init__(self, connect, get_codec, engine=SIMILARITY_ENGINE):
+        self.connect = connect
+        self.get_codec = get_codec
+        self.engine = resolve_engine(engine)
+        self.seq = None
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.slots = {}         # 病院コード → 番号
+        self.codes = []         # 番号 → 病院コード（削除済みは None）
+        self.vectors = []       # 番号 → {特徴ID: 重み}
+        self.norms = []         # 番号 → ノルム
+        self.free = []          # 削除済みの番号（再利用）
+        self.vocab = {}         # 特徴 → 特徴ID
+        self.features = []      # 特徴ID → 特徴
+        self.kind_weights = []  # 特徴ID → 列ごとの重み
+        self.df = []            # 特徴ID → 出現する病院数
+        self.idf = []           # 特徴ID → IDF（None は未計算）
+        self.postings = []      # 特徴ID → {番号: 重み}
+        self.total = 0          # 病院数
+        self._arrays = {}       # 特徴ID → (番号の配列, 重みの配列)（NumPy）
+        self._norm_array = None
+
+    # ============================================
+    # 作成・更新
+    # ============================================
+
+    def load(self):
+        """mdata の全件から作成"""
+        with self._lock:
+            self._load()
+
+    def _load(self):
+        codec = self.get_codec()
+        conn = self.connect()
+        try:
+            seq = change_log.latest_seq(conn)
+            rows = conn.execute('SELECT code, kv FROM mdata').fetchall()
+        finally:
+            conn.close()
+
+        extracted = []
+        for code, kv in rows:
+            try:
+                extracted.append((code, extract(codec.loads(kv))))
+            except Exception:
+                extracted.append((code, set()))
+
+        self._reset()
+        # 先に出現数を数えて IDF を決めてからベクトルを作る
+        for _, features in extracted:
+            for feature in features:
+                self.df[self._feature_id(feature)] += 1
+        self.total = len(extracted)
+        for fid in range(len(self.features)):
+            self._idf(fid)
+        # 出現数・病院数は _set() で数え直す
+        self.df = [0] * len(self.df)
+        self.total = 0
+        for code, features in extracted:
+            self._set(code, features)
+        self.seq = seq
+        print(f"🔗 類似病院インデックスを作成しました: {len(extracted)}件, 特徴 {len(self.features)}種類 ({self.engine})")
+
+    def _feature_id(self, feature):
+        fid = self.vocab.get(feature)
+        if fid is None:
+            fid = self.vocab[feature] = len(self.features)
+            self.features.append(feature)
+            self.kind_weights.append(KIND_WEIGHTS[feature.split(':', 1)[0]])
+            self.df.append(0)
+            self.idf.append(None)
+            self.postings.append({})
+        return fid
+
+    def _idf(self, fid):
+        idf = self.idf[fid]
+        if idf is None:
+            idf = self.idf[fid] = math.log((1 + self.total) / (1 + self.df[fid])) + 1
+        return idf
+
+    def _set(self, code, features):
+        """1病院のベクトルを作り直す（features が None の場合は削除）"""
+        slot = self.slots.get(code)
+        if slot is not None:
+            for fid in self.vectors[slot]:
+                del self.postings[fid][slot]
+                self.df[fid] -= 1
+                self._arrays.pop(fid, None)
+            if features is None:
+                del self.slots[code]
+                self.codes[slot] = None
+                self.vectors[slot] = {}
+                self.norms[slot] = 0.0
+                self.free.append(slot)
+                self.total -= 1
+                self._set_norm(slot, 0.0)
+                return
+        elif features is None:
+            return
+        else:
+            if self.free:
+                slot = self.free.pop()
+                self.codes[slot] = code
+            else:
+                slot = len(self.codes)
+                self.codes.append(code)
+                self.vectors.append({})
+                self.norms.append(0.0)
+            self.slots[code] = slot
+            self.total += 1
+
+        vector = {}
+        for feature in features:
+            fid = self._feature_id(feature)
+            self.df[fid] += 1
+            weight = self.kind_weights[fid] * self._idf(fid)
+            vector[fid] = weight
+            self.postings[fid][slot] = weight
+            self._arrays.pop(fid, None)
+        self.vectors[slot] = vector
+        norm = math.sqrt(sum(w * w for w in vector.values()))
+        self.norms[slot] = norm
+        self._set_norm(slot, norm)
+
+    def _set_norm(self, slot, norm):
+        if self._norm_array is not None:
+            if slot < len(self._norm_array):
+                self._norm_array[slot] = norm
+            else:
+                self._norm_array = None
+
+    def _refresh(self):
+        """変更された病院のベクトルを作り直す（_lock を取得して呼び出す）"""
+        if self.seq is None:
+            self._load()
+            return
+        conn = self.connect()
+        try:
+            codes, latest, expired = change_log.changed_since(conn, self.seq)
+            rows = []
+            if codes and not expired:
+                codes = sorted(codes)
+                for i in range(0, len(codes), 500):
+                    chunk = codes[i:i + 500]
+                    placeholders = ','.join('?' * len(chunk))
+                    rows += conn.execute(f'SELECT code, kv FROM mdata WHERE code IN ({placeholders})', chunk).fetchall()
+        finally:
+            conn.close()
+
+        if expired:
+            self._load()
+            return
+        codec = self.get_codec()
+        found = set()
+        for code, kv in rows:
+            found.add(code)
+            try:
+                self._set(code, extract(codec.loads(kv)))
+            except Exception:
+                self._set(code, set())
+        for code in codes:
+            if code not in found:
+                self._set(code, None)
+        self.seq = latest
+
+    # ============================================
+    # 検索
+    # ============================================
+
+    def similar(self, code, k=10):
+        """
+        似ている病院（類似度の高い順）
+
+        Returns:
+            [{'code', 'score', 'shared': {特徴の種類: [値]}}]（病院がない場合は None）
+        """
+        with self._lock:
+            self._refresh()
+            slot = self.slots.get(code)
+            if slot is None:
+                return None
+            vector, norm = self.vectors[slot], self.norms[slot]
+            if not vector or k <= 0:
+                return []
+            if self.engine == 'numpy':
+                top = self._top_numpy(vector, norm, k, slot)
+            else:
+                top = self._top_python(vector, norm, k, slot)
+
+            results = []
+            for score, other in top:
+                shared = defaultdict(list)
+                other_vector = self.vectors[other]
+                for fid in sorted((f for f in vector if f in other_vector), key=lambda f: -vector[f]):
+                    kind, value = self.features[fid].split(':', 1)
+                    shared[kind].append(value)
+                results.append({'code': self.codes[other], 'score': round(score, 4), 'shared': dict(shared)})
+            return results
+
+    def _top_python(self, vector, norm, k, exclude):
+        scores = defaultdict(float)
+        postings = self.postings
+        for fid, wq in vector.items():
+            for slot, weight in postings[fid].items():
+                scores[slot] += wq * weight
+        scores.pop(exclude, None)
+        norms, codes = self.norms, self.codes
+        top = heapq.nsmallest(k, ((-dot / (norm * norms[slot]), codes[slot], slot)
+                                  for slot, dot in scores.items()))
+        return [(-negative, slot) for negative, _, slot in top]
+
+    def _postings_array(self, fid):
+        arrays = self._arrays.get(fid)
+        if arrays is None:
+            postings = self.postings[fid]
+            arrays = self._arrays[fid] = (
+                numpy.fromiter(postings.keys(), dtype=numpy.int64, count=len(postings)),
+                numpy.fromiter(postings.values(), dtype=numpy.float64, count=len(postings)),
+            )
+        return arrays
+
+    def _top_numpy(self, vector, norm, k, exclude):
+        if self._norm_array is None:
+            self._norm_array = numpy.array(self.norms, dtype=numpy.float64)
+        slots, weights = [], []
+        for fid, wq in vector.items():
+            s, w = self._postings_array(fid)
+            slots.append(s)
+            weights.append(w * wq)
+        dots = numpy.bincount(numpy.concatenate(slots), weights=numpy.concatenate(weights),
+                              minlength=len(self.codes))
+        dots[exclude] = 0.0
+        candidates = numpy.flatnonzero(dots)
+        if not len(candidates):
+            return []
+        scores = dots[candidates] / (self._norm_array[candidates] * norm)
+        if len(candidates) > k:
+            # 同じ値の病院が境界にある場合も病院コード順に選べるよう、境界の値以上をすべて残す
+            threshold = numpy.partition(scores, len(scores) - k)[len(scores) - k]
+            keep = scores >= threshold
+            candidates, scores = candidates[keep], scores[keep]
+        codes = self.codes
+        top = sorted(zip((-scores).tolist(), (codes[s] for s in candidates.tolist()), candidates.tolist()))[:k]
+        return [(-negative, slot) for negative, _, slot in top]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'engine': self.engine,
+                'hospitals': self.total,
+                'features': sum(1 for d in self.df if d > 0),
+                'seq': self.seq,
+            }
+
+# ============================================
+# コマンドライン
+# ============================================
+
+def _percentile(sorted_values, pct):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * pct))]
+
+def bench(database, queries, k, engines):
+    """作成時間・検索時間・1件の更新時間を計測"""
+    import random
+
+    codec = storage_codec.get_codec(database)
+    connect = lambda: sqlite3.connect(database)
+    report = {}
+    for engine in engines:
+        index = SimilarityIndex(connect, lambda: codec, engine)
+        started = time.perf_counter()
+        index.load()
+        load_s = time.perf_counter() - started
+
+        rng = random.Random(1)
+        codes = [code for code, slot in index.slots.items() if index.vectors[slot]]
+        probes = [rng.choice(codes) for _ in range(queries)]
+        timings = []
+        for code in probes:
+            t = time.perf_counter()
+            index.similar(code, k)
+            timings.append(time.perf_counter() - t)
+        timings.sort()
+
+        # 1件の変更の反映（_set のみ、DBは変更しない）
+        t = time.perf_counter()
+        with index._lock:
+            for code in probes[:100]:
+                slot = index.slots[code]
+                index._set(code, {index.features[f] for f in index.vectors[slot]} | {'facility:bench'})
+        update_us = (time.perf_counter() - t) / min(100, len(probes)) * 1e6
+
+        report[index.engine] = {
+            'hospitals': index.total,
+            'features': len(index.features),
+            'load_s': round(load_s, 2),
+            'query_median_ms': round(timings[len(timings) // 2] * 1000, 3),
+            'query_p99_ms': round(_percentile(timings, 0.99) * 1000, 3),
+            'update_us': round(update_us, 1),
+        }
+    return report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='似ている病院の検索')
+    parser.add_argument('--database', default=DB_PATH, help='データベースファイル')
+    parser.add_argument('--engine', default=SIMILARITY_ENGINE, choices=('auto', 'numpy', 'python'))
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p_similar = sub.add_parser('similar', help='似ている病院を表示')
+    p_similar.add_argument('code', help='病院コード')
+    p_similar.add_argument('--k', type=int, default=10)
+
+    p_bench = sub.add_parser('bench', help='作成・検索・更新の時間を計測（NumPy と Python を比較）')
+    p_bench.add_argument('--queries', type=int, default=300)
+    p_bench.add_argument('--k', type=int, default=10)
+
+    args = parser.parse_args(argv)
+    if args.command == 'bench':
+        import json
+        engines = ('numpy', 'python') if numpy is not None else ('python',)
+        print(json.dumps(bench(args.database, args.queries, args.k, engines), ensure_ascii=False, indent=2))
+        return
+
+    codec = storage_codec.get_codec(args.database)
+    index = SimilarityIndex(lambda: sqlite3.connect(args.database), lambda: codec, args.engine)
+    results = index.similar(args.code, args.k)
+    if results is None:
+        raise SystemExit(f"❌ 病院が見つかりません: {args.code}")
+    for r in results:
+        shared = ', '.join(f"{kind}={'/'.join(values)}" for kind, values in r['shared'].items())
+        print(f"{r['code']:<10} {r['score']:.4f}  {shared}")
+
+if __name__ == '__main__':
+    main()
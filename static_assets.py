@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+静的ファイル（CSS / JS）の配信
+
+起動時に css/ と js/ のファイルを読み込み、内容のハッシュと gzip / brotli の
+圧縮済みデータを作成しておきます。
+
+- index.html 内の参照はハッシュ付きURL（例: /css/main.1a2b3c4d5e.css）に書き換え、
+  長期キャッシュ（Cache-Control: immutable）で配信します。
+- ハッシュなしのURLは ETag による再検証（no-cache）で配信します。
+"""
+
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+
+from flask import request
+
+import compression
+
+HASH_LENGTH = 10
+LONG_CACHE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+PRIVATE_REVALIDATE = 'private, no-cache'
+
+# index.html 内の css/js 参照（href="/css/main.css" / src="js/config.js"）
+_ASSET_REF = re.compile(r'(href|src)="/?((?:css|js)/[^"?#]+)"')
+
+class Asset:
+    """圧縮済みデータを含む1ファイル分の情報"""
+
+    __slots__ = ('path', 'digest', 'mimetype', 'mtime', 'variants')
+
+    def __init__(self, path, data, mimetype, mtime):
+        self.path = path
+        self.digest = hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+        self.mimetype = mimetype
+        self.mtime = mtime
+        self.variants = {None: data}
+        for encoding in compression.available_encodings():
+            # 静的ファイルは一度だけ圧縮するため最大レベルを使う
+            compressed = compression.compress(data, encoding, 11 if encoding == 'br' else 9)
+            if len(compressed) < len(data):
+                self.variants[encoding] = compressed
+
+    @property
+    def hashed_path(self):
+        base, ext = os.path.splitext(self.path)
+        return f'{base}.{self.digest}{ext}'
+
+class StaticAssets:
+    """
+    静的ファイルのマニフェスト
+
+    Args:
+        root: アプリのルートディレクトリ
+        directories: 対象ディレクトリ
+        index: ハッシュ付きURLに書き換えて配信するHTML
+        auto_reload: ファイル更新を検知して作り直す（開発用）
+    """
+
+    def __init__(self, root, directories=('css', 'js'), index='index.html', auto_reload=False):
+        self.root = root
+        self.directories = directories
+        self.index = index
+        self.auto_reload = auto_reload
+        self.assets = {}
+        self.hashed = {}
+        self.index_asset = None
+        self._lock = threading.Lock()
+        self.build()
+
+    def _scan(self):
+        for directory in self.directories:
+            base = os.path.join(self.root, directory)
+            for dirpath, _, filenames in os.walk(base):
+                for filename in filenames:
+                    if filename.endswith(('.gz', '.br')):
+                        continue
+                    full = os.path.join(dirpath, filename)
+                    yield os.path.relpath(full, self.root).replace(os.sep, '/'), full
+
+    def build(self):
+        """全ファイルを読み込み、ハッシュと圧縮済みデータを作成"""
+        assets = {}
+        for path, full in self._scan():
+            with open(full, 'rb') as f:
+                data = f.read()
+            mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+            if mimetype.startswith('text/') or mimetype == 'application/javascript':
+                mimetype += '; charset=utf-8'
+            assets[path] = Asset(path, data, mimetype, os.path.getmtime(full))
+
+        hashed = {asset.hashed_path: asset for asset in assets.values()}
+
+        index_asset = None
+        index_path = os.path.join(self.root, self.index)
+        if os.path.exists(index_path):
+            with open(index_path, 'r', encoding='utf-8') as f:
+                html = f.read()
+
+            def replace(match):
+                asset = assets.get(match.group(2))
+                url = f'/{asset.hashed_path}' if asset else f'/{match.group(2)}'
+                return f'{match.group(1)}="{url}"'
+
+            html = _ASSET_REF.sub(replace, html)
+            index_asset = Asset(self.index, html.encode('utf-8'), 'text/html; charset=utf-8',
+                                os.path.getmtime(index_path))
+
+        self.assets, self.hashed, self.index_asset = assets, hashed, index_asset
+        print(f"📦 静的ファイルを準備しました: {len(assets)}件")
+
+    def _changed(self):
+        paths = dict(self._scan())
+        if set(paths) != set(self.assets):
+            return True
+        if any(os.path.getmtime(full) != self.assets[path].mtime for path, full in paths.items()):
+            return True
+        index_path = os.path.join(self.root, self.index)
+        return bool(self.index_asset) and os.path.getmtime(index_path) != self.index_asset.mtime
+
+    def _reload_if_changed(self):
+        if self.auto_reload:
+            with self._lock:
+                if self._changed():
+                    self.build()
+
+    def url_for(self, path):
+        """ハッシュ付きURLを返す（テンプレート用: {{ asset_url('css/main.css') }}）"""
+        self._reload_if_changed()
+        asset = self.assets.get(path.lstrip('/'))
+        return f'/{asset.hashed_path}' if asset else f'/{path.lstrip("/")}'
+
+    def _respond(self, asset, cache_control):
+        from flask import current_app
+
+        encoding = compression.negotiate(
+            request.headers.get('Accept-Encoding', ''),
+            tuple(e for e in compression.available_encodings() if e in asset.variants),
+        )
+        if encoding not in asset.variants:
+            # 圧縮版を用意していない（小さすぎる等）場合は非圧縮で返す
+            encoding = None
+        response = current_app.response_class(asset.variants[encoding], mimetype=None)
+        response.headers['Content-Type'] = asset.mimetype
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        response.headers['Cache-Control'] = cache_control
+        response.set_etag(f'{asset.digest}-{encoding}' if encoding else asset.digest)
+        return response.make_conditional(request)
+
+    def response(self, directory, filename):
+        """
+        css/js ファイルのレスポンス（該当なしの場合は None）
+
+        ハッシュ付きURLは長期キャッシュ、ハッシュなしURLは再検証で配信します。
+        """
+        self._reload_if_changed()
+        path = f'{directory}/{filename}'
+        asset = self.hashed.get(path)
+        if asset is not None:
+            return self._respond(asset, LONG_CACHE)
+        asset = self.assets.get(path)
+        if asset is not None:
+            return self._respond(asset, REVALIDATE)
+        return None
+
+    def index_response(self):
+        """ハッシュ付きURLに書き換えた index.html のレスポンス"""
+        self._reload_if_changed()
+        if self.index_asset is None:
+            return None
+        # ログイン済みユーザー向けのページのため共有キャッシュには置かない
+        return self._respond(self.index_asset, PRIVATE_REVALIDATE)
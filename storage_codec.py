@@ -0,0 +1,500 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+病院データ・履歴の圧縮保存（ストレージコーデック）
+
+mdata.kv / history.old_data / history.new_data を圧縮して保存します。
+圧縮済みの値は先頭1バイトが NUL のBLOBとして保存されるため、従来の
+JSONテキストと混在していても透過的に読み込めます。
+
+    コーデック   形式
+    none         JSONテキスト（従来どおり）
+    zlib         \\x00Z + zlib
+    zstd         \\x00S + 辞書ID(4バイト) + zstd（データから学習した辞書を使用）
+
+有効なコーデックと学習済み辞書は storage_codec テーブルの最新行に保存されます。
+環境変数 STORAGE_CODEC を指定すると書き込み時のコーデックを上書きできます。
+
+使い方:
+    python storage_codec.py migrate --codec zstd       # 辞書を学習して全件を再圧縮
+    python storage_codec.py migrate --codec none       # 非圧縮に戻す
+    python storage_codec.py report --codec zstd        # 非圧縮との比較（サイズ・ページ数・読み込み速度）
+
+    pip install zstandard   # zstd を使う場合（任意）
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import struct
+import tempfile
+import threading
+import time
+import zlib
+
+import json_engine
+
+MAGIC_ZLIB = b'\x00Z'
+MAGIC_ZSTD = b'\x00S'
+
+DEFAULT_LEVELS = {'zlib': 6, 'zstd': 3}
+
+# 圧縮対象のカラム
+COMPRESSED_COLUMNS = {
+    'mdata': ('kv',),
+    'history': ('old_data', 'new_data'),
+}
+
+CREATE_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS storage_codec (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        codec TEXT NOT NULL,
+        level INTEGER,
+        dictionary BLOB,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+'''
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError('zstd を使うには zstandard をインストールしてください（pip install zstandard）')
+    return zstandard
+
+# ============================================
+# コーデック
+# ============================================
+
+class StorageCodec:
+    """
+    JSONの圧縮・展開
+
+    Args:
+        codec: 書き込み時のコーデック（'none' / 'zlib' / 'zstd'）
+        level: 圧縮レベル
+        dictionaries: 辞書ID -> 辞書データ（zstd用）
+        dict_id: 書き込み時に使う辞書ID
+    """
+
+    def __init__(self, codec='none', level=None, dictionaries=None, dict_id=0):
+        if codec not in ('none', 'zlib', 'zstd'):
+            raise ValueError(f'Unknown storage codec: {codec}')
+        self.codec = codec
+        self.level = level or DEFAULT_LEVELS.get(codec)
+        self.dictionaries = dict(dictionaries or {})
+        self.dict_id = dict_id if dict_id in self.dictionaries else 0
+        self.loader = None  # 未知の辞書IDに出会ったときの再読み込み
+        self._local = threading.local()
+
+    # zstd の圧縮器・展開器はスレッド間で共有できないためスレッドごとに保持
+    def _compressor(self):
+        compressor = getattr(self._local, 'compressor', None)
+        if compressor is None:
+            zstd = _zstd()
+            kwargs = {'level': self.level}
+            if self.dict_id:
+                kwargs['dict_data'] = zstd.ZstdCompressionDict(self.dictionaries[self.dict_id])
+            compressor = self._local.compressor = zstd.ZstdCompressor(**kwargs)
+        return compressor
+
+    def _decompressor(self, dict_id):
+        cache = getattr(self._local, 'decompressors', None)
+        if cache is None:
+            cache = self._local.decompressors = {}
+        decompressor = cache.get(dict_id)
+        if decompressor is None:
+            zstd = _zstd()
+            if dict_id and dict_id not in self.dictionaries and self.loader:
+                self.dictionaries.update(self.loader())
+            if dict_id:
+                if dict_id not in self.dictionaries:
+                    raise ValueError(f'zstd dictionary {dict_id} not found')
+                decompressor = zstd.ZstdDecompressor(
+                    dict_data=zstd.ZstdCompressionDict(self.dictionaries[dict_id]))
+            else:
+                decompressor = zstd.ZstdDecompressor()
+            cache[dict_id] = decompressor
+        return decompressor
+
+    def encode(self, text):
+        """JSONテキストを保存用の値に変換（none の場合はそのまま）"""
+        if text is None or self.codec == 'none':
+            return text
+        raw = text.encode('utf-8')
+        if self.codec == 'zlib':
+            return MAGIC_ZLIB + zlib.compress(raw, self.level)
+        return MAGIC_ZSTD + struct.pack('>I', self.dict_id) + self._compressor().compress(raw)
+
+    def decode(self, value):
+        """保存された値をJSONテキストに戻す（形式は先頭バイトで判別）"""
+        if value is None or isinstance(value, str):
+            return value
+        value = bytes(value)
+        if value.startswith(MAGIC_ZLIB):
+            return zlib.decompress(value[2:]).decode('utf-8')
+        if value.startswith(MAGIC_ZSTD):
+            dict_id = struct.unpack('>I', value[2:6])[0]
+            return self._decompressor(dict_id).decompress(value[6:]).decode('utf-8')
+        return value.decode('utf-8')
+
+    def dumps(self, obj):
+        """辞書をJSON化して保存用の値に変換"""
+        return self.encode(json_engine.dumps(obj))
+
+    def loads(self, value):
+        """保存された値を辞書に戻す"""
+        return json_engine.loads(self.decode(value))
+
+# ============================================
+# DB設定の読み込み
+# ============================================
+
+_codecs = {}
+_codecs_lock = threading.Lock()
+
+def load_dictionaries(conn):
+    """storage_codec テーブルの辞書をすべて読み込む"""
+    try:
+        rows = conn.execute('SELECT id, dictionary FROM storage_codec WHERE dictionary IS NOT NULL').fetchall()
+    except sqlite3.OperationalError:
+        return {}
+    return {row[0]: bytes(row[1]) for row in rows}
+
+def load_codec(conn, override=None):
+    """
+    DBに記録された設定からコーデックを作成
+
+    Args:
+        conn: DB接続
+        override: 書き込み時のコーデックを上書き（環境変数 STORAGE_CODEC など）
+    """
+    try:
+        row = conn.execute('SELECT id, codec, level FROM storage_codec ORDER BY id DESC LIMIT 1').fetchone()
+    except sqlite3.OperationalError:
+        row = None
+    dictionaries = load_dictionaries(conn)
+
+    codec, level, dict_id = 'none', None, 0
+    if row:
+        dict_id, codec, level = row[0], row[1], row[2]
+    if override and override != codec:
+        codec, level = override, None
+    return StorageCodec(codec, level, dictionaries, dict_id)
+
+def get_codec(database):
+    """
+    データベースごとのコーデックを取得（プロセス内でキャッシュ）
+
+    Args:
+        database: DBファイルのパス
+    """
+    codec = _codecs.get(database)
+    if codec is None:
+        with _codecs_lock:
+            codec = _codecs.get(database)
+            if codec is None:
+                conn = sqlite3.connect(database)
+                try:
+                    codec = load_codec(conn, os.environ.get('STORAGE_CODEC'))
+                finally:
+                    conn.close()
+
+                def reload_dictionaries():
+                    c = sqlite3.connect(database)
+                    try:
+                        return load_dictionaries(c)
+                    finally:
+                        c.close()
+
+                codec.loader = reload_dictionaries
+                _codecs[database] = codec
+    return codec
+
+def reset_codec_cache():
+    """キャッシュを破棄（マイグレーション後に呼ぶ）"""
+    with _codecs_lock:
+        _codecs.clear()
+
+# ============================================
+# 一部のフィールドの読み込み
+# ============================================
+
+def json_path(field):
+    """フィールド名の JSON パス（json_extract で扱えない名前は None）"""
+    if '"' in field or '\\' in field:
+        return None
+    return f'$."{field}"'
+
+def select_fields(conn, codec, fields, where='', params=()):
+    """
+    mdata の一部のフィールドだけを読み込む
+
+    JSONテキストの行は SQLite の json_extract で必要な値だけを取り出し、
+    圧縮済み（BLOB）の行・JSONとして読めない行だけ Python で展開します。
+
+    Args:
+        fields: フィールド名のリスト
+        where: 'WHERE ...'（mdata の条件）
+        params: where のパラメータ
+
+    Yields:
+        (code, {フィールド: 値})（値がないフィールドは含まない）
+    """
+    fields = list(fields)
+    paths = [json_path(field) for field in fields]
+    if fields and None not in paths:
+        extracts = ''.join(f', CASE WHEN plain THEN json_extract(kv, ?) END' for _ in fields)
+        query = f'''
+            SELECT code, plain, CASE WHEN plain THEN NULL ELSE kv END{extracts}
+            FROM (SELECT code, kv, typeof(kv) = 'text' AND json_valid(kv) AS plain FROM mdata {where})
+        '''
+        rows = conn.execute(query, [*paths, *params])
+    else:
+        rows = ((row[0], 0, row[1]) for row in conn.execute(f'SELECT code, kv FROM mdata {where}', params))
+
+    for row in rows:
+        if row[1]:
+            yield row[0], {field: value for field, value in zip(fields, row[3:]) if value is not None}
+            continue
+        try:
+            data = codec.loads(row[2])
+        except Exception:
+            # 解析できないデータは読み込まない
+            continue
+        yield row[0], {field: data[field] for field in fields if data.get(field) is not None}
+
+def series_base(key):
+    """連番の列のフィールド名から番号を除いた部分（'PHS_12' → 'PHS_'、SQLite の rtrim と同じ）"""
+    return key.rstrip('0123456789')
+
+def select_items(conn, codec, keys=(), series=(), where='', params=()):
+    """
+    mdata の指定したフィールドと連番の列だけを読み込む
+
+    連番の列がない場合は select_fields()（json_extract）で必要な値だけを取り出します。
+    連番の列（番号の分からないキー）がある場合は kv を展開して絞り込みます
+    （SQLite 3.40 の json_each でキーを絞り込むと、展開するより5〜6倍遅いため）。
+
+    Args:
+        keys: フィールド名のリスト
+        series: 連番の列の名前のリスト（'PHS' は PHS_1, PHS_2, ...）
+        where: 'WHERE ...'（mdata の条件）
+        params: where のパラメータ
+
+    Yields:
+        (code, {フィールド: 値})（値がないフィールドは含まない）
+    """
+    if not series:
+        yield from select_fields(conn, codec, keys, where, params)
+        return
+    wanted, prefixes = set(keys), {f'{base}_' for base in series}
+    for code, kv in conn.execute(f'SELECT code, kv FROM mdata {where}', params):
+        try:
+            data = codec.loads(kv)
+        except Exception:
+            # 解析できないデータは読み込まない
+            continue
+        yield code, {key: value for key, value in data.items() if value is not None and
+                     (key in wanted or (series_base(key) in prefixes and key[-1:].isdigit()))}
+
+# ============================================
+# マイグレーション
+# ============================================
+
+def _iter_blobs(conn, decoder, limit=None):
+    """圧縮対象カラムの値（JSONテキスト）を順に返す"""
+    for table, columns in COMPRESSED_COLUMNS.items():
+        for column in columns:
+            query = f'SELECT {column} FROM {table} WHERE {column} IS NOT NULL ORDER BY random()'
+            if limit:
+                query += f' LIMIT {int(limit)}'
+            for (value,) in conn.execute(query):
+                yield decoder.decode(value)
+
+def train_dictionary(conn, decoder, dict_size=112640, samples=5000):
+    """保存済みデータから zstd 辞書を学習"""
+    zstd = _zstd()
+    data = [text.encode('utf-8') for text in _iter_blobs(conn, decoder, samples)]
+    if len(data) < 10:
+        raise SystemExit('辞書の学習に必要なデータが不足しています')
+    return zstd.train_dictionary(dict_size, data).as_bytes()
+
+def migrate(database, codec_name, level=None, dict_size=112640, samples=5000, batch_size=500, vacuum=False):
+    """
+    全件を指定のコーデックで再保存（一括マイグレーション）
+
+    読み込みは先頭バイトで形式を判別するため、途中で中断しても再実行できます。
+    """
+    conn = sqlite3.connect(database)
+    conn.execute(CREATE_TABLE_SQL)
+    decoder = load_codec(conn)
+
+    dictionary = None
+    if codec_name == 'zstd':
+        print(f'📚 zstd辞書を学習中（サンプル: 最大{samples}件/カラム, サイズ: {dict_size}バイト）...')
+        dictionary = train_dictionary(conn, decoder, dict_size, samples)
+
+    cur = conn.execute('INSERT INTO storage_codec (codec, level, dictionary) VALUES (?, ?, ?)',
+                       (codec_name, level or DEFAULT_LEVELS.get(codec_name), dictionary))
+    dict_id = cur.lastrowid if dictionary else 0
+    conn.commit()
+
+    dictionaries = load_dictionaries(conn)
+    decoder.dictionaries.update(dictionaries)
+    encoder = StorageCodec(codec_name, level, dictionaries, dict_id)
+
+    total = 0
+    for table, columns in COMPRESSED_COLUMNS.items():
+        rowids = [r[0] for r in conn.execute(f'SELECT rowid FROM {table} ORDER BY rowid')]
+        column_list = ', '.join(columns)
+        assignments = ', '.join(f'{c} = ?' for c in columns)
+        for start in range(0, len(rowids), batch_size):
+            batch = rowids[start:start + batch_size]
+            placeholders = ','.join('?' * len(batch))
+            rows = conn.execute(
+                f'SELECT rowid, {column_list} FROM {table} WHERE rowid IN ({placeholders})', batch).fetchall()
+            updates = [
+                tuple(encoder.encode(decoder.decode(value)) for value in row[1:]) + (row[0],)
+                for row in rows
+            ]
+            conn.executemany(f'UPDATE {table} SET {assignments} WHERE rowid = ?', updates)
+            conn.commit()
+            total += len(updates)
+        print(f'  ✅ {table}: {len(rowids)}件')
+
+    if vacuum:
+        print('🧹 VACUUM 実行中...')
+        conn.execute('VACUUM')
+    conn.close()
+    reset_codec_cache()
+    print(f'✅ マイグレーション完了: codec={codec_name}, 件数={total}')
+    return total
+
+# ============================================
+# 比較レポート
+# ============================================
+
+def _table_pages(conn):
+    """テーブル（インデックス含む）ごとのページ数"""
+    try:
+        rows = conn.execute('SELECT name, COUNT(*) FROM dbstat GROUP BY name').fetchall()
+        return {name: count for name, count in rows}
+    except sqlite3.OperationalError:
+        return {}
+
+def _measure(database, reads, cache_pages, seed):
+    conn = sqlite3.connect(database)
+    page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+    page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+    pages = _table_pages(conn)
+    codes = [r[0] for r in conn.execute('SELECT code FROM mdata')]
+    history_ids = [r[0] for r in conn.execute('SELECT id FROM history')]
+    conn.close()
+
+    rng = random.Random(seed)
+
+    # 小さなページキャッシュで、ランダムな病院データ読み込みを計測
+    conn = sqlite3.connect(database)
+    codec = load_codec(conn)
+    conn.execute(f'PRAGMA cache_size = {int(cache_pages)}')
+    latencies = []
+    for _ in range(reads):
+        code = rng.choice(codes)
+        started = time.perf_counter()
+        value = conn.execute('SELECT kv FROM mdata WHERE code = ?', (code,)).fetchone()[0]
+        codec.loads(value)
+        latencies.append((time.perf_counter() - started) * 1e6)
+
+    history_latencies = []
+    for _ in range(min(reads, len(history_ids))):
+        history_id = rng.choice(history_ids)
+        started = time.perf_counter()
+        row = conn.execute('SELECT old_data, new_data FROM history WHERE id = ?', (history_id,)).fetchone()
+        codec.loads(row[0]) if row[0] else None
+        codec.loads(row[1]) if row[1] else None
+        history_latencies.append((time.perf_counter() - started) * 1e6)
+    conn.close()
+
+    def summary(values):
+        values = sorted(values)
+        if not values:
+            return None
+        return {
+            'p50_us': round(values[len(values) // 2], 2),
+            'p95_us': round(values[int(len(values) * 0.95) - 1], 2),
+            'mean_us': round(statistics.fmean(values), 2),
+        }
+
+    return {
+        'file_bytes': os.path.getsize(database),
+        'page_size': page_size,
+        'page_count': page_count,
+        'pages': {name: pages[name] for name in ('mdata', 'history') if name in pages},
+        'cache_pages': cache_pages,
+        'mdata_read': summary(latencies),
+        'history_read': summary(history_latencies),
+    }
+
+def report(database, codec_name, level=None, reads=2000, cache_pages=500, seed=1):
+    """非圧縮と指定コーデックのDBサイズ・ページ数・読み込み時間を比較"""
+    workdir = tempfile.mkdtemp(prefix='storage_codec_')
+    try:
+        results = {}
+        for name in ('none', codec_name):
+            path = os.path.join(workdir, f'{name}.sqlite3')
+            with sqlite3.connect(database) as src, sqlite3.connect(path) as dst:
+                src.backup(dst)
+            migrate(path, name, level=level, vacuum=True)
+            results[name] = _measure(path, reads, cache_pages, seed)
+
+        baseline, compressed = results['none'], results[codec_name]
+        results['ratio'] = {
+            'file_bytes': round(compressed['file_bytes'] / baseline['file_bytes'], 4),
+            'mdata_read_p50': round(compressed['mdata_read']['p50_us'] / baseline['mdata_read']['p50_us'], 4),
+        }
+        return results
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='病院データ・履歴の圧縮保存')
+    parser.add_argument('--database', default=os.environ.get('DATABASE_PATH', 'hospital_data.sqlite3'))
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    m = sub.add_parser('migrate', help='全件を指定のコーデックで再保存')
+    m.add_argument('--codec', choices=['none', 'zlib', 'zstd'], required=True)
+    m.add_argument('--level', type=int)
+    m.add_argument('--dict-size', type=int, default=112640, help='zstd辞書のサイズ（バイト）')
+    m.add_argument('--samples', type=int, default=5000, help='辞書学習に使うカラムごとの件数')
+    m.add_argument('--vacuum', action='store_true', help='完了後にVACUUMで領域を回収')
+
+    r = sub.add_parser('report', help='非圧縮との比較')
+    r.add_argument('--codec', choices=['zlib', 'zstd'], required=True)
+    r.add_argument('--level', type=int)
+    r.add_argument('--reads', type=int, default=2000)
+    r.add_argument('--cache-pages', type=int, default=500, help='計測時のページキャッシュ（ページ数）')
+    r.add_argument('--output', help='結果JSONの保存先')
+
+    args = parser.parse_args(argv)
+    if not os.path.exists(args.database):
+        raise SystemExit(f'DBが見つかりません: {args.database}')
+
+    if args.command == 'migrate':
+        migrate(args.database, args.codec, args.level, args.dict_size, args.samples, vacuum=args.vacuum)
+    else:
+        results = report(args.database, args.codec, args.level, args.reads, args.cache_pages)
+        text = json.dumps(results, ensure_ascii=False, indent=2)
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                f.write(text + '\n')
+            print(f'✅ 結果を保存しました: {args.output}')
+        else:
+            print(text)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+テスト用のアプリ（同梱の hospital_data.sqlite3 の一時コピーを使用）
+
+コピーにマイグレーションを適用してから create_app() に渡します。
+"""
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+PASSWORD = 'test-password'
+
+@pytest.fixture(scope='session')
+def flask_app():
+    workdir = tempfile.mkdtemp()
+    db_path = os.path.join(workdir, 'hospital_data.sqlite3')
+    with sqlite3.connect(os.path.join(ROOT, 'hospital_data.sqlite3')) as src, sqlite3.connect(db_path) as dst:
+        src.backup(dst)
+    os.environ.setdefault('SECRET_KEY', 'test-secret-key')
+    os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+    os.chdir(ROOT)
+
+    import migrations
+    migrations.upgrade(db_path)
+    from werkzeug.security import generate_password_hash
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("UPDATE users SET password = ? WHERE username = 'admin'",
+                     (generate_password_hash(PASSWORD, method='pbkdf2:sha256:1000'),))
+
+    import app
+    yield app.create_app(database=db_path)
+    app.audit_log.close()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+@pytest.fixture(scope='session')
+def app_module(flask_app):
+    import app
+    return app
+
+@pytest.fixture
+def client(flask_app):
+    client = flask_app.test_client()
+    response = client.post('/login', data={'username': 'admin', 'password': PASSWORD})
+    assert response.status_code == 302
+    return client
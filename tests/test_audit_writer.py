@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""audit_writer.AuditWriter の書き込み失敗・再試行"""
+
+import sqlite3
+import threading
+
+import pytest
+
+import audit_writer
+
+HISTORY = ('01-02', 'update', None, None, None, 1, 'admin')
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / 'audit.sqlite3')
+    with sqlite3.connect(path) as conn:
+        conn.execute('''
+            CREATE TABLE history (
+                id INTEGER PRIMARY KEY, code TEXT NOT NULL, action TEXT, old_data TEXT,
+                new_data TEXT, changed_fields TEXT, user_id INTEGER, username TEXT)
+        ''')
+    return path
+
+def make_writer(path, retry_seconds=5):
+    return audit_writer.AuditWriter(lambda: sqlite3.connect(path, timeout=0.05),
+                                    durability='sync', retry_seconds=retry_seconds)
+
+def count(path):
+    with sqlite3.connect(path) as conn:
+        return conn.execute('SELECT COUNT(*) FROM history').fetchone()[0]
+
+def test_retries_while_database_is_locked(db_path):
+    writer = make_writer(db_path)
+    lock = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+    lock.execute('BEGIN EXCLUSIVE')
+    timer = threading.Timer(0.3, lambda: lock.execute('ROLLBACK'))
+    timer.start()
+    try:
+        writer.add('history', HISTORY)
+    finally:
+        timer.join()
+        lock.close()
+        writer.close()
+    assert count(db_path) == 1
+    assert writer.stats['retries'] >= 1 and writer.stats['dropped'] == 0
+
+def test_failed_rows_are_reported_to_waiting_callers(db_path):
+    writer = make_writer(db_path, retry_seconds=0)
+    try:
+        with pytest.raises(audit_writer.AuditWriteError):
+            writer.add('login_history', (1, 'admin', None, None, True))   # テーブルがない
+        with pytest.raises(audit_writer.AuditWriteError):
+            writer.add('history', (None,) + HISTORY[1:])                  # NOT NULL 違反
+        seq = writer.add('history', HISTORY)
+        assert writer.flush(seq) and writer.flush()
+        writer.add('history', (None,) + HISTORY[1:], wait=False)
+        assert writer.flush() is False
+    finally:
+        writer.close()
+    assert count(db_path) == 1
+    assert writer.stats['dropped'] == 3
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""ログイン失敗の記録のキー（X-Forwarded-For を付け替えても別のクライアントにならない）"""
+
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+import login_guard
+
+def failed_logins(client, count, forwarded):
+    statuses = []
+    for i in range(count):
+        response = client.post('/login', data={'username': f'nobody{i}', 'password': 'x'},
+                               headers={'X-Forwarded-For': forwarded(i)},
+                               environ_base={'REMOTE_ADDR': '10.0.0.5'})
+        statuses.append(response.status_code)
+    return statuses
+
+def test_login_throttle_ignores_spoofed_forwarded_for(app_module, flask_app, monkeypatch):
+    monkeypatch.setattr(app_module, 'login_throttle', login_guard.LoginThrottle(max_ip_failures=3, max_user_failures=100))
+    client = flask_app.test_client()
+    statuses = failed_logins(client, 5, lambda i: f'203.0.113.{i}')
+    assert statuses[:3] == [200] * 3 and statuses[3:] == [429, 429]
+
+def test_login_throttle_behind_trusted_proxy(app_module, flask_app, monkeypatch):
+    monkeypatch.setattr(app_module, 'login_throttle', login_guard.LoginThrottle(max_ip_failures=3, max_user_failures=100))
+    monkeypatch.setattr(flask_app, 'wsgi_app', ProxyFix(flask_app.wsgi_app, x_for=1))
+    client = flask_app.test_client()
+    # プロキシが追加した最後のアドレスだけを使う（クライアントが付けた先頭のアドレスは無視）
+    statuses = failed_logins(client, 4, lambda i: f'198.51.100.{i}, 192.0.2.7')
+    assert statuses == [200, 200, 200, 429]
+    assert failed_logins(client, 1, lambda i: '192.0.2.8') == [200]
+
+def test_rate_limit_ignores_spoofed_forwarded_for(app_module, flask_app, monkeypatch):
+    import rate_limit
+    limiter = rate_limit.RateLimiter(limits=rate_limit.parse_limits('read=0.01/2'), enabled=True)
+    monkeypatch.setattr(app_module, 'rate_limiter', limiter)
+    client = flask_app.test_client()
+    statuses = [client.get('/api/session', headers={'X-Forwarded-For': f'203.0.113.{i}'},
+                           environ_base={'REMOTE_ADDR': '10.0.0.6'}).status_code for i in range(4)]
+    assert statuses == [401, 401, 429, 429]
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""同じ病院の同時保存で集計（aggregate_stats）がずれない"""
+
+import sqlite3
+import threading
+import time
+
+import aggregate_stats
+from conftest import PASSWORD
+
+def stats_rows(conn):
+    return sorted(conn.execute('SELECT * FROM stats_hospital_doctors').fetchall())
+
+def test_concurrent_saves_keep_stats_consistent(app_module, flask_app, client, monkeypatch):
+    code = '01-05'
+    original = client.get(f'/api/mdata/{code}').get_json()['kv']
+    # 全員が同時に、医師の行を1行増やした版を保存（変更前はいずれも original）
+    added = dict(original, **{'診療科_40': '内科', 'Dr./出身大学_40': 'テスト大学', '卒業_40': 'H20'})
+
+    # 既存データの読み込みから書き込みまでの間（入力チェック）を遅くして、保存を重ならせる
+    check = app_module.validator.check
+    monkeypatch.setattr(app_module.validator, 'check', lambda *args: time.sleep(0.01) or check(*args))
+    statuses = []
+    barrier = threading.Barrier(6)
+
+    def worker():
+        client = flask_app.test_client()
+        client.post('/login', data={'username': 'admin', 'password': PASSWORD})
+        barrier.wait()
+        statuses.append(client.post(f'/api/mdata/{code}', json={'kv': added}).status_code)
+
+    threads = [threading.Thread(target=worker) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert statuses == [200] * 6
+
+    conn = sqlite3.connect(app_module.DATABASE)
+    try:
+        incremental = stats_rows(conn)
+        conn.execute('BEGIN')
+        aggregate_stats.fill(conn, app_module.get_storage_codec())
+        assert stats_rows(conn) == incremental
+        conn.rollback()
+    finally:
+        conn.close()
+    monkeypatch.undo()
+    assert client.post(f'/api/mdata/{code}', json={'kv': original}).status_code == 200
+
+def test_failed_save_releases_write_lock(app_module, client, monkeypatch):
+    code = '01-05'
+    original = client.get(f'/api/mdata/{code}').get_json()['kv']
+
+    def fail(*args):
+        raise RuntimeError('boom')
+
+    monkeypatch.setattr(app_module.geo, 'apply_change', fail)
+    assert client.post(f'/api/mdata/{code}', json={'kv': dict(original, ファミレス='x')}).status_code == 500
+    monkeypatch.undo()
+
+    # 失敗した保存の書き込みロックが残っていれば、次の書き込みは busy_timeout まで待って失敗する
+    conn = sqlite3.connect(app_module.DATABASE, timeout=0.5)
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.rollback()
+    finally:
+        conn.close()
+    assert client.get(f'/api/mdata/{code}').get_json()['kv'] == original
@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+"""create_app: 未適用のマイグレーションがあるDBでは起動しない"""
+
+import sqlite3
+
+import pytest
+
+from conftest import ROOT
+
+def test_refuses_unmigrated_database(app_module, tmp_path):
+    db_path = str(tmp_path / 'hospital_data.sqlite3')
+    with sqlite3.connect(f'{ROOT}/hospital_data.sqlite3') as src, sqlite3.connect(db_path) as dst:
+        src.backup(dst)
+    with pytest.raises(RuntimeError, match='python migrations.py --database .* upgrade'):
+        app_module.create_app(preload=True, database=db_path)
+    # 作成済みのアプリはそのまま
+    assert app_module.DATABASE != db_path
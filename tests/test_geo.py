@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+"""geo.GeoGrid の近隣検索"""
+
+import random
+
+import geo
+
+def scattered_points(n=40, seed=1):
+    rng = random.Random(seed)
+    return [(f'h{i}', 35 + rng.uniform(-3, 3), 139 + rng.uniform(-3, 3)) for i in range(n)]
+
+def test_nearest_has_no_duplicate_codes():
+    grid = geo.GeoGrid(scattered_points())
+    for results in (grid.nearest(35.0, 139.0, k=40),
+                    grid.nearest(35.0, 139.0, k=None, radius_km=2000),
+                    grid.nearest(35.0, 139.0, k=40, radius_km=2000)):
+        codes = [code for _, code in results]
+        assert len(codes) == len(set(codes)) == 40
+
+def test_nearest_matches_brute_force():
+    points = scattered_points()
+    grid = geo.GeoGrid(points)
+    expected = sorted((geo.haversine_km(35.0, 139.0, lat, lon), code) for code, lat, lon in points)[:10]
+    results = grid.nearest(35.0, 139.0, k=10)
+    assert [code for _, code in results] == [code for _, code in expected]
+    assert all(abs(a - b) < 1e-6 for (a, _), (b, _) in zip(results, expected))
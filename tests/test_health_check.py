@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""readiness: 未適用のマイグレーションがあるDBは準備未完了"""
+
+import sqlite3
+
+import health_check
+import migrations
+
+class InlineSocketIO:
+    async_mode = 'threading'
+
+    def start_background_task(self, target, *args):
+        target(*args)
+
+    def sleep(self, seconds):
+        pass
+
+def readiness(db_path):
+    return health_check.ReadinessCheck(lambda: sqlite3.connect(db_path), str(db_path), lambda: 0,
+                                       InlineSocketIO(), migrations.LATEST_VERSION)
+
+def test_unmigrated_database_is_not_ready(tmp_path):
+    db_path = tmp_path / 'hospital_data.sqlite3'
+    with sqlite3.connect(db_path) as conn:
+        conn.execute('CREATE TABLE mdata (code TEXT PRIMARY KEY, kv TEXT)')
+    result = readiness(db_path).run()
+    assert 'schema' in result['failed']
+    assert result['checks']['schema'] == {'ok': False, 'version': 0, 'required': migrations.LATEST_VERSION}
+
+    migrations.upgrade(str(db_path))
+    assert readiness(db_path).run()['checks']['schema']['ok']
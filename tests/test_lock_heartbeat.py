@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+"""POST /api/lock/heartbeat（病院コード 'heartbeat' のロックにならない）"""
+
+def test_heartbeat_checks_lock_without_acquiring(app_module, flask_app, client):
+    code = '01-10'
+    assert client.post(f'/api/lock/{code}').status_code == 200
+    try:
+        response = client.post('/api/lock/heartbeat', json={'code': code})
+        assert response.status_code == 200 and response.get_json()['ok']
+        locks = client.get('/api/lock/status').get_json()['locks']
+        assert 'heartbeat' not in [lock['code'] for lock in locks]
+    finally:
+        client.delete(f'/api/lock/{code}')
+
+    response = client.post('/api/lock/heartbeat', json={'code': code})
+    assert response.status_code == 409 and response.get_json()['error'] == 'Lock lost'
+    assert client.post('/api/lock/heartbeat', json={}).status_code == 400
+
+    with flask_app.test_request_context('/api/lock/heartbeat', method='POST'):
+        from flask import request
+        assert request.endpoint == 'main.api_lock_heartbeat'
+    assert app_module.ROUTE_CLASSES['api_lock_heartbeat'] == 'heartbeat'
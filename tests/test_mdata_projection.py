@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+"""/api/mdata/<code>/open の射影（画面の読み込み）と保存"""
+
+def screen_kv(app_module, opened):
+    """js/api.js の collectForSave と同じく、画面に表示した内容だけから保存データを作る"""
+    kv = {field: opened['kv'].get(field, '') for field in app_module.META_FIELDS}
+    for name, rows in opened['tables'].items():
+        for n, row in enumerate(rows, 1):
+            for key, value in zip(app_module.TABLE_KEYS[name], row):
+                if value:
+                    kv[f'{key}_{n}'] = value
+    return kv
+
+def test_projected_open_then_save_keeps_famires(app_module, client):
+    code = '01-04'
+    before = client.get(f'/api/mdata/{code}').get_json()['kv']
+    assert before.get('ファミレス')
+
+    opened = client.post(f'/api/mdata/{code}/open',
+                         json={'fields': 'meta,main,facilities,vendors', 'shape': 'tables'}).get_json()
+    assert opened['ok'] and opened['kv']['ファミレス'] == before['ファミレス']
+    try:
+        response = client.post(f'/api/mdata/{code}', json={'kv': screen_kv(app_module, opened)})
+        assert response.status_code == 200, response.get_json()
+    finally:
+        client.delete(f'/api/lock/{code}')
+
+    after = client.get(f'/api/mdata/{code}').get_json()['kv']
+    assert after['ファミレス'] == before['ファミレス']
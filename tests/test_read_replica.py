@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+"""リードレプリカ: 接続中にコピーが切り替わっても空のDBを開かない"""
+
+import sqlite3
+
+import read_replica
+
+def test_reconnects_when_copy_switches_while_connecting(tmp_path, monkeypatch):
+    db_path = str(tmp_path / 'hospital_data.sqlite3')
+    with sqlite3.connect(db_path) as conn:
+        conn.execute('CREATE TABLE mdata (code TEXT PRIMARY KEY)')
+        conn.execute("INSERT INTO mdata VALUES ('01-02')")
+    replica = read_replica.ReadReplica(db_path, enabled=True, check_interval=60)
+    replica.refresh()
+
+    # 取得済みの URI に接続する直前に2回切り替える（古いコピーは解放される）
+    real_connect = sqlite3.connect
+    switched = []
+
+    def connect(database, *args, **kwargs):
+        if kwargs.get('uri') and not switched:
+            switched.append(database)
+            replica.refresh()
+            replica.refresh()
+        return real_connect(database, *args, **kwargs)
+
+    monkeypatch.setattr(sqlite3, 'connect', connect)
+    conn = replica.connect()
+    try:
+        assert switched and [row['code'] for row in conn.execute('SELECT code FROM mdata')] == ['01-02']
+    finally:
+        conn.close()
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""一括置換: プレビューの後に変更された病院は conflict"""
+
+import json
+import sqlite3
+import threading
+import time
+
+import find_replace
+
+RULE = {'find': 'REPLACE-ME', 'replace': 'REPLACED', 'fields': ['備考_*']}
+CODES = ['01-07', '01-08', '01-09']
+
+def preview_versions(client):
+    response = client.post('/api/mdata/replace/preview', json=RULE)
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    return {line['code']: line['version'] for line in lines if line['type'] == 'hospital'}
+
+def set_memo(app_module, code, value, updated_at):
+    codec = app_module.get_storage_codec()
+    conn = sqlite3.connect(app_module.DATABASE)
+    with conn:
+        kv = codec.loads(conn.execute('SELECT kv FROM mdata WHERE code = ?', (code,)).fetchone()[0])
+        kv['備考_1'] = value
+        conn.execute('UPDATE mdata SET kv = ?, updated_at = ? WHERE code = ?', (codec.dumps(kv), updated_at, code))
+    conn.close()
+
+def memo(client, code):
+    return client.get(f'/api/mdata/{code}').get_json()['kv'].get('備考_1')
+
+def test_apply_rejects_hospitals_edited_after_preview(app_module, client):
+    codes = CODES
+    for code in codes:
+        set_memo(app_module, code, 'REPLACE-ME', '2020-01-01 00:00:00')
+    versions = preview_versions(client)
+    assert set(versions) == set(codes)
+
+    # プレビューの後: 1件は対象のまま編集、1件は対象でなくなる編集
+    edited, unmatched, untouched = codes
+    set_memo(app_module, edited, 'REPLACE-ME (edited)', '2020-01-02 00:00:00')
+    set_memo(app_module, unmatched, 'something else', '2020-01-02 00:00:00')
+
+    response = client.post('/api/mdata/replace/apply', json=dict(RULE, versions=versions))
+    statuses = {r['code']: r['status'] for r in response.get_json()['results']}
+    assert statuses == {edited: 'conflict', unmatched: 'conflict', untouched: 'updated'}
+    assert memo(client, edited) == 'REPLACE-ME (edited)'
+    assert memo(client, unmatched) == 'something else'
+    assert memo(client, untouched) == 'REPLACED'
+
+    response = client.post('/api/mdata/replace/apply',
+                           json=dict(RULE, versions=preview_versions(client), atomic=True))
+    assert response.status_code == 200 and memo(client, edited) == 'REPLACED (edited)'
+
+def test_concurrent_index_sync_adds_each_hospital_once(app_module, client):
+    codec = app_module.get_storage_codec()
+    setup = sqlite3.connect(app_module.DATABASE)
+    with setup:
+        setup.executemany('INSERT OR IGNORE INTO mdata_search_dirty (code) VALUES (?)', [(c,) for c in CODES])
+    setup.close()
+
+    class SlowCodec:
+        # 検索用テキストの作成中に、もう一方の接続が更新待ちを読み込むようにする
+        def loads(self, kv):
+            time.sleep(0.05)
+            return codec.loads(kv)
+
+    barrier = threading.Barrier(2)
+
+    def worker():
+        conn = sqlite3.connect(app_module.DATABASE, timeout=10)
+        try:
+            barrier.wait()
+            find_replace.sync_index(conn, SlowCodec())
+        finally:
+            conn.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    conn = sqlite3.connect(app_module.DATABASE)
+    try:
+        placeholders = ','.join('?' * len(CODES))
+        counts = dict(conn.execute(f'SELECT code, COUNT(*) FROM mdata_search WHERE code IN ({placeholders}) '
+                                   'GROUP BY code', CODES))
+    finally:
+        conn.close()
+    assert counts == {code: 1 for code in CODES}
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+"""圧縮版のない静的ファイルの配信"""
+
+from flask import Flask
+
+import static_assets
+
+def test_small_asset_is_served_uncompressed(tmp_path):
+    # 3バイトのファイルは圧縮すると大きくなるため圧縮版が作られない
+    (tmp_path / 'css').mkdir()
+    (tmp_path / 'css' / 'a.css').write_bytes(b'a{}')
+    assets = static_assets.StaticAssets(str(tmp_path), directories=('css',))
+    assert list(assets.assets['css/a.css'].variants) == [None]
+
+    flask_app = Flask(__name__)
+    with flask_app.test_request_context('/css/a.css', headers={'Accept-Encoding': 'gzip, br'}):
+        response = assets.response('css', 'a.css')
+    assert response.status_code == 200
+    assert 'Content-Encoding' not in response.headers
+    assert response.get_data() == b'a{}'
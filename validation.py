@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+"""
+病院データ（mdata.kv）の入力チェック
+
+チェックの内容は RULES に宣言的に書き、起動時に1回だけ Validator にコンパイル
+します（正規表現のコンパイル、フィールド名 → チェックの対応表の作成）。
+保存時は変更されたフィールドのチェックだけを行います。
+
+ルールの種類（kind）:
+    required     値が必要（fields）
+    pattern      値全体が正規表現に一致する（fields、空の値はチェックしない）
+    row_requires 連番の列の同じ行で、when のいずれかに値があれば fields のいずれかにも値が必要
+    row_unique   連番の列の値が行どうしで重複しない（fields）
+
+fields には通常のフィールド名（'TEL'）と、連番の列のフィールド名から '_n' を除いた
+名前（'PHS' は PHS_1, PHS_2, ... に適用）のどちらも書けます。
+
+level:
+    error    保存を拒否（VALIDATION_MODE=warn の場合は警告として保存）
+    warning  保存した上で警告を返す
+
+使い方:
+    python validation.py check --output violations.csv
+    python validation.py check --level error
+    python validation.py bench
+"""
+
+import argparse
+import codecs
+import csv
+import os
+import re
+import sqlite3
+import time
+from functools import lru_cache
+
+import storage_codec
+
+DB_PATH = os.environ.get('DATABASE_PATH', 'hospital_data.sqlite3')
+
+# enforce: error のルールに違反する保存を拒否 / warn: 警告のみ / off: チェックしない
+VALIDATION_MODE = os.environ.get('VALIDATION_MODE', 'enforce')
+
+LEVELS = ('error', 'warning')
+
+# 市外局番から始まる電話番号（ハイフン区切り、またはハイフンなし）
+PHONE = r'0\d{1,4}-\d{1,4}-\d{3,4}|0\d{2,4}-\d{5,6}|0\d{9,10}'
+
+RULES = (
+    {'name': 'code_format', 'kind': 'pattern', 'fields': ('コード',), 'pattern': r'\d{2}-[0-9A-Za-z]+',
+     'level': 'error', 'message': 'コードは「都道府県コード-番号」（例: 01-02）で入力してください'},
+    {'name': 'tel_required', 'kind': 'required', 'fields': ('TEL',),
+     'level': 'error', 'message': '電話番号を入力してください'},
+    {'name': 'tel_format', 'kind': 'pattern', 'fields': ('TEL',), 'pattern': rf'(?:{PHONE}).*',
+     'level': 'error', 'message': '電話番号（例: 011-890-1110）で始まっていません'},
+    {'name': 'tel_extra', 'kind': 'pattern', 'fields': ('TEL',), 'pattern': PHONE,
+     'level': 'warning', 'message': '電話番号の後に番号以外の記載があります（TEL・メモ に記載してください）'},
+    {'name': 'postcode_format', 'kind': 'pattern', 'fields': ('郵便番号',), 'pattern': r'\d{3}-\d{4}',
+     'level': 'error', 'message': '郵便番号は 123-4567 の形式で入力してください'},
+    {'name': 'phs_format', 'kind': 'pattern', 'fields': ('PHS', '直PHS'), 'pattern': r'\d{3,6}|0[789]0-?\d{4}-?\d{4}',
+     'level': 'error', 'message': 'PHS番号は数字（3〜6桁）または 070-1234-5678 の形式で入力してください'},
+    {'name': 'phs_unique', 'kind': 'row_unique', 'fields': ('PHS', '直PHS'),
+     'level': 'warning', 'message': '同じPHS番号が他の行にもあります'},
+    {'name': 'facility_tel_format', 'kind': 'pattern', 'fields': ('関連病院TEL',), 'pattern': rf'(?:{PHONE}).*',
+     'level': 'warning', 'message': '電話番号（例: 011-890-1110）で始まっていません'},
+    {'name': 'graduation_format', 'kind': 'pattern', 'fields': ('卒業',), 'pattern': r'[MTSHR]\d{1,2}|(?:19|20)\d{2}',
+     'level': 'warning', 'message': '卒業年は H12 / R3 / 2005 の形式で入力してください'},
+    {'name': 'doctor_row', 'kind': 'row_requires', 'fields': ('Dr./出身大学',), 'when': ('卒業', '診療科', 'PHS', '直PHS'),
+     'level': 'warning', 'message': 'Dr./出身大学 が空欄です'},
+    {'name': 'facility_row', 'kind': 'row_requires', 'fields': ('関連病院施設等',), 'when': ('関連病院TEL', '関連病院備考'),
+     'level': 'warning', 'message': '関連病院施設等 が空欄です'},
+    {'name': 'vendor_row', 'kind': 'row_requires', 'fields': ('部署', '業者'), 'when': ('内線', 'TEL・メモ'),
+     'level': 'warning', 'message': '部署・業者 が空欄です'},
+)
+
+SERIES_KEY_RE = re.compile(r'^(.+)_(\d+)$')
+
+@lru_cache(maxsize=4096)
+def split_key(key):
+    """'PHS_3' → ('PHS', 3)、連番でないフィールドは (key, None)"""
+    m = SERIES_KEY_RE.match(key)
+    if m:
+        return m.group(1), int(m.group(2))
+    return key, None
+
+def _text(value):
+    if value is None:
+        return ''
+    return (value if isinstance(value, str) else str(value)).strip()
+
+class ValidationError(ValueError):
+    """error のルールに違反（violations に違反の一覧）"""
+
+    def __init__(self, violations):
+        super().__init__(f'{len(violations)} validation error(s)')
+        self.violations = violations
+
+class Validator:
+    """
+    RULES をコンパイルしたチェック
+
+    Args:
+        rules: ルールの一覧（RULES の形式）
+    """
+
+    def __init__(self, rules=RULES):
+        self.rules = tuple(rules)
+        self.required = []            # [(フィールド名, ルール)]
+        self.checks = {}              # {フィールド名 or 連番の列の名前: [(fullmatch, ルール)]}
+        self.row_rules = []           # [(when の名前, fields の名前, ルール)]
+        self.unique = {}              # {連番の列の名前: [ルール]}
+        for rule in self.rules:
+            if rule.get('level') not in LEVELS:
+                raise ValueError(f"level must be one of {LEVELS}: {rule.get('name')}")
+            kind = rule['kind']
+            if kind == 'required':
+                self.required.extend((field, rule) for field in rule['fields'])
+            elif kind == 'pattern':
+                fullmatch = re.compile(rule['pattern']).fullmatch
+                for field in rule['fields']:
+                    self.checks.setdefault(field, []).append((fullmatch, rule))
+            elif kind == 'row_requires':
+                self.row_rules.append((tuple(rule['when']), tuple(rule['fields']), rule))
+            elif kind == 'row_unique':
+                for field in rule['fields']:
+                    self.unique.setdefault(field, []).append(rule)
+            else:
+                raise ValueError(f"Unknown rule kind: {kind}")
+        # 行のチェックで値の有無を調べる連番の列
+        self.row_bases = frozenset(
+            base for when, fields, _ in self.row_rules for base in (*when, *fields)) | frozenset(self.unique)
+        # フィールド名ごとのチェック（同じフィールド名は病院をまたいで繰り返し現れる）
+        self._plan = lru_cache(maxsize=8192)(self._make_plan)
+
+    def _make_plan(self, key):
+        """(連番の列の名前, 行, pattern のチェック, 行のチェックで使うか)"""
+        base, n = split_key(key)
+        return base, n, tuple(self.checks.get(key if n is None else base, ())), n is not None and base in self.row_bases
+
+    def validate(self, kv, changed=None):
+        """
+        違反の一覧
+
+        Args:
+            kv: 病院データ
+            changed: 変更されたフィールド名（None の場合はすべてチェック）。
+                     指定した場合は、そのフィールドと、そのフィールドを含む行だけチェックします
+
+        Returns:
+            [{'field', 'level', 'rule', 'message', 'value'}]
+        """
+        violations = []
+        if changed is not None:
+            changed = set(changed)
+            touched = {}
+            for key in changed:
+                base, n = split_key(key)
+                if n is not None:
+                    touched.setdefault(base, set()).add(n)
+
+        for field, rule in self.required:
+            if (changed is None or field in changed) and not _text(kv.get(field)):
+                violations.append(_violation(field, rule, kv.get(field)))
+
+        plan = self._plan
+        if changed is None:
+            items = kv.items()
+        else:
+            # 変更されたフィールドと、変更された行の値（重複のチェックは列のすべての値）だけ読む
+            keys = set(changed)
+            lines = set()
+            for base, numbers in touched.items():
+                if base in self.row_bases:
+                    lines |= numbers
+                if base in self.unique:
+                    keys.update(key for key in kv if plan(key)[0] == base)
+            keys.update(f'{base}_{n}' for base in self.row_bases for n in lines)
+            items = ((key, kv.get(key)) for key in keys)
+
+        rows = {}
+        for key, value in items:
+            base, n, key_checks, row = plan(key)
+            text = None
+            if row:
+                text = _text(value)
+                if text:
+                    rows.setdefault(base, {})[n] = text
+            if not key_checks or (changed is not None and key not in changed):
+                continue
+            if text is None:
+                text = _text(value)
+            if text:
+                for fullmatch, rule in key_checks:
+                    if not fullmatch(text):
+                        violations.append(_violation(key, rule, value))
+
+        if rows:
+            for when, fields, rule in self.row_rules:
+                lines = set()
+                for base in when:
+                    lines.update(rows.get(base, ()))
+                if changed is not None:
+                    lines &= set().union(*(touched.get(base, ()) for base in (*when, *fields)))
+                for base in fields:
+                    lines.difference_update(rows.get(base, ()))
+                for n in sorted(lines):
+                    violations.append(_violation(f'{fields[0]}_{n}', rule, None))
+
+            for base, rules in self.unique.items():
+                values = rows.get(base)
+                if not values or len(values) < 2:
+                    continue
+                seen = {}
+                for n in sorted(values):
+                    seen.setdefault(values[n], []).append(n)
+                for text, lines in seen.items():
+                    if len(lines) < 2:
+                        continue
+                    if changed is not None and not touched.get(base, set()) & set(lines):
+                        continue
+                    for rule in rules:
+                        violations.extend(_violation(f'{base}_{n}', rule, text) for n in lines[1:])
+        return violations
+
+    def check(self, kv, changed=None, mode=None):
+        """
+        保存前のチェック
+
+        Returns:
+            警告の一覧（error の違反がある場合は ValidationError、mode が warn の場合は警告に含める）
+        """
+        mode = VALIDATION_MODE if mode is None else mode
+        if mode == 'off':
+            return []
+        violations = self.validate(kv, changed)
+        if mode == 'enforce':
+            errors = [v for v in violations if v['level'] == 'error']
+            if errors:
+                raise ValidationError(errors)
+        return violations
+
+def _violation(field, rule, value):
+    return {
+        'field': field,
+        'level': rule['level'],
+        'rule': rule['name'],
+        'message': rule['message'],
+        'value': value,
+    }
+
+# ============================================
+# 全件のチェック
+# ============================================
+
+def check_all(conn, codec, validator, level=None, stats=None):
+    """
+    全病院のチェック（1件ずつ読み込みながら違反のある病院を返す）
+
+    Args:
+        level: 'error' の場合は error の違反だけ
+        stats: 辞書を渡すと 'hospitals' / 'invalid' / 'violations' / 'unreadable' を記録
+
+    Yields:
+        (病院コード, 違反の一覧)
+    """
+    stats = {} if stats is None else stats
+    stats.update(hospitals=0, invalid=0, violations=0, unreadable=0)
+    for code, kv in conn.execute('SELECT code, kv FROM mdata ORDER BY code'):
+        stats['hospitals'] += 1
+        try:
+            data = codec.loads(kv)
+        except Exception:
+            stats['unreadable'] += 1
+            continue
+        violations = validator.validate(data)
+        if level:
+            violations = [v for v in violations if v['level'] == level]
+        if violations:
+            stats['invalid'] += 1
+            stats['violations'] += len(violations)
+            yield code, violations
+
+REPORT_COLUMNS = ('code', 'field', 'level', 'rule', 'message', 'value')
+
+def report_rows(results):
+    """check_all() の結果をレポートの行に"""
+    for code, violations in results:
+        for v in violations:
+            yield (code, v['field'], v['level'], v['rule'], v['message'], '' if v['value'] is None else v['value'])
+
+# ============================================
+# コマンドライン
+# ============================================
+
+def cmd_check(conn, args):
+    validator = Validator()
+    stats = {}
+    started = time.perf_counter()
+    rows = report_rows(check_all(conn, storage_codec.get_codec(args.database), validator, args.level, stats))
+    if args.output:
+        # Excel で開けるよう BOM 付き
+        with codecs.open(args.output, 'w', 'utf-8-sig') as f:
+            writer = csv.writer(f)
+            writer.writerow(REPORT_COLUMNS)
+            writer.writerows(rows)
+        print(f"📄 レポートを出力しました: {args.output}")
+    else:
+        counts = {}
+        for row in rows:
+            counts[(row[3], row[2])] = counts.get((row[3], row[2]), 0) + 1
+        for (rule, level), count in sorted(counts.items(), key=lambda item: -item[1]):
+            print(f"  {level:7s} {rule:20s} {count}件")
+    elapsed = time.perf_counter() - started
+    print(f"📊 病院 {stats['hospitals']}件 → 違反のある病院 {stats['invalid']}件, 違反 {stats['violations']}件"
+          f"（読み込めない病院 {stats['unreadable']}件, {elapsed * 1000:.1f}ms）")
+
+def cmd_bench(conn, args):
+    codec = storage_codec.get_codec(args.database)
+    started = time.perf_counter()
+    validator = Validator()
+    compile_ms = (time.perf_counter() - started) * 1000
+
+    records = []
+    for (kv,) in conn.execute('SELECT kv FROM mdata'):
+        try:
+            records.append(codec.loads(kv))
+        except Exception:
+            pass
+    if not records:
+        print("⚠️ 病院データがありません")
+        return
+
+    def measure(changed_of):
+        times = []
+        for _ in range(args.repeat):
+            for kv in records:
+                changed = changed_of(kv)
+                started = time.perf_counter()
+                validator.validate(kv, changed)
+                times.append(time.perf_counter() - started)
+        times.sort()
+        return (sum(times) / len(times) * 1e6, times[len(times) // 2] * 1e6, times[int(len(times) * 0.99)] * 1e6)
+
+    fields = sum(len(kv) for kv in records) / len(records)
+    print(f"📊 病院 {len(records)}件（平均 {fields:.0f}フィールド）, ルール {len(validator.rules)}件, "
+          f"コンパイル {compile_ms:.2f}ms")
+    for label, changed_of in (('全フィールド', lambda kv: None),
+                              ('保存（1行の変更）', lambda kv: [key for key in kv if split_key(key)[1] == 1][:4] or ['TEL'])):
+        mean, median, p99 = measure(changed_of)
+        print(f"  {label}: 平均 {mean:.1f}µs, 中央値 {median:.1f}µs, p99 {p99:.1f}µs /件")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='病院データの入力チェック')
+    parser.add_argument('--database', default=DB_PATH, help='データベースファイル')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p_check = sub.add_parser('check', help='全病院をチェック（DBは変更しない）')
+    p_check.add_argument('--level', choices=LEVELS, help='指定した level の違反だけ')
+    p_check.add_argument('--output', help='違反の一覧の出力先（CSV、省略時はルールごとの件数を表示）')
+
+    p_bench = sub.add_parser('bench', help='1件あたりのチェック時間を計測')
+    p_bench.add_argument('--repeat', type=int, default=3)
+
+    args = parser.parse_args(argv)
+    conn = sqlite3.connect(args.database)
+    try:
+        {'check': cmd_check, 'bench': cmd_bench}[args.command](conn, args)
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+"""
+gunicorn 用のエントリポイント
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+gunicorn.conf.py では preload_app = True のため、このモジュールはフォーク前に
+マスタープロセスで1回だけ読み込まれ、warmup() の結果がワーカー間で共有されます。
+未適用のマイグレーションがある場合は起動しません（先に python migrations.py upgrade を実行）。
+"""
+
+from app import create_app
+
+app = create_app(preload=True)